@@ -8,11 +8,14 @@ setup(name='soft_phone',
       author_email='greg.farrow1@gmail.com',
       license='MIT',
       packages=['soft_phone'],
-      python_requires='>=3',
+      python_requires='>=3.7',
+      extras_require={'analysis': ['numpy']},
+      entry_points={'pytest11': ['soft_phone = soft_phone.pytest_plugin']},
       keywords='phone sip soft phone testing',
       classifiers=['Programming Language :: Python :: 3',
-                   'Programming Language :: Python :: 3.2',
-                   'Programming Language :: Python :: 3.3',
-                   'Programming Language :: Python :: 3.4',
-                   'Programming Language :: Python :: 3.5'],
+                   'Programming Language :: Python :: 3.7',
+                   'Programming Language :: Python :: 3.8',
+                   'Programming Language :: Python :: 3.9',
+                   'Programming Language :: Python :: 3.10',
+                   'Programming Language :: Python :: 3.11'],
       zip_safe=False)
@@ -0,0 +1,42 @@
+"""
+soft_phone: automated phone call testing with PJSIP/PJSUA
+
+The main classes can be imported from the package itself. They are loaded on first use (PEP 562), so importing
+soft_phone doesn't load pjsua, and the backend can still be chosen afterwards (see soft_phone.backend).
+"""
+import importlib
+
+_LAZY_ATTRIBUTES = {
+    "PJSipClient": "soft_phone.manage_pjsip",
+    "SoftPhone": "soft_phone.soft_phone",
+    "AsyncSoftPhone": "soft_phone.async_soft_phone",
+    "SoftPhonePool": "soft_phone.pool",
+    "PhoneFleet": "soft_phone.fleet",
+    "PhoneCall": "soft_phone.phone_call",
+    "PJSipConfig": "soft_phone.config",
+    "TransportSettings": "soft_phone.config",
+    "MediaProfile": "soft_phone.config",
+    "Answer": "soft_phone.dispositions",
+    "Busy": "soft_phone.dispositions",
+    "Decline": "soft_phone.dispositions",
+    "NoAnswer": "soft_phone.dispositions",
+    "WeightedMix": "soft_phone.dispositions",
+    "CDRWriter": "soft_phone.cdr",
+    "EventDispatcher": "soft_phone.dispatch",
+    "PhoneCallNotInProgress": "soft_phone.exceptions",
+}
+
+__all__ = sorted(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError("module 'soft_phone' has no attribute '{}'".format(name))
+    value = getattr(importlib.import_module(module_name), name)
+    globals()[name] = value  # later lookups don't come back here
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
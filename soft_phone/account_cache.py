@@ -0,0 +1,194 @@
+from soft_phone.backend import get_backend
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+pj = get_backend()
+
+logger = logging.getLogger(__name__)
+
+
+def _cache_key(pbx_ip, pbx_account_name, pbx_password, transport):
+    """
+    :param transport: pjsua Transport - The transport the account is bound to (None for pjsua's default)
+    :return: Tuple - Key of the account in the cache
+    """
+    return pbx_ip, pbx_account_name, pbx_password, None if transport is None else transport._id
+
+
+class _ParkedAccountCallback(pj.AccountCallback):
+    """
+    Looks after a cached account whilst no 'Soft Phone' is using it: keeps track of its registration (which pjsua
+    refreshes by itself) and turns away any call to it
+    """
+
+    def __init__(self, account_cache, cached_account):
+        pj.AccountCallback.__init__(self, None)
+        self.account_cache = account_cache
+        self.cached_account = cached_account
+
+    def on_reg_state(self):
+        account_info = self.account.info()
+        self.cached_account.reg_status = account_info.reg_status
+        if account_info.reg_status >= 300:
+            logger.warning("[%s] Registration of the cached account failed with status %s, evicting it",
+                           self.cached_account.key[1], account_info.reg_status)
+            # not deleted from within its own callback
+            self.account_cache.pjsip_client.timers.schedule(0, self.account_cache._evict, self.cached_account)
+
+    def on_incoming_call(self, call):
+        call.answer(480)  # Temporarily Unavailable, no phone is using the account
+
+
+class _CachedAccount:
+    """
+    A registered pjsua Account waiting in the cache
+    """
+    __slots__ = ("key", "account", "reg_status", "parked_at", "expiry_timer")
+
+    def __init__(self, key, account, reg_status):
+        self.key = key
+        self.account = account
+        self.reg_status = reg_status
+        self.parked_at = time.monotonic()
+        self.expiry_timer = None
+
+
+class AccountCache:
+    """
+    Registered pjsua accounts kept between 'Soft Phones', keyed by (PBX address, account name, password, transport)
+
+    When a phone is unregistered its account is parked here still registered (pjsua goes on refreshing the
+    registration before it expires), and the next phone registering the same account takes it over at once, with
+    no REGISTER round trip. Accounts idle for 'idle_ttl' seconds, or beyond 'max_idle_accounts' (least recently
+    parked first), are unregistered and deleted.
+    pjsua is never called whilst holding the cache's lock, as its callback thread (holding the pjsua lock) may be
+    waiting for it.
+    """
+
+    def __init__(self, pjsip_client, max_idle_accounts=32, idle_ttl=300, refresh_margin=30):
+        """
+        :param pjsip_client: PJSipClient - The client the accounts belong to
+        :param max_idle_accounts: Int - How many accounts no phone is using are kept registered
+        :param idle_ttl: Number - Seconds an account may wait unused before it is unregistered
+        :param refresh_margin: Number - An account handed out with less than this many seconds of its registration
+                               left is re-registered straight away
+        """
+        self.pjsip_client = pjsip_client
+        self.max_idle_accounts = max_idle_accounts
+        self.idle_ttl = idle_ttl
+        self.refresh_margin = refresh_margin
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._idle = OrderedDict()  # key -> _CachedAccount, least recently parked first
+
+    def __len__(self):
+        return len(self._idle)
+
+    def checkout(self, pbx_ip, pbx_account_name, pbx_password, transport=None):
+        """
+        Take a registered account out of the cache
+        Once the caller has set the account's callback, it receives the account's registration changes from then on.
+        :param transport: pjsua Transport - The transport the account must be bound to (None for pjsua's default)
+        :return: pjsua Account - The account (still registering if it was only just warmed up), None if there is none
+        """
+        with self._lock:
+            cached_account = self._idle.pop(_cache_key(pbx_ip, pbx_account_name, pbx_password, transport), None)
+            if cached_account is None or cached_account.reg_status >= 300:
+                self.misses += 1
+                return None
+            self.hits += 1
+        if cached_account.expiry_timer:
+            cached_account.expiry_timer.cancel()
+        account = cached_account.account
+        if cached_account.reg_status == 200 and 0 <= account.info().reg_expires < self.refresh_margin:
+            account.set_registration(True)  # about to expire, refresh it now rather than part way through a test
+        logger.debug("[%s] Registered account taken from the cache", pbx_account_name)
+        return account
+
+    def checkin(self, account, pbx_ip, pbx_account_name, pbx_password, transport=None):
+        """
+        Park a registered account no phone is using any more, ready for the next 'checkout'
+        :param account: pjsua Account - The account
+        :param transport: pjsua Transport - The transport the account is bound to (None for pjsua's default)
+        """
+        cached_account = _CachedAccount(_cache_key(pbx_ip, pbx_account_name, pbx_password, transport), account,
+                                        account.info().reg_status)
+        account.set_callback(_ParkedAccountCallback(self, cached_account))
+        self._park(cached_account)
+        logger.debug("[%s] Registered account parked in the cache", pbx_account_name)
+
+    def prewarm(self, pbx_ip, pbx_account_name, pbx_password, transport=None):
+        """
+        Register an account ahead of time, so that the first phone to use it doesn't have to wait
+        The registration completes in the background.
+        :param transport: pjsua Transport - The transport to bind the account to (see PJSipClient.get_transport)
+        """
+        account_config = pj.AccountConfig(pbx_ip, pbx_account_name, pbx_password)
+        if transport is not None:
+            account_config.transport_id = transport._id
+        cached_account = _CachedAccount(_cache_key(pbx_ip, pbx_account_name, pbx_password, transport), None, 0)
+        cached_account.account = self.pjsip_client.lib.create_account(
+            account_config, cb=_ParkedAccountCallback(self, cached_account))
+        self.pjsip_client.resources.add("accounts")
+        self._park(cached_account)
+
+    def _park(self, cached_account):
+        """
+        Add an account to the cache, evicting the least recently parked ones beyond 'max_idle_accounts'
+        """
+        cached_account.expiry_timer = self.pjsip_client.timers.schedule(self.idle_ttl, self._evict, cached_account)
+        evicted = []
+        with self._lock:
+            replaced = self._idle.pop(cached_account.key, None)  # the same account can't be registered twice
+            if replaced is not None:
+                evicted.append(replaced)
+            self._idle[cached_account.key] = cached_account
+            while len(self._idle) > self.max_idle_accounts:
+                evicted.append(self._idle.popitem(last=False)[1])
+        for old_account in evicted:
+            self._delete(old_account)
+
+    def _evict(self, cached_account):
+        """
+        Remove an account from the cache, unless a phone has taken it since (runs on the timer thread)
+        """
+        with self._lock:
+            if self._idle.get(cached_account.key) is not cached_account:
+                return
+            del self._idle[cached_account.key]
+        self._delete(cached_account)
+
+    def _delete(self, cached_account):
+        """
+        Unregister and delete an account which has left the cache
+        """
+        if cached_account.expiry_timer:
+            cached_account.expiry_timer.cancel()
+        self.evictions += 1
+        logger.debug("[%s] Deleting the cached account", cached_account.key[1])
+        try:
+            cached_account.account.delete()  # pjsua unregisters it first
+        except pj.Error as e:
+            logger.warning("[%s] Unable to delete the cached account: %s", cached_account.key[1], e)
+        else:
+            self.pjsip_client.resources.add("accounts", -1)
+
+    def clear(self):
+        """
+        Unregister and delete every account in the cache
+        """
+        with self._lock:
+            cached_accounts = list(self._idle.values())
+            self._idle.clear()
+        for cached_account in cached_accounts:
+            self._delete(cached_account)
+
+    def stats(self):
+        """
+        :return: Dict - The number of accounts waiting in the cache, and the hits, misses and evictions so far
+        """
+        return {"idle": len(self._idle), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
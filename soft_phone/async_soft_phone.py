@@ -0,0 +1,249 @@
+import asyncio
+import logging
+import time
+from soft_phone.callbacks import TRACE
+from soft_phone.dtmf import _as_pattern
+from soft_phone.soft_phone import SoftPhone
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSoftPhone:
+    """
+    asyncio facade for a 'Soft Phone', every blocking wait of SoftPhone becomes an awaitable
+
+    The pjsua callback threads hand each state change over to the event loop (with 'call_soon_threadsafe'), so
+    any number of phones can be driven from a single event loop without a sleeping thread per phone.
+    """
+
+    def __init__(self, pjsip_client, pbx_ip, pbx_account_name, pbx_password, answer_audio=None, loop=True,
+                 action_on_incoming_call="ANSWER", transport=None, recording_directory=None):
+        """
+        :param pjsip_client: Established instance of PJSip Lib
+        :param pbx_account_name: String - the telephone number to register as
+        :param answer_audio: String - File path of a WAV file which should be played once an incoming call is answered
+        :param loop: Boolean - Indicate if the audio file should be looped (True), or played once (False)
+        :param transport: Int or pjsua Transport - The PJSipClient transport to bind the account to (see SoftPhone)
+        :param recording_directory: String - Record the audio received on every call to this directory (see SoftPhone)
+        """
+        self.soft_phone = SoftPhone(pjsip_client, pbx_ip, pbx_account_name, pbx_password, answer_audio=answer_audio,
+                                    loop=loop, action_on_incoming_call=action_on_incoming_call, transport=transport,
+                                    recording_directory=recording_directory)
+        self.pjsip_client = pjsip_client
+        self.pbx_account_name = pbx_account_name
+        self._event_loop = None
+        self._waiters = []
+        self.soft_phone.add_state_listener(self._on_state_changed)
+
+    def _on_state_changed(self, phone_call):
+        """
+        State listener, runs on the pjsua callback thread and defers the real work to the event loop
+        """
+        event_loop = self._event_loop
+        if event_loop is not None and self._waiters:
+            event_loop.call_soon_threadsafe(self._resolve_waiters)
+
+    def _resolve_waiters(self):
+        """
+        Complete the futures of any waiters whose predicate is now satisfied (runs on the event loop)
+        """
+        for predicate, future in list(self._waiters):
+            if not future.done() and predicate():
+                future.set_result(True)
+
+    def _bind_event_loop(self):
+        """
+        Attach the phone to the running event loop and make sure its thread may call into pjsua
+        """
+        self._event_loop = asyncio.get_running_loop()
+        self.pjsip_client.register_thread()
+
+    async def _wait_for_state(self, predicate, time_out):
+        """
+        Await the state published by the pjsua callbacks satisfying a predicate (with a time out)
+        :param predicate: Callable - Evaluated against the published state only, it must not call into pjsua
+        :param time_out: Number - The maximum number of seconds to wait (None to wait indefinitely)
+        :return: Boolean - True if the predicate was satisfied before the time out
+        """
+        if predicate():
+            return True
+        waiter = (predicate, self._event_loop.create_future())
+        self._waiters.append(waiter)
+        try:
+            if predicate():  # the state may have changed before the listener could see this waiter
+                return True
+            await asyncio.wait_for(waiter[1], time_out)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiters.remove(waiter)
+
+    async def register(self, time_out=10):
+        """
+        Register the account with the PBX
+        :param time_out: Int - The maximum number of seconds to wait for the registration to complete
+        :return: Boolean - True if the PBX accepted the registration
+        """
+        self._bind_event_loop()
+        self.soft_phone._create_and_register_account_with_pbx()
+        await self._wait_for_state(self.soft_phone._registration_finished, time_out)
+        if self.soft_phone.reg_status == 200:
+            logger.debug("[%s] [RUN] Account is now registered", self.pbx_account_name)
+            return True
+        logger.warning("[%s] [RUN] Account registration did not succeed (status %s)",
+                       self.pbx_account_name, self.soft_phone.reg_status)
+        return False
+
+    async def unregister(self, time_out=10):
+        """
+        Unregister and delete the account (or park it in the PJSipClient's account cache, if it has one)
+        :param time_out: Int - The maximum number of seconds to wait for the PBX to remove the registration
+        """
+        self._bind_event_loop()
+        if self.soft_phone._park_account():
+            return
+        self.soft_phone._start_unregistration()
+        if await self._wait_for_state(self.soft_phone._unregistration_finished, time_out):
+            logger.log(TRACE, "[%s] Registration status is now False", self.pbx_account_name)
+        self.soft_phone._delete_account()
+
+    async def make_call(self, number_to_dial, protocol="sip", time_out=12):
+        """
+        Dial a number/start a call
+        :param number_to_dial: String - The number (SIP user) to dial
+        :param protocol: String - URI scheme used to build the destination, e.g. "sip"
+        :param time_out: Int - The maximum number of seconds to wait for the call to be CONFIRMED
+        :return: PhoneCall - Handle for the call (check 'is_connected()' to see whether it was answered)
+        """
+        self._bind_event_loop()
+        phone_call = self.soft_phone._start_call(number_to_dial, protocol)
+        await self._wait_for_state(phone_call.setup_finished, time_out)
+        if phone_call.is_connected():
+            logger.info("[%s] Number dialled and connected (call in progress)", self.pbx_account_name)
+        else:
+            logger.log(TRACE, "[%s] Call state is '%s'", self.pbx_account_name, phone_call.state)
+        return phone_call
+
+    async def wait_for_call(self, time_out=60):
+        """
+        Wait for a call to happen (with a time out)
+        :param time_out: Int - The maximum number of seconds to wait for a call to happen
+        :return: PhoneCall - The current call, or None if no call happened
+        """
+        self._bind_event_loop()
+        logger.info("[%s] Waiting for a call to happen", self.pbx_account_name)
+        await self._wait_for_state(self.soft_phone._call_has_occurred, time_out)
+        return self.soft_phone.current_call
+
+    async def wait_for_call_to_end(self, time_out=60, call=None):
+        """
+        Wait for an existing call to end (with a time out)
+        :param time_out: Int - The maximum number of seconds to wait for the call to end
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        :return: Boolean - True if the call has ended
+        """
+        self._bind_event_loop()
+        phone_call = self.soft_phone._validate_phone_call_in_progress(call)
+        return await self._wait_for_state(phone_call.has_ended, time_out)
+
+    async def wait_for_call_length(self, desired_call_length, time_out=None, call=None):
+        """
+        Wait until the call has been connected for a specific duration
+        :param desired_call_length: Number - Seconds of connection time to wait for
+        :param time_out: Number - The maximum number of seconds to wait for the call to connect in the first place
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        :return: Boolean - True if the duration was reached, False if the call ended (or never connected) first
+        """
+        self._bind_event_loop()
+        phone_call = self.soft_phone._validate_phone_call_in_progress(call)
+        await self._wait_for_state(phone_call.setup_finished, time_out)
+        connected_at = phone_call.connected_at
+        if connected_at is None or phone_call.has_ended():
+            return False
+        remaining = connected_at + desired_call_length - time.monotonic()
+        if remaining > 0 and await self._wait_for_state(phone_call.has_ended, remaining):
+            return False
+        logger.debug("[%s] The desired call connection duration (%s seconds) has been reached",
+                     self.pbx_account_name, desired_call_length)
+        return True
+
+    def schedule_call_action(self, offset, action, *args, call=None):
+        """
+        Run an action on a call at a precise offset from the moment it was CONFIRMED, on the PJSipClient's timer
+        thread (see SoftPhone.schedule_call_action)
+        :param offset: Number - Seconds after the call was CONFIRMED
+        :param action: String or Callable - e.g. "hang_up" or "send_dtmf_key_tones"
+        :param args: Arguments of the action
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        :return: Timer - Handle to cancel the action with
+        """
+        return self.soft_phone.schedule_call_action(offset, action, *args, call=call)
+
+    def hang_up_after(self, call_length, call=None):
+        """
+        Hang up a call once it has been connected for a specific duration, without awaiting it
+        :param call_length: Number - Seconds of connection time
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        :return: Timer - Handle to cancel the hang up with
+        """
+        return self.soft_phone.hang_up_after(call_length, call)
+
+    async def hang_up(self, time_out=10, call=None):
+        """
+        End an in progress call and wait for the disconnection to complete
+        :param time_out: Int - The maximum number of seconds to wait for the call to be disconnected
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        """
+        self._bind_event_loop()
+        phone_call = self.soft_phone._validate_phone_call_in_progress(call)
+        self.soft_phone.hang_up(phone_call)
+        await self._wait_for_state(phone_call.has_ended, time_out)
+
+    async def send_dtmf_key_tones(self, digits, call=None):
+        """
+        Send DTMF keypad tones to the call
+        :param digits: String - Digits to send over the call
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        """
+        self._bind_event_loop()
+        self.soft_phone.send_dtmf_key_tones(digits, call)
+
+    async def send_dtmf_sequence(self, sequence, time_out=60, call=None):
+        """
+        Play a scripted DTMF sequence on a call and wait for it to finish
+        :param sequence: DTMFSequence or String - The sequence, or a dial string (see SoftPhone.send_dtmf_sequence)
+        :param time_out: Number - The maximum number of seconds to wait for the sequence to finish
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        :return: DTMFSequenceRun - The sequence, its 'state' is "completed" if every step was
+        """
+        self._bind_event_loop()
+        run = self.soft_phone.send_dtmf_sequence(sequence, call)
+        await self._wait_for_state(run.finished, time_out)
+        return run
+
+    async def wait_for_dtmf(self, pattern, time_out=10, call=None):
+        """
+        Wait for DTMF digits matching a pattern to be received on a call (see SoftPhone.wait_for_dtmf)
+        :param pattern: String or compiled regular expression - The digits wanted
+        :param time_out: Number - The maximum number of seconds to wait
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        :return: DTMFMatch - The digits with their timings, None if they didn't arrive before the time out or the
+                 end of the call
+        """
+        self._bind_event_loop()
+        phone_call = self.soft_phone._validate_phone_call_in_progress(call)
+        pattern = _as_pattern(pattern)
+        found = []
+
+        def matched():
+            if not found:
+                with self.soft_phone._state_changed:  # matching consumes digits the callback thread appends to
+                    dtmf_match = phone_call.dtmf.match(pattern)
+                    if dtmf_match:
+                        self.soft_phone.metrics.on_dtmf_match(dtmf_match)
+                        found.append(dtmf_match)
+            return bool(found) or phone_call.has_ended()
+
+        await self._wait_for_state(matched, time_out)
+        return found[0] if found else None
@@ -0,0 +1,363 @@
+"""
+Analysis of recorded call audio: DTMF and tone detection, silence segmentation and playback latency
+
+Every function works on a whole recording at once with NumPy (install the 'analysis' extra: pip install
+soft_phone[analysis]), so a recording of a typical call is analysed in milliseconds. RecordingAnalyser and
+analyse_directory spread the work over a pool of processes.
+"""
+import glob
+import logging
+import multiprocessing
+import os
+import wave
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:  # only needed for the analysis itself
+    np = None
+
+logger = logging.getLogger(__name__)
+
+DTMF_LOW_FREQUENCIES = (697, 770, 852, 941)
+DTMF_HIGH_FREQUENCIES = (1209, 1336, 1477, 1633)
+DTMF_KEYS = ("123A", "456B", "789C", "*0#D")  # rows by low frequency, columns by high frequency
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("Audio analysis needs NumPy, install it with 'pip install soft_phone[analysis]'")
+
+
+def read_wav(path):
+    """
+    Read a PCM WAV file (e.g. a call recording) as samples scaled to -1.0 to 1.0
+    :param path: String - Path of the WAV file
+    :return: Tuple (numpy array - The samples (channels are mixed down to one), Int - Sample rate in Hz)
+    """
+    _require_numpy()
+    with wave.open(path, "rb") as wav_file:
+        channels, sample_width, sample_rate = (wav_file.getnchannels(), wav_file.getsampwidth(),
+                                               wav_file.getframerate())
+        frames = wav_file.readframes(wav_file.getnframes())
+    if sample_width == 1:  # 8 bit WAV is unsigned
+        samples = (np.frombuffer(frames, np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width == 2:
+        samples = np.frombuffer(frames, "<i2").astype(np.float32) / 32768
+    elif sample_width == 4:
+        samples = np.frombuffer(frames, "<i4").astype(np.float32) / 2147483648
+    else:
+        raise ValueError("{} bit WAV files are not supported".format(sample_width * 8))
+    if channels > 1:
+        samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels).mean(axis=1)
+    return samples, sample_rate
+
+
+def _frames(samples, frame_size):
+    """
+    :return: numpy array - The samples as consecutive frames, one per row (any part frame at the end is dropped)
+    """
+    frame_count = len(samples) // frame_size
+    return samples[:frame_count * frame_size].reshape(frame_count, frame_size)
+
+
+def frame_energy(samples, sample_rate, frame_ms=20):
+    """
+    :param samples: numpy array - Samples scaled to -1.0 to 1.0
+    :param sample_rate: Int - Hz
+    :param frame_ms: Number - Length of each frame in milliseconds
+    :return: numpy array - The RMS level of each frame in dBFS
+    """
+    _require_numpy()
+    return _levels(_frames(samples, max(1, int(sample_rate * frame_ms / 1000))))
+
+
+def _levels(frames):
+    """
+    :return: numpy array - The RMS level of each frame in dBFS
+    """
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+    return 20 * np.log10(np.maximum(rms, 1e-10))
+
+
+def tone_powers(samples, sample_rate, frequencies, frame_size):
+    """
+    Goertzel filter bank over every frame at once: how much of each frame's energy is at each frequency
+    The Goertzel outputs are evaluated together as one matrix product of the frames with the filters' DFT terms,
+    rather than by running the recurrence sample by sample.
+    :param samples: numpy array - Samples scaled to -1.0 to 1.0
+    :param sample_rate: Int - Hz
+    :param frequencies: Tuple - Hz
+    :param frame_size: Int - Samples in each frame
+    :return: numpy array - One row per frame, one column per frequency, the fraction (0 to about 1) of the frame's
+             energy at that frequency
+    """
+    _require_numpy()
+    frames = _frames(samples, frame_size).astype(np.float64)
+    n = np.arange(frame_size)
+    # each frequency itself rather than its nearest DFT bin (the generalised Goertzel algorithm), as a tone between
+    # two bins (e.g. 425 Hz in 20 ms frames) would otherwise lose over half its power
+    bins = np.asarray(frequencies, dtype=np.float64) * frame_size / sample_rate
+    terms = np.exp(-2j * np.pi * np.outer(n, bins) / frame_size)
+    powers = np.abs(frames @ terms) ** 2
+    energy = np.sum(np.square(frames), axis=1, keepdims=True)
+    return 2 * powers / (frame_size * np.maximum(energy, 1e-20))
+
+
+def _runs(active, frame_seconds, min_frames=1):
+    """
+    :param active: numpy array - Boolean of each frame
+    :return: List - (start seconds, end seconds) of each run of at least 'min_frames' active frames
+    """
+    edges = np.diff(np.concatenate(([0], active.astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    return [(float(start * frame_seconds), float(end * frame_seconds)) for start, end in zip(starts, ends)
+            if end - start >= min_frames]
+
+
+def detect_tone(samples, sample_rate, frequency, threshold=0.5, min_level_db=-45, frame_ms=20, min_duration=0.05):
+    """
+    Find where a tone (e.g. a 1 kHz test tone or a 425 Hz ring back) is present
+    :param samples: numpy array - Samples scaled to -1.0 to 1.0
+    :param sample_rate: Int - Hz
+    :param frequency: Number - Hz
+    :param threshold: Float - Fraction of a frame's energy which must be at the frequency
+    :param min_level_db: Number - Frames quieter than this (dBFS) are never a tone
+    :param frame_ms: Number - Length of each analysis frame in milliseconds
+    :param min_duration: Float - Shortest tone to report, in seconds
+    :return: List - (start seconds, end seconds) of each stretch of tone
+    """
+    frame_size = max(1, int(sample_rate * frame_ms / 1000))
+    frame_seconds = frame_size / sample_rate
+    present = ((tone_powers(samples, sample_rate, (frequency,), frame_size)[:, 0] >= threshold) &
+               (_levels(_frames(samples, frame_size)) >= min_level_db))
+    return _runs(present, frame_seconds, max(1, int(round(min_duration / frame_seconds))))
+
+
+def detect_dtmf(samples, sample_rate, min_level_db=-40, threshold=0.6, max_twist_db=8, min_frames=2):
+    """
+    Decode the in-band DTMF digits in a recording
+    Each frame (about 26 ms) is tested against the eight DTMF frequencies. It holds a digit when the strongest low and
+    high group tones together carry most of its energy and are within 'max_twist_db' of each other. A digit is
+    reported once for each run of at least 'min_frames' frames holding it.
+    :param samples: numpy array - Samples scaled to -1.0 to 1.0
+    :param sample_rate: Int - Hz
+    :param min_level_db: Number - Frames quieter than this (dBFS) never hold a digit
+    :param threshold: Float - Fraction of a frame's energy the two tones must carry
+    :param max_twist_db: Number - Largest difference in level allowed between the two tones
+    :param min_frames: Int - Frames a digit must last for
+    :return: String - The digits, in order
+    """
+    frame_size = max(1, int(round(sample_rate * 0.0256)))  # 205 samples at 8 kHz, the classic DTMF Goertzel block
+    powers = tone_powers(samples, sample_rate, DTMF_LOW_FREQUENCIES + DTMF_HIGH_FREQUENCIES, frame_size)
+    if not len(powers):
+        return ""
+    low, high = powers[:, :4], powers[:, 4:]
+    rows, columns = np.argmax(low, axis=1), np.argmax(high, axis=1)
+    low_power, high_power = np.max(low, axis=1), np.max(high, axis=1)
+    twist = np.abs(10 * np.log10(np.maximum(low_power, 1e-12) / np.maximum(high_power, 1e-12)))
+    loud = _levels(_frames(samples, frame_size)) >= min_level_db
+    valid = loud & (low_power + high_power >= threshold) & (twist <= max_twist_db)
+    codes = np.where(valid, rows * 4 + columns, -1)  # -1 where no digit
+    change = np.flatnonzero(np.diff(np.concatenate(([-2], codes, [-2]))))  # the start of each run of equal codes
+    digits = []
+    for start, end in zip(change[:-1], change[1:]):
+        code = codes[start]
+        if code >= 0 and end - start >= min_frames:
+            digits.append(DTMF_KEYS[code // 4][code % 4])
+    return "".join(digits)
+
+
+def segment_silence(samples, sample_rate, threshold_db=-50, frame_ms=20, min_silence=0.2):
+    """
+    Split a recording into stretches of sound and silence
+    :param samples: numpy array - Samples scaled to -1.0 to 1.0
+    :param sample_rate: Int - Hz
+    :param threshold_db: Number - Frames quieter than this (dBFS) are silent
+    :param frame_ms: Number - Length of each analysis frame in milliseconds
+    :param min_silence: Float - Shorter silences (in seconds) are counted as part of the sound around them
+    :return: List - (start seconds, end seconds, Boolean - silent) of each segment, in order
+    """
+    frame_seconds = max(1, int(sample_rate * frame_ms / 1000)) / sample_rate
+    silent = frame_energy(samples, sample_rate, frame_ms) < threshold_db
+    silences = _runs(silent, frame_seconds, max(1, int(round(min_silence / frame_seconds))))
+    segments, position = [], 0.0
+    for start, end in silences:
+        if start > position:
+            segments.append((position, start, False))
+        segments.append((start, end, True))
+        position = end
+    total = len(silent) * frame_seconds
+    if total > position:
+        segments.append((position, total, False))
+    return segments
+
+
+def resample(samples, sample_rate, target_rate):
+    """
+    Linear interpolation resampling, good enough for aligning a reference with a recording
+    :return: numpy array - The samples at 'target_rate'
+    """
+    _require_numpy()
+    if sample_rate == target_rate:
+        return samples
+    duration = len(samples) / sample_rate
+    return np.interp(np.arange(int(duration * target_rate)) / target_rate, np.arange(len(samples)) / sample_rate,
+                     samples).astype(np.float32)
+
+
+def playback_latency(recording, reference, sample_rate, max_latency=None):
+    """
+    Find where a reference (e.g. the WAV the far end was told to play) starts in a recording by cross-correlation
+    :param recording: numpy array - The recorded samples
+    :param reference: numpy array - The reference samples, at the same sample rate
+    :param sample_rate: Int - Hz
+    :param max_latency: Float - Only search this many seconds into the recording (None for all of it)
+    :return: Tuple (Float - Seconds into the recording the reference starts, Float - Normalised correlation at that
+             point, about 1.0 for a clean copy and near 0 if the reference isn't there), (None, 0.0) if the
+             recording is shorter than the reference
+    """
+    _require_numpy()
+    recording = np.asarray(recording, dtype=np.float64)
+    reference = np.asarray(reference, dtype=np.float64)
+    if max_latency is not None:
+        recording = recording[:int(max_latency * sample_rate) + len(reference)]
+    if len(recording) < len(reference) or not len(reference):
+        return None, 0.0
+    size = 1 << int(len(recording) + len(reference) - 1).bit_length()
+    correlation = np.fft.irfft(np.fft.rfft(recording, size) * np.conj(np.fft.rfft(reference, size)), size)
+    correlation = correlation[:len(recording) - len(reference) + 1]  # lags where the whole reference fits
+    # energy of the recording under the reference at each lag, to normalise the correlation
+    energy = np.cumsum(np.concatenate(([0.0], np.square(recording))))
+    window_energy = energy[len(reference):] - energy[:-len(reference)]
+    normalised = correlation / np.sqrt(np.maximum(window_energy * np.sum(np.square(reference)), 1e-20))
+    lag = int(np.argmax(normalised))
+    return lag / sample_rate, float(normalised[lag])
+
+
+def analyse_recording(path, reference_path=None, tones=(), silence_threshold_db=-50, max_latency=None):
+    """
+    Run every analysis on a recording, returning plain values (so it can be run in another process)
+    :param path: String - Path of the recorded WAV file
+    :param reference_path: String - WAV file which should have been played to the phone, to find in the recording
+    :param tones: Tuple - Frequencies (Hz) to look for
+    :param silence_threshold_db: Number - Frames quieter than this (dBFS) are silent
+    :param max_latency: Float - Only look for the reference this many seconds into the recording
+    :return: Dict - "duration", "level_db", "dtmf", "silence_ratio", "segments", "tones" (frequency -> stretches),
+             "latency" and "correlation" (if given a reference), or "error" if the recording couldn't be read
+    """
+    try:
+        samples, sample_rate = read_wav(path)
+    except (EOFError, OSError, ValueError, wave.Error) as error:
+        return {"path": path, "error": "{}: {}".format(type(error).__name__, error)}
+    duration = len(samples) / sample_rate if sample_rate else 0.0
+    segments = segment_silence(samples, sample_rate, silence_threshold_db)
+    silent = sum(end - start for start, end, is_silent in segments if is_silent)
+    result = {"path": path, "duration": duration,
+              "level_db": float(20 * np.log10(max(float(np.sqrt(np.mean(np.square(samples)))), 1e-10)))
+              if len(samples) else None,
+              "dtmf": detect_dtmf(samples, sample_rate), "silence_ratio": silent / duration if duration else 1.0,
+              "segments": segments,
+              "tones": {frequency: detect_tone(samples, sample_rate, frequency) for frequency in tones}}
+    if reference_path:
+        reference, reference_rate = read_wav(reference_path)
+        result["latency"], result["correlation"] = playback_latency(
+            samples, resample(reference, reference_rate, sample_rate), sample_rate, max_latency)
+    return result
+
+
+def _analyse_batch(paths, analysis_kwargs):
+    return [analyse_recording(path, **analysis_kwargs) for path in paths]
+
+
+def analyse_directory(directory, pattern="*.wav", processes=None, batch_size=32, **analysis_kwargs):
+    """
+    Analyse every recording in a directory over a pool of processes
+    :param directory: String - Directory of recordings
+    :param pattern: String - Glob pattern of the files to analyse
+    :param processes: Int - Size of the process pool (defaults to the number of CPUs)
+    :param batch_size: Int - Recordings sent to a process at once
+    :param analysis_kwargs: Passed to analyse_recording, e.g. reference_path or tones
+    :return: Dict - Path -> analysis of each recording
+    """
+    _require_numpy()
+    paths = sorted(glob.glob(os.path.join(directory, pattern)))
+    batches = [paths[index:index + batch_size] for index in range(0, len(paths), batch_size)]
+    results = {}
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+        for batch in executor.map(_analyse_batch, batches, [analysis_kwargs] * len(batches)):
+            results.update((result["path"], result) for result in batch)
+    return results
+
+
+class RecordingAnalyser:
+    """
+    Analyse the recordings of calls as they end, on a pool of processes
+
+    Attach it to phones recording their calls (see SoftPhone's 'recording_directory') and each recording is
+    analysed once its call has ended, the result passed to 'on_result'.
+    """
+
+    def __init__(self, on_result=None, processes=None, **analysis_kwargs):
+        """
+        :param on_result: Callable - Called with the PhoneCall (None for 'submit') and its analysis, on a thread of
+                          the pool's, it must return quickly
+        :param processes: Int - Size of the process pool (defaults to the number of CPUs)
+        :param analysis_kwargs: Passed to analyse_recording, e.g. reference_path or tones
+        """
+        _require_numpy()
+        self.on_result = on_result
+        self.analysis_kwargs = analysis_kwargs
+        # spawned rather than forked, so the workers don't inherit pjsua's threads
+        self._executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn"))
+        self._listeners = {}
+
+    def submit(self, path, phone_call=None):
+        """
+        Analyse a recording
+        :param path: String - Path of the recording
+        :param phone_call: PhoneCall - The call it is a recording of, passed on to 'on_result'
+        :return: concurrent.futures Future - Completed with the analysis
+        """
+        future = self._executor.submit(analyse_recording, path, **self.analysis_kwargs)
+        if self.on_result:
+            future.add_done_callback(lambda done: self._deliver(phone_call, done))
+        return future
+
+    def _deliver(self, phone_call, future):
+        try:
+            self.on_result(phone_call, future.result())
+        except Exception:
+            logger.exception("Failed to deliver the analysis of the recording of %r", phone_call)
+
+    def attach(self, sip_phone):
+        """
+        Analyse the recording of each of a phone's calls once the call has ended
+        :param sip_phone: SoftPhone - The phone
+        """
+        def listener(phone_call):
+            if phone_call is not None and phone_call.has_ended() and phone_call.recording_path \
+                    and not phone_call.recording_analysed:
+                phone_call.recording_analysed = True
+                self.submit(phone_call.recording_path, phone_call)
+
+        self._listeners[sip_phone] = listener
+        sip_phone.add_state_listener(listener)
+
+    def detach(self, sip_phone):
+        """
+        Stop analysing a phone's recordings
+        :param sip_phone: SoftPhone - The phone
+        """
+        listener = self._listeners.pop(sip_phone, None)
+        if listener:
+            sip_phone.remove_state_listener(listener)
+
+    def close(self, wait=True):
+        """
+        Detach every phone and shut the process pool down
+        :param wait: Boolean - Wait for the analyses already submitted to finish
+        """
+        for sip_phone in list(self._listeners):
+            self.detach(sip_phone)
+        self._executor.shutdown(wait)
@@ -0,0 +1,149 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class _CachedPlayer:
+    """
+    A pjsua WAV player held by the cache
+    """
+    __slots__ = ("key", "player_id", "slot", "users")
+
+    def __init__(self, key, player_id, slot):
+        self.key = key
+        self.player_id = player_id
+        self.slot = slot
+        self.users = 0
+
+
+class AudioPlayerCache:
+    """
+    Shared pjsua WAV players for audio played on calls, keyed by (file path, loop)
+
+    A looped player is created once and its conference slot connected to every call playing that file, so each
+    file is opened and parsed once and uses a single conference port however many calls it is played on.
+    A player which plays once can't be shared (later calls would join it part way through), so it is only reused
+    once idle, rewound to the start.
+    Players are reference counted, those no call is using are kept (up to 'max_idle_players', least recently used
+    evicted first) ready for the next call.
+    pjsua is never called whilst holding the cache's lock, as its callback thread (holding the pjsua lock) may be
+    waiting for it.
+    """
+
+    def __init__(self, lib, max_idle_players=8):
+        """
+        :param lib: pjsua Lib - The initialised PJSip library
+        :param max_idle_players: Int - How many players no call is using are kept rather than destroyed
+        """
+        self.lib = lib
+        self.max_idle_players = max_idle_players
+        self._lock = threading.Lock()
+        self._players = {}  # player id -> _CachedPlayer
+        self._shared = {}  # (path, True) -> _CachedPlayer, the one player of each looped file
+        self._idle = OrderedDict()  # player id -> _CachedPlayer, least recently used first
+
+    def __len__(self):
+        return len(self._players)
+
+    def _take_idle(self, key):
+        """
+        Claim a player for 'key' which is not in use (the lock must be held)
+        :return: _CachedPlayer - The player, or None if there isn't one
+        """
+        for player_id, player in self._idle.items():
+            if player.key == key:
+                del self._idle[player_id]
+                return player
+        return None
+
+    def acquire(self, audio_file_path, loop=True):
+        """
+        Get a player of the audio file for a call, creating one if need be
+        :param audio_file_path: String - path to the audio (WAV) file
+        :param loop: Boolean - Should the audio file be played in a loop (True), or just once (False)
+        :return: Tuple (Int - player id, Int - conference slot of the player)
+        """
+        key = (audio_file_path, bool(loop))
+        rewind = False
+        with self._lock:
+            player = self._shared.get(key) if loop else None
+            if player is None:
+                player = self._take_idle(key)
+                rewind = player is not None and not loop
+            else:
+                self._idle.pop(player.player_id, None)
+            if player is not None:
+                player.users += 1
+        if player is not None:
+            if rewind:
+                self.lib.player_set_pos(player.player_id, 0)
+            logger.debug("Reusing audio player %s for '%s' (%s calls)", player.player_id, audio_file_path,
+                         player.users)
+            return player.player_id, player.slot
+
+        if not os.path.exists(audio_file_path):
+            raise FileNotFoundError("Cannot find your audio file: {}".format(audio_file_path))
+        if not os.path.isfile(audio_file_path):
+            raise FileNotFoundError("Your audio file is not a file: {}".format(audio_file_path))
+        player_id = self.lib.create_player(audio_file_path, loop=loop)
+        player = _CachedPlayer(key, player_id, self.lib.player_get_slot(player_id))
+        player.users = 1
+        duplicate = None
+        with self._lock:
+            if loop and key in self._shared:  # another thread created the shared player at the same time
+                duplicate, player = player, self._shared[key]
+                self._idle.pop(player.player_id, None)
+                player.users += 1
+            else:
+                self._players[player_id] = player
+                if loop:
+                    self._shared[key] = player
+        if duplicate is not None:
+            self.lib.player_destroy(duplicate.player_id)
+        logger.debug("Created audio player %s for '%s'", player.player_id, audio_file_path)
+        return player.player_id, player.slot
+
+    def release(self, player_id):
+        """
+        A call has stopped using a player, keep it for reuse or destroy it if too many are idle
+        The caller disconnects the player from the call's conference slot (pjsua does so itself once a call ends).
+        :param player_id: Int - Player id returned by 'acquire'
+        """
+        evicted = []
+        with self._lock:
+            player = self._players.get(player_id)
+            if player is None or player.users == 0:
+                logger.warning("Audio player %s is not in use, it can't be released", player_id)
+                return
+            player.users -= 1
+            if player.users:
+                return
+            self._idle[player_id] = player
+            while len(self._idle) > self.max_idle_players:
+                evicted.append(self._forget(self._idle.popitem(last=False)[1]))
+        for player in evicted:
+            logger.debug("Destroying idle audio player %s for '%s'", player.player_id, player.key[0])
+            self.lib.player_destroy(player.player_id)
+
+    def _forget(self, player):
+        """
+        Remove a player from the cache (the lock must be held)
+        :return: _CachedPlayer - The player
+        """
+        del self._players[player.player_id]
+        if self._shared.get(player.key) is player:
+            del self._shared[player.key]
+        return player
+
+    def clear(self):
+        """
+        Destroy every idle player (players in use are left to their calls)
+        """
+        with self._lock:
+            evicted = [self._forget(player) for player in self._idle.values()]
+            self._idle.clear()
+        for player in evicted:
+            self.lib.player_destroy(player.player_id)
@@ -0,0 +1,61 @@
+"""
+Selects the pjsua implementation every soft_phone module is built on
+
+The real pjsua bindings are used unless the SOFT_PHONE_BACKEND environment variable or 'use_backend' selects
+another, e.g. "fake" for the in-process simulation in soft_phone.fake_pjsua. The backend is loaded when the first
+soft_phone module which needs it is imported, so it has to be chosen before then.
+"""
+import importlib
+import os
+import threading
+
+ENVIRONMENT_VARIABLE = "SOFT_PHONE_BACKEND"
+
+BACKENDS = {
+    "pjsua": "pjsua",
+    "fake": "soft_phone.fake_pjsua",
+}
+
+_backend = None
+_lock = threading.Lock()
+
+
+def _module_name(name):
+    """
+    :param name: String - A name from BACKENDS, or the name of any module implementing the pjsua API
+    :return: String - The module to import
+    """
+    return BACKENDS.get(name, name)
+
+
+def use_backend(name):
+    """
+    Choose the pjsua implementation, before any module which uses it is imported
+    :param name: String - "pjsua", "fake", or the name of any module implementing the pjsua API
+    """
+    global _backend
+    with _lock:
+        if _backend is not None:
+            if _backend.__name__ != _module_name(name):
+                raise RuntimeError("The '{}' backend is already in use, '{}' must be chosen before any soft_phone "
+                                   "module using pjsua is imported".format(_backend.__name__, name))
+            return
+        _backend = importlib.import_module(_module_name(name))
+
+
+def selected_backend():
+    """
+    :return: String - Module which is (or once loaded will be) the pjsua implementation, found without loading it
+    """
+    if _backend is not None:
+        return _backend.__name__
+    return _module_name(os.environ.get(ENVIRONMENT_VARIABLE, "pjsua"))
+
+
+def get_backend():
+    """
+    :return: Module - The pjsua implementation in use (loaded on first use)
+    """
+    if _backend is None:
+        use_backend(os.environ.get(ENVIRONMENT_VARIABLE, "pjsua"))
+    return _backend
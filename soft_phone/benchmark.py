@@ -0,0 +1,280 @@
+"""
+Benchmarks of the soft_phone control paths, run against the simulated pjsua backend (soft_phone.fake_pjsua)
+
+    python -m soft_phone.benchmark --phones 500 --calls 200
+
+Measures how long a fresh process takes to get from 'import soft_phone' to its first connected call, how quickly the
+blocking and asyncio waits wake once a pjsua callback has published a state change, the CPU used by idle registered
+phones, how long a process takes to register a pool of phones and carry a batch of concurrent calls, and the CPU
+used per concurrent call under each media profile.
+As no audio flows, the numbers cover the Python control code only, so they are for catching regressions rather than
+for sizing a real deployment. Run with SOFT_PHONE_BACKEND=pjsua (and a PBX answering the 'pbx' accounts) to measure
+the real media cost of each profile.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from soft_phone import backend
+
+backend.use_backend(os.environ.get(backend.ENVIRONMENT_VARIABLE, "fake"))
+
+from soft_phone.async_soft_phone import AsyncSoftPhone  # noqa: E402 (the backend must be chosen first)
+from soft_phone.config import MEDIA_PROFILES  # noqa: E402
+from soft_phone.manage_pjsip import PJSipClient  # noqa: E402
+from soft_phone.pool import SoftPhonePool  # noqa: E402
+from soft_phone.soft_phone import SoftPhone  # noqa: E402
+
+EXTERNAL_NUMBER = "900"  # not registered with the library, so the simulated PBX answers it
+
+
+def _summarise(samples):
+    """
+    :param samples: List - Durations in seconds
+    :return: Dict - Count, mean, p50, p99 and max in milliseconds
+    """
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0}
+
+    def percentile(percent):
+        return samples[max(0, int(math.ceil(percent / 100.0 * len(samples))) - 1)] * 1000
+
+    return {"count": len(samples), "mean_ms": sum(samples) / len(samples) * 1000, "p50_ms": percentile(50),
+            "p99_ms": percentile(99), "max_ms": samples[-1] * 1000}
+
+
+# Run in a fresh interpreter by 'startup', printing the seconds from its start at which each stage finished
+_STARTUP_SCRIPT = """
+import json, time
+started = time.perf_counter()
+timings = {}
+import soft_phone
+timings["import_package"] = time.perf_counter() - started
+from soft_phone.backend import get_backend
+if get_backend().__name__ == "soft_phone.fake_pjsua":
+    get_backend().configure(registration_delay=0.001, ring_delay=0.002, answer_delay=0.002)
+client = soft_phone.PJSipClient(log_file=None)
+timings["init"] = time.perf_counter() - started
+client.start()
+timings["start"] = time.perf_counter() - started
+phone = soft_phone.SoftPhone(client, "pbx", "startup", "password")
+phone.register_soft_phone()
+timings["register"] = time.perf_counter() - started
+phone_call = phone.make_call(%r)
+timings["first_call"] = time.perf_counter() - started
+phone.hang_up(phone_call)
+phone.wait_for_existing_call_to_end(call=phone_call)
+phone.unregister_soft_phone()
+restarted = time.perf_counter()
+client.stop()
+client.start()
+timings["restart"] = time.perf_counter() - restarted
+client.stop()
+print(json.dumps(timings))
+"""
+
+
+def startup(samples=5):
+    """
+    Time to first call: how long a fresh process takes to import soft_phone, initialise and start PJSIP, register a
+    phone and connect its first call, and how long stopping and restarting the client takes
+    :param samples: Int - Number of processes to time
+    :return: Dict - Summaries of the seconds from the start of the process at which each stage finished (restart on
+             its own), and of the whole process' wall clock time including the interpreter starting up
+    """
+    environment = dict(os.environ, **{backend.ENVIRONMENT_VARIABLE: backend.get_backend().__name__})
+    stages, processes = {}, []
+    for _ in range(samples):
+        started = time.monotonic()
+        output = subprocess.run([sys.executable, "-c", _STARTUP_SCRIPT % EXTERNAL_NUMBER], env=environment,
+                                stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        processes.append(time.monotonic() - started)
+        for stage, seconds in json.loads(output.strip().splitlines()[-1]).items():
+            stages.setdefault(stage, []).append(seconds)
+    results = {stage: _summarise(seconds) for stage, seconds in stages.items()}
+    results["process"] = _summarise(processes)
+    return results
+
+
+def wake_up_latency(pjsip_client, samples=200):
+    """
+    Time from a call's CONFIRMED/DISCONNECTED callback to the waiting make_call/wait_for_existing_call_to_end
+    returning, with SoftPhone and with AsyncSoftPhone
+    :param pjsip_client: Started PJSipClient
+    :param samples: Int - Number of calls to make with each
+    :return: Dict - Latency summaries
+    """
+    phone = SoftPhone(pjsip_client, "pbx", "wake-up", "password")
+    phone.register_soft_phone()
+    connected, ended = [], []
+    for _ in range(samples):
+        phone_call = phone.make_call(EXTERNAL_NUMBER)
+        connected.append(time.monotonic() - phone_call.connected_at)
+        phone.hang_up(phone_call)
+        phone.wait_for_existing_call_to_end(call=phone_call)
+        ended.append(time.monotonic() - phone_call.call_state.ended_at)
+    phone.unregister_soft_phone()
+
+    async_phone = AsyncSoftPhone(pjsip_client, "pbx", "async-wake-up", "password")
+    async_connected, async_ended = [], []
+
+    async def run():
+        await async_phone.register()
+        for _ in range(samples):
+            phone_call = await async_phone.make_call(EXTERNAL_NUMBER)
+            async_connected.append(time.monotonic() - phone_call.connected_at)
+            await async_phone.hang_up(call=phone_call)
+            async_ended.append(time.monotonic() - phone_call.call_state.ended_at)
+        await async_phone.unregister()
+
+    event_loop = asyncio.new_event_loop()
+    try:
+        event_loop.run_until_complete(run())
+    finally:
+        event_loop.close()
+    return {"make_call": _summarise(connected), "wait_for_existing_call_to_end": _summarise(ended),
+            "async_make_call": _summarise(async_connected), "async_hang_up": _summarise(async_ended)}
+
+
+def idle_cpu(pjsip_client, phones=500, seconds=5.0):
+    """
+    CPU used by the process whilst a pool of phones sits registered and idle
+    :param pjsip_client: Started PJSipClient
+    :param phones: Int - Number of phones to register
+    :param seconds: Float - How long to measure for
+    :return: Dict - CPU seconds used per wall clock second, in total and per phone
+    """
+    pool = SoftPhonePool(pjsip_client, "pbx", ("idle-{}".format(index) for index in range(phones)), "password")
+    pool.register_all()
+    cpu_started, wall_started = time.process_time(), time.monotonic()
+    time.sleep(seconds)
+    cpu_per_second = (time.process_time() - cpu_started) / (time.monotonic() - wall_started)
+    pool.unregister_all()
+    return {"phones": phones, "cpu_per_second": cpu_per_second, "cpu_per_second_per_phone": cpu_per_second / phones}
+
+
+def capacity(pjsip_client, phones=500, calls=200, hold_time=1.0):
+    """
+    Register a pool of phones, then make a batch of concurrent calls from it and hang them all up
+    :param pjsip_client: Started PJSipClient (its 'max_calls' must allow 'calls')
+    :param phones: Int - Number of phones to register
+    :param calls: Int - Number of calls to have in progress at once, spread over the phones
+    :param hold_time: Float - Seconds to hold the calls once they have all been set up
+    :return: Dict - Timings of each stage and the call setup times
+    """
+    pool = SoftPhonePool(pjsip_client, "pbx", ("capacity-{}".format(index) for index in range(phones)), "password",
+                         max_in_flight=100)
+    started = time.monotonic()
+    results = pool.register_all(time_out=max(30, phones / 10.0))
+    registration_seconds = time.monotonic() - started
+    registered = pool.registered_phones
+    if not registered:
+        raise RuntimeError("None of the phones registered")
+
+    started = time.monotonic()
+    phone_calls = [registered[index % len(registered)]._start_call(EXTERNAL_NUMBER) for index in range(calls)]
+    for phone_call in phone_calls:
+        phone_call.sip_phone._wait_for_state(phone_call.setup_finished, 30)
+    setup_seconds = time.monotonic() - started
+    answered = [phone_call for phone_call in phone_calls if phone_call.is_connected()]
+    time.sleep(hold_time)
+
+    started = time.monotonic()
+    for phone_call in answered:
+        phone_call.sip_phone.hang_up(phone_call)
+    for phone_call in answered:
+        phone_call.sip_phone._wait_for_state(phone_call.has_ended, 30)
+    teardown_seconds = time.monotonic() - started
+    pool.unregister_all()
+    return {"phones": phones, "registered": sum(1 for result in results.values() if result.reg_status == 200),
+            "registration_seconds": registration_seconds, "calls": calls, "answered": len(answered),
+            "setup_seconds": setup_seconds, "teardown_seconds": teardown_seconds,
+            "setup_time": _summarise([phone_call.connected_at - phone_call.call_state.started_at
+                                      for phone_call in answered])}
+
+
+def media_profiles(profiles=None, calls=50, seconds=5.0):
+    """
+    CPU used whilst a batch of calls between two phones of the process are held, playing audio on the answering
+    end, under each media profile (each with its own PJSipClient, so no other client may be running)
+    :param profiles: List - Names of the MEDIA_PROFILES to measure (defaults to all of them)
+    :param calls: Int - Number of calls to hold at once, each has two ends in the process
+    :param seconds: Float - How long to measure for once the calls are set up
+    :return: Dict - By profile, the codecs offered and the CPU seconds used per wall clock second, in total and per
+             concurrent call
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        audio_file = os.path.join(directory, "silence.wav")
+        with wave.open(audio_file, "wb") as wav_file:
+            wav_file.setparams((1, 2, 8000, 0, "NONE", "not compressed"))
+            wav_file.writeframes(b"\0\0" * 8000)
+        for profile in profiles or sorted(MEDIA_PROFILES):
+            pjsip_client = PJSipClient(max_calls=calls * 2 + 2, max_media_ports=calls * 4 + 16, log_file=None,
+                                       media_profile=profile)
+            pjsip_client.start()
+            try:
+                caller = SoftPhone(pjsip_client, "pbx", "profile-caller", "password")
+                callee = SoftPhone(pjsip_client, "pbx", "profile-callee", "password", answer_audio=audio_file)
+                caller.register_soft_phone()
+                callee.register_soft_phone()
+                phone_calls = [caller._start_call(callee.pbx_account_name) for _ in range(calls)]
+                for phone_call in phone_calls:
+                    caller._wait_for_state(phone_call.setup_finished, 30)
+                answered = sum(1 for phone_call in phone_calls if phone_call.is_connected())
+                cpu_started, wall_started = time.process_time(), time.monotonic()
+                time.sleep(seconds)
+                cpu_per_second = (time.process_time() - cpu_started) / (time.monotonic() - wall_started)
+                caller.hang_up_all_calls()
+                caller._wait_for_state(lambda: not caller.calls, 30)
+                caller.unregister_soft_phone()
+                callee.unregister_soft_phone()
+                results[profile] = {"codecs": pjsip_client.codecs, "calls": answered, "cpu_per_second": cpu_per_second,
+                                    "cpu_per_second_per_call": cpu_per_second / answered if answered else None}
+            finally:
+                pjsip_client.stop()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--phones", type=int, default=500, help="phones to register for the idle and capacity runs")
+    parser.add_argument("--calls", type=int, default=200, help="concurrent calls for the capacity run")
+    parser.add_argument("--samples", type=int, default=200, help="calls to make for the wake-up latency run")
+    parser.add_argument("--idle-seconds", type=float, default=5.0, help="length of the idle CPU measurement")
+    parser.add_argument("--startup-samples", type=int, default=5, help="processes to time for the startup run")
+    parser.add_argument("--profile-calls", type=int, default=50, help="concurrent calls for the media profile run")
+    parser.add_argument("--profile-seconds", type=float, default=5.0, help="length of each media profile measurement")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    if backend.get_backend().__name__ == backend.BACKENDS["fake"]:
+        backend.get_backend().configure(registration_delay=0.001, ring_delay=0.002, answer_delay=0.002)
+    results = {"startup": startup(args.startup_samples)}  # before this process starts its own client
+    results["media_profiles"] = media_profiles(calls=args.profile_calls, seconds=args.profile_seconds)
+    pjsip_client = PJSipClient(max_calls=args.calls + 1, max_media_ports=args.calls * 2 + 16, log_file=None)
+    pjsip_client.start()
+    try:
+        results.update({"wake_up_latency": wake_up_latency(pjsip_client, args.samples),
+                        "idle_cpu": idle_cpu(pjsip_client, args.phones, args.idle_seconds),
+                        "capacity": capacity(pjsip_client, args.phones, args.calls)})
+    finally:
+        pjsip_client.stop()
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for benchmark, result in results.items():
+            print(benchmark)
+            for name, value in result.items():
+                print("  {}: {}".format(name, value))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,137 @@
-import pjsua as pj
+from soft_phone.backend import get_backend
 import logging
+import threading
 import time
+from collections import deque
+from soft_phone.dispositions import as_disposition
+
+pj = get_backend()
 
 logger = logging.getLogger(__name__)
-logging.addLevelName(5, "TRACE")
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
+
+def python_log_level(pjsip_level):
+    """
+    Map a PJSIP log level (0 fatal, 1 error, 2 warning, 3 info, 4 debug, 5+ trace) onto a Python logging level
+    :param pjsip_level: Int - PJSIP log level
+    :return: Int - Python logging level
+    """
+    if pjsip_level <= 1:
+        return logging.ERROR
+    if pjsip_level == 2:
+        return logging.WARNING
+    if pjsip_level == 3:
+        return logging.DEBUG
+    return TRACE
+
+
+def pjsip_console_level():
+    """
+    The most verbose PJSIP level which 'log_cb' would actually log, given the current logging configuration
+    PJSIP does not hand more verbose lines to the callback at all, so they cost nothing.
+    :return: Int - PJSIP log level
+    """
+    for pjsip_level in (6, 3, 2):
+        if logger.isEnabledFor(python_log_level(pjsip_level)):
+            return pjsip_level
+    return 1
 
 
 def log_cb(level, msg, length_of_message):
     """
     Logging Callback
     """
-    if int(level) == 3:
-        logger.debug(msg)
-    elif int(level) == 4:
-        logger.log(5, msg)
-    else:
-        print(level, msg)
+    python_level = python_log_level(int(level))
+    if logger.isEnabledFor(python_level):
+        logger.log(python_level, msg.rstrip())
+
+
+class LogRingBuffer:
+    """
+    PJSIP logging callback which keeps the most recent lines in memory and only writes them to disk when asked
+    (PJSipClient does so when a call fails), so detailed PJSIP logging costs no disk I/O whilst calls succeed
+    """
+
+    def __init__(self, file_path, capacity=10000, callback=log_cb, callback_level=None):
+        """
+        :param file_path: String - File the buffered lines are appended to when flushed
+        :param capacity: Int - The maximum number of lines kept, the oldest are discarded first
+        :param callback: Callable - Logging callback every line up to 'callback_level' is also passed on to
+        :param callback_level: Int - Most verbose PJSIP level passed on to 'callback' (defaults to what 'log_cb'
+                               would log given the current logging configuration)
+        """
+        self.file_path = file_path
+        self.callback = callback
+        self.callback_level = pjsip_console_level() if callback_level is None else callback_level
+        self._lines = deque(maxlen=capacity)
+        self._flush_lock = threading.Lock()
+
+    def __call__(self, level, msg, length_of_message):
+        self._lines.append(msg)
+        if self.callback and level <= self.callback_level:
+            self.callback(level, msg, length_of_message)
+
+    def flush(self, reason=None):
+        """
+        Append the buffered lines to the file and empty the buffer
+        :param reason: String - Written to the file ahead of the lines, e.g. which call failed
+        """
+        with self._flush_lock, open(self.file_path, "a") as log_file:
+            log_file.write("==== {} ({}) ====\n".format(reason or "PJSIP log", time.strftime("%Y-%m-%d %H:%M:%S")))
+            while self._lines:
+                try:
+                    msg = self._lines.popleft()
+                except IndexError:
+                    break
+                log_file.write(msg if msg.endswith("\n") else msg + "\n")
 
 
 class CallCallback(pj.CallCallback):
     """
-    Callback to receive events from Call
+    Callback to receive events from Call and publish them to the Soft Phone which owns the Call
     """
 
-    def __init__(self, call=None):
+    def __init__(self, call=None, sip_phone=None, phone_call=None):
         pj.CallCallback.__init__(self, call)
+        self.sip_phone = sip_phone
+        self.phone_call = phone_call
+
+    def on_state(self):
+        """
+        The call state has changed (e.g. CALLING, EARLY, CONFIRMED, DISCONNECTED)
+        """
+        sip_phone = self.sip_phone
+        if sip_phone:
+            started = time.perf_counter()
+            sip_phone._on_call_state(self.phone_call, self.call.info())
+            if self.phone_call.has_ended():
+                # nothing more is published for the call, and the PhoneCall -> pjsua Call -> callback -> PhoneCall
+                # cycle is broken, so the handle is freed as soon as nothing else refers to it
+                self.sip_phone = self.phone_call = None
+            sip_phone.pjsip_client.callback_stats.observe("on_state", time.perf_counter() - started,
+                                                          sip_phone.pbx_account_name)
+
+    def on_media_state(self):
+        """
+        The call media state has changed (e.g. ACTIVE once audio is flowing)
+        """
+        if self.sip_phone:
+            started = time.perf_counter()
+            self.sip_phone._on_call_media_state(self.phone_call, self.call.info())
+            self.sip_phone.pjsip_client.callback_stats.observe("on_media_state", time.perf_counter() - started,
+                                                               self.sip_phone.pbx_account_name)
+
+    def on_dtmf_digit(self, digits):
+        """
+        DTMF digits have been received from the far end
+        """
+        if self.sip_phone:
+            started = time.perf_counter()
+            self.sip_phone._on_dtmf_digit(self.phone_call, digits)
+            self.sip_phone.pjsip_client.callback_stats.observe("on_dtmf_digit", time.perf_counter() - started,
+                                                               self.sip_phone.pbx_account_name)
 
 
 class IncomingCallCallback(pj.AccountCallback):
@@ -32,35 +139,35 @@ class IncomingCallCallback(pj.AccountCallback):
     Callback to answer incoming Calls
     """
 
-    def __init__(self, account, sip_phone, action_on_incoming_call, audio_playback_file=None, loop=True):
+    def __init__(self, account, sip_phone, action_on_incoming_call):
+        """
+        :param action_on_incoming_call: String or Disposition - How to respond to incoming calls (see as_disposition)
+        """
         pj.AccountCallback.__init__(self, account)
         self.action_on_incoming_call = action_on_incoming_call
+        self.disposition = as_disposition(action_on_incoming_call)
         self.sip_phone = sip_phone
-        self.audio_playback_file = audio_playback_file
-        self.loop = loop
+
+    def on_reg_state(self):
+        """
+        The registration status of the account has changed (registered, unregistered or failed)
+        """
+        started = time.perf_counter()
+        self.sip_phone._on_registration_state(self.account.info())
+        self.sip_phone.pjsip_client.callback_stats.observe("on_reg_state", time.perf_counter() - started,
+                                                           self.sip_phone.pbx_account_name)
 
     def on_incoming_call(self, call):
         """
         Receiver reaction dictates whether the call is to be answered or not
+        The disposition sends any ringing at once and schedules the rest, so the callback thread never waits.
         """
-        logger.debug("[{}] [INCOMING] Incoming call has been detected...".format(self.sip_phone.pbx_account_name))
-        self.sip_phone.call = call
-        if self.action_on_incoming_call.upper() == "ANSWER":  # ANSWERED
-            logger.debug("[{}] [INCOMING] The intended disposition of this call is 'answered', answering the incoming"
-                         " call...".format(self.sip_phone.pbx_account_name))
-            time.sleep(1)
-            call.answer()
-            logger.info("[{}] [INCOMING] Call answered".format(self.sip_phone.pbx_account_name))
-            if self.audio_playback_file:
-                self.sip_phone.start_audio_playback(self.audio_playback_file, self.loop)
-
-        elif self.action_on_incoming_call.upper() == "BUSY":  # destination number rejects the call before it is answered
-            logger.debug("[{}] [INCOMING] The intended disposition of this call is 'busy', rejecting the incoming "
-                         "call...".format(self.sip_phone.pbx_account_name))
-            # https://en.wikipedia.org/wiki/List_of_SIP_response_codes
-            call.answer(486)  # busy status
-            logger.info("[{}] [INCOMING] The intended disposition of this call is 'busy' - busy tone was "
-                        "returned".format(self.sip_phone.pbx_account_name))
-        else:
-            raise ValueError("'{}' is not a valid value for 'action_on_incoming_call'".format(
-                self.action_on_incoming_call))
+        started = time.perf_counter()
+        logger.debug("[%s] [INCOMING] Incoming call has been detected...", self.sip_phone.pbx_account_name)
+        phone_call = self.sip_phone._on_incoming_call(call)
+        disposition = self.disposition.choose()
+        logger.debug("[%s] [INCOMING] The intended disposition of this call is %r", self.sip_phone.pbx_account_name,
+                     disposition)
+        disposition.apply(self.sip_phone, phone_call)
+        self.sip_phone.pjsip_client.callback_stats.observe("on_incoming_call", time.perf_counter() - started,
+                                                           self.sip_phone.pbx_account_name)
@@ -0,0 +1,396 @@
+import abc
+import csv
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from soft_phone.media_stats import MEDIA_STATS_FIELDS
+
+logger = logging.getLogger(__name__)
+
+CDR_FIELDS = ("call_id", "account", "direction", "caller", "callee", "started_at", "connected_at", "ended_at",
+              "last_code", "call_time", "total_time", "dtmf_sent", "dtmf_received",
+              "audio_played") + MEDIA_STATS_FIELDS
+
+
+def _iso_time(timestamp):
+    """
+    :param timestamp: Float - Seconds since the epoch (or None)
+    :return: String - ISO 8601 UTC time with milliseconds (or None)
+    """
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec="milliseconds")
+
+
+def _sip_user(uri):
+    """
+    :param uri: String - e.g. '"Alice" <sip:100@10.0.0.1>'
+    :return: String - The user part of the URI, e.g. "100" (the URI itself if it has none)
+    """
+    if not uri:
+        return uri
+    start = uri.find("sip:")
+    if start < 0:
+        return uri
+    user = uri[start + 4:].split("@", 1)[0]
+    return user.rstrip(">")
+
+
+class CallDetailRecord:
+    """
+    Compact record of a call which has ended
+
+    Only plain values are copied out of the PhoneCall, so a record waiting to be written keeps nothing of pjsua's
+    alive. The timestamps are wall clock times, converted from the call's monotonic timestamps.
+    """
+    __slots__ = CDR_FIELDS
+
+    def __init__(self, phone_call):
+        """
+        :param phone_call: PhoneCall - The call (which has ended)
+        """
+        call_state = phone_call.call_state
+        wall_clock_offset = time.time() - time.monotonic()
+        account = phone_call.sip_phone.pbx_account_name
+        self.call_id = phone_call.call_id
+        self.account = account
+        self.direction = phone_call.direction
+        if phone_call.direction == "outgoing":
+            self.caller, self.callee = account, phone_call.number_dialled
+        else:
+            self.caller, self.callee = _sip_user(phone_call.remote_uri), account
+        self.started_at = call_state.started_at + wall_clock_offset
+        self.connected_at = call_state.connected_at + wall_clock_offset if call_state.connected_at else None
+        self.ended_at = call_state.ended_at + wall_clock_offset if call_state.ended_at else None
+        self.last_code = call_state.last_code
+        # the same whole seconds SoftPhone.get_call_length returns
+        self.call_time = int(call_state.connected_duration())
+        self.total_time = int(call_state.total_duration())
+        self.dtmf_sent = phone_call.dtmf_sent
+        self.dtmf_received = phone_call.dtmf.received_digits
+        self.audio_played = tuple(phone_call.audio_played)
+        media_stats = phone_call.media_stats.as_dict() if phone_call.media_stats else {}
+        for name in MEDIA_STATS_FIELDS:  # None unless the PJSipClient collected media statistics
+            setattr(self, name, media_stats.get(name))
+
+    def __repr__(self):
+        return "<CallDetailRecord {} {} {} -> {} last_code={}>".format(self.call_id, self.direction, self.caller,
+                                                                        self.callee, self.last_code)
+
+    def as_row(self):
+        """
+        :return: Tuple - The fields in the order of CDR_FIELDS, with the times as ISO 8601 strings and the audio
+                 files joined by ';'
+        """
+        return (self.call_id, self.account, self.direction, self.caller, self.callee, _iso_time(self.started_at),
+                _iso_time(self.connected_at), _iso_time(self.ended_at), self.last_code, self.call_time,
+                self.total_time, self.dtmf_sent, self.dtmf_received, ";".join(self.audio_played)) + tuple(
+                    getattr(self, name) for name in MEDIA_STATS_FIELDS)
+
+    def as_dict(self):
+        """
+        :return: Dict - The fields by name, with the times as ISO 8601 strings
+        """
+        record = dict(zip(CDR_FIELDS, self.as_row()))
+        record["audio_played"] = list(self.audio_played)
+        return record
+
+
+class RotatingSink(abc.ABC):
+    """
+    Append-only file of call detail records, rotated once it reaches 'max_bytes'
+
+    Rotation renames the file to '<path>.1' (and any older ones to '<path>.2' and so on, deleting those beyond
+    'backup_count') then starts a new one, like logging's RotatingFileHandler. Subclasses implement opening,
+    closing, writing and flushing the file.
+    """
+
+    def __init__(self, path, max_bytes=0, backup_count=5):
+        """
+        :param path: String - Path of the file
+        :param max_bytes: Int - Size at which the file is rotated (0 to never rotate)
+        :param backup_count: Int - Number of rotated files to keep
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._open()
+
+    @abc.abstractmethod
+    def _open(self):
+        """
+        Open (or create) the file at 'path'
+        """
+
+    @abc.abstractmethod
+    def close(self):
+        """
+        Close the file
+        """
+
+    @abc.abstractmethod
+    def write(self, records):
+        """
+        Append a batch of records
+        :param records: List - CallDetailRecords
+        """
+
+    @abc.abstractmethod
+    def flush(self, fsync=False):
+        """
+        Hand the records written so far to the operating system
+        :param fsync: Boolean - Also wait for them to reach the disk
+        """
+
+    def size(self):
+        """
+        :return: Int - Bytes in the current file
+        """
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def rotate_if_needed(self):
+        """
+        Rotate the file if it has reached 'max_bytes'
+        """
+        if not self.max_bytes or self.size() < self.max_bytes:
+            return
+        self.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            older = "{}.{}".format(self.path, index)
+            if os.path.exists(older):
+                os.replace(older, "{}.{}".format(self.path, index + 1))
+        if self.backup_count > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        logger.info("Rotated the call detail records in %s", self.path)
+        self._open()
+
+
+class JsonLinesSink(RotatingSink):
+    """
+    Call detail records as one JSON object per line
+    """
+
+    def _open(self):
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def close(self):
+        self._file.close()
+
+    def write(self, records):
+        self._file.write("".join(json.dumps(record.as_dict(), separators=(",", ":")) + "\n" for record in records))
+
+    def flush(self, fsync=False):
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+
+
+class CsvSink(RotatingSink):
+    """
+    Call detail records as CSV, each file starting with a header row
+    """
+
+    def _open(self):
+        new_file = self.size() == 0
+        self._file = open(self.path, "a", encoding="utf-8", newline="")
+        self._writer = csv.writer(self._file)
+        if new_file:
+            self._writer.writerow(CDR_FIELDS)
+
+    def close(self):
+        self._file.close()
+
+    def write(self, records):
+        self._writer.writerows(record.as_row() for record in records)
+
+    def flush(self, fsync=False):
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+
+
+_SQLITE_INSERT = "INSERT INTO cdr ({}) VALUES ({})".format(", ".join(CDR_FIELDS), ", ".join("?" * len(CDR_FIELDS)))
+
+
+class SqliteSink(RotatingSink):
+    """
+    Call detail records in the 'cdr' table of a SQLite database, each batch inserted in one transaction
+    """
+
+    def __init__(self, path, max_bytes=0, backup_count=5, synchronous="NORMAL"):
+        """
+        :param synchronous: String - SQLite 'synchronous' setting, "NORMAL" (with the WAL journal) only syncs at
+                            checkpoints, "FULL" syncs every batch
+        """
+        self.synchronous = synchronous
+        RotatingSink.__init__(self, path, max_bytes, backup_count)
+
+    def _open(self):
+        # only ever used by the writer's thread, though it is created on the caller's
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous={}".format(self.synchronous))
+        self._connection.execute("CREATE TABLE IF NOT EXISTS cdr ({})".format(", ".join(CDR_FIELDS)))
+        # a database written by an earlier version lacks the newer fields, they are added (empty for old records)
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(cdr)")}
+        for name in CDR_FIELDS:
+            if name not in columns:
+                self._connection.execute("ALTER TABLE cdr ADD COLUMN {}".format(name))
+                logger.info("Added the column '%s' to the call detail records in %s", name, self.path)
+        self._connection.commit()
+
+    def close(self):
+        self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._connection.close()
+
+    def write(self, records):
+        with self._connection:
+            self._connection.executemany(_SQLITE_INSERT, (record.as_row() for record in records))
+
+    def flush(self, fsync=False):
+        if fsync:
+            self._connection.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+
+SINKS = {
+    "jsonl": JsonLinesSink,
+    "csv": CsvSink,
+    "sqlite": SqliteSink,
+}
+
+
+class CDRWriter:
+    """
+    Writes a call detail record for every call which ends, from a background thread
+
+    Records wait on a bounded queue and are written in batches, so memory stays flat however many calls are made and
+    the pjsua callback thread only has to copy a few fields. Pass it to PJSipClient as 'cdr_writer'.
+    """
+
+    def __init__(self, path, format="jsonl", max_bytes=100 * 1024 * 1024, backup_count=5, batch_size=500,
+                 flush_interval=1.0, fsync_interval=10.0, max_queue_size=100000, block_when_full=False, sink=None):
+        """
+        :param path: String - File to append the records to
+        :param format: String - "jsonl", "csv" or "sqlite"
+        :param max_bytes: Int - Size at which the file is rotated (0 to never rotate)
+        :param backup_count: Int - Number of rotated files to keep
+        :param batch_size: Int - The most records written at once
+        :param flush_interval: Float - The most seconds a record waits before it is written
+        :param fsync_interval: Float - Seconds between syncs of the file to disk (None to leave it to the OS)
+        :param max_queue_size: Int - The most records waiting to be written
+        :param block_when_full: Boolean - Make the pjsua callback wait for room when the queue is full, rather than
+                                drop the record (which is counted and logged)
+        :param sink: RotatingSink - Write to this instead of creating one from 'path' and 'format'
+        """
+        if sink is None:
+            try:
+                sink = SINKS[format](path, max_bytes, backup_count)
+            except KeyError:
+                raise ValueError("'{}' is not a valid CDR format, use one of {}".format(format, ", ".join(SINKS)))
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.block_when_full = block_when_full
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._dropped_lock = threading.Lock()  # records are dropped on any of the pjsua callback threads
+        self._queue = queue.Queue(max_queue_size)
+        self._thread = threading.Thread(target=self._run, name="soft-phone-cdr", daemon=True)
+        self._thread.start()
+
+    def submit(self, phone_call):
+        """
+        Queue the record of a call which has ended (called from the pjsua callback thread)
+        :param phone_call: PhoneCall - The call
+        """
+        self.submit_record(CallDetailRecord(phone_call))
+
+    def submit_record(self, record):
+        """
+        Queue a record to be written
+        :param record: CallDetailRecord - The record
+        """
+        try:
+            self._queue.put(record, block=self.block_when_full)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+                dropped = self.dropped
+            if dropped == 1 or dropped % 1000 == 0:
+                logger.warning("[%s] The CDR queue is full, %s records have been dropped", record.account, dropped)
+
+    def stats(self):
+        """
+        :return: Dict - Records written, dropped (queue full) and lost to write errors, and the number waiting
+        """
+        return {"written": self.written, "dropped": self.dropped, "failed": self.failed,
+                "queued": self._queue.qsize()}
+
+    def close(self):
+        """
+        Write the records still queued, sync the file and stop the writer thread
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self.sink.close()
+
+    def _run(self):
+        last_fsync = time.monotonic()
+        while True:
+            batch, stopping = self._next_batch()
+            now = time.monotonic()
+            fsync = stopping or (self.fsync_interval is not None and now - last_fsync >= self.fsync_interval)
+            if batch or fsync:
+                self._write(batch, fsync)
+                if fsync:
+                    last_fsync = now
+            if stopping:
+                return
+
+    def _next_batch(self):
+        """
+        Wait up to 'flush_interval' for records, then take as many as are waiting (up to 'batch_size')
+        :return: Tuple (List - CallDetailRecords, Boolean - the writer has been closed)
+        """
+        batch = []
+        try:
+            record = self._queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return batch, False
+        while record is not None:
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                return batch, False
+            try:
+                record = self._queue.get_nowait()
+            except queue.Empty:
+                return batch, False
+        return batch, True
+
+    def _write(self, batch, fsync):
+        """
+        Write a batch of records, rotating the file first if need be
+        :param batch: List - CallDetailRecords
+        :param fsync: Boolean - Sync the file to disk afterwards
+        """
+        try:
+            if batch:
+                self.sink.rotate_if_needed()
+                self.sink.write(batch)
+                self.written += len(batch)
+            self.sink.flush(fsync)
+        except Exception:
+            self.failed += len(batch)
+            logger.exception("Failed to write %s call detail records to %s", len(batch), self.sink.path)
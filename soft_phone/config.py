@@ -0,0 +1,161 @@
+class TransportSettings:
+    """
+    A SIP transport for PJSipClient to create
+    """
+
+    def __init__(self, type="udp", port=0, port_range=None, bound_address="", public_address=""):
+        """
+        :param type: String - "udp" or "tcp"
+        :param port: Int - Local port to listen on (0 for any free port)
+        :param port_range: Tuple - (first, last) local ports, the first which is free is used (overrides 'port')
+        :param bound_address: String - Local address to bind to (defaults to every address)
+        :param public_address: String - Address to advertise in the SIP messages (e.g. when behind NAT)
+        """
+        if type.lower() not in ("udp", "tcp"):
+            raise ValueError("Transport type must be 'udp' or 'tcp', not '{}'".format(type))
+        self.type = type.lower()
+        self.port = port
+        self.port_range = tuple(port_range) if port_range else None
+        self.bound_address = bound_address
+        self.public_address = public_address
+
+    def __repr__(self):
+        return "<TransportSettings {} {}:{}>".format(self.type, self.bound_address or "*",
+                                                    "{}-{}".format(*self.port_range) if self.port_range else self.port)
+
+    def ports(self):
+        """
+        :return: List - The local ports to try, in order
+        """
+        if self.port_range:
+            first, last = self.port_range
+            return list(range(first, last + 1))
+        return [self.port]
+
+    def with_port_range(self, first, last):
+        """
+        :return: TransportSettings - A copy of these settings using a different port range
+        """
+        return TransportSettings(self.type, port_range=(first, last), bound_address=self.bound_address,
+                                 public_address=self.public_address)
+
+
+class PJSipConfig:
+    """
+    Transport and threading configuration for PJSipClient
+    """
+
+    def __init__(self, transports=None, sip_threads=1, media_threads=None, clock_rate=None,
+                 receive_buffer_size=None):
+        """
+        :param transports: List - TransportSettings of each transport to create (defaults to one UDP transport on any
+                           free port), spreading the phones over several lets each use its own socket
+        :param sip_threads: Int - Number of pjsua worker threads polling the SIP sockets and running the callbacks
+        :param media_threads: Int - Number of media threads (only applied if the pjsua build exposes the setting)
+        :param clock_rate: Int - Conference bridge clock rate in Hz (e.g. 8000 to match G.711 and save resampling)
+        :param receive_buffer_size: Int - Bytes of socket receive buffer the SIP sockets should have, pjsua can't set
+                                    it per socket so the operating system's default is checked against it instead
+        """
+        self.transports = list(transports) if transports else [TransportSettings()]
+        self.sip_threads = sip_threads
+        self.media_threads = media_threads
+        self.clock_rate = clock_rate
+        self.receive_buffer_size = receive_buffer_size
+
+    def with_port_ranges(self, first_port, ports_per_transport):
+        """
+        :param first_port: Int - First port of the first transport
+        :param ports_per_transport: Int - Number of ports in each transport's range
+        :return: PJSipConfig - A copy of this configuration whose transports use consecutive port ranges
+        """
+        transports = [settings.with_port_range(first_port + index * ports_per_transport,
+                                               first_port + (index + 1) * ports_per_transport - 1)
+                      for index, settings in enumerate(self.transports)]
+        return PJSipConfig(transports, self.sip_threads, self.media_threads, self.clock_rate,
+                           self.receive_buffer_size)
+
+
+class MediaProfile:
+    """
+    Media settings for PJSipClient, trading audio fidelity for CPU per call
+
+    Anything left as None keeps pjsua's default. A signalling-only profile also leaves the media of every call
+    alone: no audio is played or recorded and no media statistics are collected, for measuring call setup
+    throughput on its own (pjsua still negotiates a codec and gives each call a conference port).
+    """
+
+    def __init__(self, codecs=None, ptime=None, vad=None, echo_canceller=None, clock_rate=None,
+                 conference_ports=None, quality=None, audio_frame_ptime=None, signalling_only=False):
+        """
+        :param codecs: Tuple - Names of the codecs to offer, most preferred first (e.g. ("PCMU", "PCMA")), every
+                       other codec is disabled (None to keep pjsua's codec priorities)
+        :param ptime: Int - Milliseconds of audio in each RTP packet
+        :param vad: Boolean - Voice activity detection (silence suppression)
+        :param echo_canceller: Boolean - Echo cancellation (False sets its tail length to 0)
+        :param clock_rate: Int - Conference bridge clock rate in Hz, matching the codecs' saves resampling
+        :param conference_ports: Int - Size of the conference bridge (unless PJSipClient's 'max_media_ports' is set)
+        :param quality: Int - Media quality 1 (cheapest) to 10, for resampling and echo cancellation
+        :param audio_frame_ptime: Int - Milliseconds of audio the conference bridge mixes at a time
+        :param signalling_only: Boolean - Don't play, record or sample the media of any call
+        """
+        self.codecs = tuple(codecs) if codecs else None
+        self.ptime = ptime
+        self.vad = vad
+        self.echo_canceller = echo_canceller
+        self.clock_rate = clock_rate
+        self.conference_ports = conference_ports
+        self.quality = quality
+        self.audio_frame_ptime = audio_frame_ptime
+        self.signalling_only = signalling_only
+
+    def __repr__(self):
+        return "<MediaProfile codecs={} clock_rate={} signalling_only={}>".format(self.codecs, self.clock_rate,
+                                                                                 self.signalling_only)
+
+    def apply_media_config(self, media_cfg):
+        """
+        Set the profile's settings on a pjsua MediaConfig, before the library is initialised with it
+        :param media_cfg: pjsua MediaConfig - The configuration
+        """
+        if self.ptime is not None:
+            media_cfg.ptime = self.ptime
+        if self.vad is not None:
+            media_cfg.no_vad = not self.vad
+        if self.echo_canceller is False:
+            media_cfg.ec_tail_len = 0
+        if self.clock_rate:
+            media_cfg.clock_rate = self.clock_rate
+        if self.conference_ports:
+            media_cfg.max_media_ports = self.conference_ports
+        if self.quality is not None:
+            media_cfg.quality = self.quality
+        if self.audio_frame_ptime:
+            media_cfg.audio_frame_ptime = self.audio_frame_ptime
+
+    def apply_codec_priorities(self, lib):
+        """
+        Give the profile's codecs descending priorities and disable the rest, once the library is initialised
+        :param lib: pjsua Lib - The library
+        :return: List - Codec IDs enabled (e.g. "PCMU/8000/1"), most preferred first
+        """
+        if not self.codecs:
+            return []
+        preference = {name.lower(): index for index, name in enumerate(self.codecs)}
+        enabled = []
+        for codec in lib.enum_codecs():
+            index = preference.get(codec.name.split("/")[0].lower())
+            lib.set_codec_priority(codec.name, 0 if index is None else 255 - index)
+            if index is not None:
+                enabled.append((index, codec.name))
+        return [name for _, name in sorted(enabled)]
+
+
+# Profiles PJSipClient's 'media_profile' can be given by name
+MEDIA_PROFILES = {
+    "default": MediaProfile(),
+    # G.711 at its own clock rate: no transcoding or resampling, and nothing spent on silence or echo
+    "low_cpu": MediaProfile(codecs=("PCMU", "PCMA"), ptime=20, vad=False, echo_canceller=False, clock_rate=8000,
+                            quality=1),
+    "signalling_only": MediaProfile(codecs=("PCMU", "PCMA"), ptime=20, vad=False, echo_canceller=False,
+                                    clock_rate=8000, quality=1, signalling_only=True),
+}
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from soft_phone.metrics import CALLBACK_BUCKETS, Histogram
+
+logger = logging.getLogger(__name__)
+
+
+class PhoneEvent:
+    """
+    A state change of a 'Soft Phone', captured on the pjsua callback thread for a handler to process later
+
+    The state is copied when the event is published, as by the time the handler runs the call may have moved on.
+    """
+    __slots__ = ("sip_phone", "phone_call", "state", "media_state", "last_code", "reg_status", "published_at")
+
+    def __init__(self, sip_phone, phone_call):
+        """
+        :param sip_phone: SoftPhone - The phone whose state changed
+        :param phone_call: PhoneCall - The call whose state changed (None for a change of registration status)
+        """
+        self.sip_phone = sip_phone
+        self.phone_call = phone_call
+        self.reg_status = sip_phone.reg_status
+        if phone_call is None:
+            self.state = self.media_state = self.last_code = None
+        else:
+            call_state = phone_call.call_state
+            self.state = call_state.state
+            self.media_state = call_state.media_state
+            self.last_code = call_state.last_code
+        self.published_at = time.monotonic()
+
+    def __repr__(self):
+        return "<PhoneEvent {} {} state={} media_state={} last_code={} reg_status={}>".format(
+            self.sip_phone.pbx_account_name, self.phone_call.call_id if self.phone_call else None, self.state,
+            self.media_state, self.last_code, self.reg_status)
+
+
+def _shard(key, shards):
+    """
+    :param key: Object - The call or phone whose events must stay in order
+    :param shards: Int - Number of shards
+    :return: Int - The shard of the key
+    """
+    # an object's hash follows its (aligned) address, so its low bits barely vary, Fibonacci hashing spreads them
+    return (((hash(key) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 32) % shards
+
+
+class EventDispatcher:
+    """
+    Deliver the state changes of 'Soft Phones' to a handler away from the pjsua callback thread
+
+    A slow handler run as a state listener holds up every SIP event of the process, so instead each event is put on
+    a bounded queue and the handler runs on a pool of worker threads (or on an asyncio event loop). Events for the
+    same call (or for the same phone's registration) always go to the same worker, so they are handled in order.
+    How far behind the handler is running is measured as the dispatch lag, alongside the queue depth.
+    """
+
+    def __init__(self, handler, workers=4, max_queue_size=10000, block_when_full=False, event_loop=None,
+                 name="soft-phone-dispatch"):
+        """
+        :param handler: Callable - Called with each PhoneEvent, on a worker thread (which may call into pjsua) or, with
+                        'event_loop', on the event loop (a coroutine function is scheduled as a task, so only the
+                        start of each one is in order)
+        :param workers: Int - Number of worker threads
+        :param max_queue_size: Int - The most events each worker may have waiting
+        :param block_when_full: Boolean - Make the pjsua callback wait for room when a queue is full, rather than
+                                drop the event (which is counted and logged)
+        :param event_loop: asyncio event loop - Run the handler on this loop instead of on worker threads
+        :param name: String - Prefix of the worker thread names
+        """
+        self.handler = handler
+        self.max_queue_size = max_queue_size
+        self.block_when_full = block_when_full
+        self.event_loop = event_loop
+        self._listeners = {}  # SoftPhone -> its state listener
+        self._stats_lock = threading.Lock()
+        self.dispatched = 0
+        self.dropped = 0
+        self.max_queue_depth = 0
+        self._loop_depth = 0  # events handed to the event loop which it has not handled yet
+        self.dispatch_lag = Histogram(CALLBACK_BUCKETS)
+        self.handler_duration = Histogram(CALLBACK_BUCKETS)
+        self._queues = []
+        self._threads = []
+        if event_loop is None:
+            for index in range(workers):
+                event_queue = queue.Queue(max_queue_size)
+                thread = threading.Thread(target=self._work, args=(event_queue,), name="{}-{}".format(name, index),
+                                          daemon=True)
+                thread.start()
+                self._queues.append(event_queue)
+                self._threads.append(thread)
+
+    def attach(self, sip_phone):
+        """
+        Start delivering a phone's state changes to the handler
+        :param sip_phone: SoftPhone - The phone
+        """
+        def listener(phone_call):
+            self._publish(PhoneEvent(sip_phone, phone_call))
+
+        self._listeners[sip_phone] = listener
+        sip_phone.add_state_listener(listener)
+
+    def detach(self, sip_phone):
+        """
+        Stop delivering a phone's state changes to the handler
+        :param sip_phone: SoftPhone - The phone
+        """
+        listener = self._listeners.pop(sip_phone, None)
+        if listener:
+            sip_phone.remove_state_listener(listener)
+
+    def queue_depth(self):
+        """
+        :return: Int - The number of events waiting to be handled
+        """
+        return sum(event_queue.qsize() for event_queue in self._queues) + self._loop_depth
+
+    def _publish(self, event):
+        """
+        Hand an event over for dispatch (runs on the pjsua callback thread, so it must not wait unless told to)
+        """
+        if self.event_loop is not None:
+            with self._stats_lock:
+                if self._loop_depth >= self.max_queue_size:
+                    self._drop(event)
+                    return
+                self._loop_depth += 1
+                self.max_queue_depth = max(self.max_queue_depth, self._loop_depth)
+            self.event_loop.call_soon_threadsafe(self._handle_on_loop, event)
+            return
+        # one worker per call (or per phone for registrations), so each one's events stay in order
+        key = event.phone_call if event.phone_call is not None else event.sip_phone
+        event_queue = self._queues[_shard(key, len(self._queues))]
+        try:
+            event_queue.put(event, block=self.block_when_full)
+        except queue.Full:
+            with self._stats_lock:
+                self._drop(event)
+            return
+        depth = event_queue.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+
+    def _drop(self, event):
+        """ Count a dropped event (the stats lock must be held) """
+        self.dropped += 1
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            logger.warning("[%s] Event dispatch queue is full, %s events have been dropped",
+                           event.sip_phone.pbx_account_name, self.dropped)
+
+    def _handle(self, event):
+        """ Run the handler for an event, recording how late it started and how long it took """
+        started = time.monotonic()
+        try:
+            result = self.handler(event)
+        except Exception:
+            logger.exception("[%s] Event handler failed for %r", event.sip_phone.pbx_account_name, event)
+            result = None
+        finished = time.monotonic()
+        with self._stats_lock:
+            self.dispatched += 1
+            self.dispatch_lag.observe(started - event.published_at)
+            self.handler_duration.observe(finished - started)
+        return result
+
+    def _work(self, event_queue):
+        """ Worker thread: handle the events of its queue in order """
+        while True:
+            event = event_queue.get()
+            if event is None:
+                return
+            event.sip_phone.pjsip_client.register_thread()
+            self._handle(event)
+
+    def _handle_on_loop(self, event):
+        with self._stats_lock:
+            self._loop_depth -= 1
+        result = self._handle(event)
+        if asyncio.iscoroutine(result):
+            self.event_loop.create_task(result)
+
+    def stats(self):
+        """
+        :return: Dict - Events dispatched and dropped, the current and highest queue depth, and how late (dispatch lag)
+                 and for how long the handler ran
+        """
+        with self._stats_lock:
+            return {"dispatched": self.dispatched, "dropped": self.dropped, "queue_depth": self.queue_depth(),
+                    "max_queue_depth": self.max_queue_depth, "dispatch_lag": self.dispatch_lag.snapshot(),
+                    "handler_duration": self.handler_duration.snapshot()}
+
+    def stop(self, wait=True):
+        """
+        Detach every phone and stop the worker threads, once they have handled the events already queued
+        :param wait: Boolean - Wait for the worker threads to finish
+        """
+        for sip_phone in list(self._listeners):
+            self.detach(sip_phone)
+        for event_queue in self._queues:
+            event_queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
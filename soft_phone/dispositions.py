@@ -0,0 +1,207 @@
+import abc
+import bisect
+import itertools
+import logging
+import random
+from soft_phone.exceptions import PhoneCallNotInProgress
+
+logger = logging.getLogger(__name__)
+
+
+def pick_delay(delay):
+    """
+    :param delay: Number or Tuple - Seconds, or a (minimum, maximum) range to pick a random number of seconds from
+    :return: Float - Seconds
+    """
+    if isinstance(delay, (tuple, list)):
+        return random.uniform(*delay)
+    return delay or 0
+
+
+class Disposition(abc.ABC):
+    """
+    How a 'Soft Phone' responds to an incoming call
+
+    'apply' runs on the pjsua callback thread, so it only sends what is due at once and leaves the rest to the
+    PJSipClient's timers, never sleeping. Subclasses must implement 'respond'.
+    """
+    name = None
+
+    def __init__(self, ring_delay=0, ringing_code=180):
+        """
+        :param ring_delay: Number or Tuple - Seconds to ring before the final response, or a (minimum, maximum) range
+                           to pick a random ring time from for each call
+        :param ringing_code: Int - Provisional response sent straight away (180 Ringing or 183 Session Progress),
+                             None to send none
+        """
+        self.ring_delay = ring_delay
+        self.ringing_code = ringing_code
+
+    def __repr__(self):
+        return "<{} ring_delay={}>".format(type(self).__name__, self.ring_delay)
+
+    def choose(self):
+        """
+        :return: Disposition - The disposition to apply to a particular call
+        """
+        return self
+
+    def apply(self, sip_phone, phone_call):
+        """
+        Respond to an incoming call: ring, then send the final response once the ring delay has passed
+        :param sip_phone: SoftPhone - The phone receiving the call
+        :param phone_call: PhoneCall - The incoming call
+        """
+        if self.ringing_code:
+            phone_call.call.answer(self.ringing_code)
+        ring_delay = pick_delay(self.ring_delay)
+        if ring_delay > 0:
+            sip_phone.pjsip_client.timers.schedule(ring_delay, self._respond_unless_ended, sip_phone, phone_call)
+        else:
+            self.respond(sip_phone, phone_call)
+
+    def _respond_unless_ended(self, sip_phone, phone_call):
+        if phone_call.has_ended():  # the caller gave up whilst it was ringing
+            logger.debug("[%s] [INCOMING] The call ended before it was %s", sip_phone.pbx_account_name, self.name)
+            return
+        self.respond(sip_phone, phone_call)
+
+    @abc.abstractmethod
+    def respond(self, sip_phone, phone_call):
+        """
+        Send the final response to the call
+        :param sip_phone: SoftPhone - The phone receiving the call
+        :param phone_call: PhoneCall - The incoming call
+        """
+
+
+class Answer(Disposition):
+    """
+    Answer the call (and play the phone's answer audio, if it has any)
+    """
+    name = "answered"
+
+    def __init__(self, ring_delay=1, ringing_code=180):
+        Disposition.__init__(self, ring_delay, ringing_code)
+
+    def respond(self, sip_phone, phone_call):
+        phone_call.call.answer(200)
+        logger.info("[%s] [INCOMING] Call answered", sip_phone.pbx_account_name)
+        if sip_phone.answer_audio:
+            try:
+                sip_phone.start_audio_playback(sip_phone.answer_audio, sip_phone.loop, call=phone_call)
+            except PhoneCallNotInProgress:
+                logger.debug("[%s] [INCOMING] The call ended before its audio could be played",
+                             sip_phone.pbx_account_name)
+
+
+class Decline(Disposition):
+    """
+    Reject the call with a SIP status code, e.g. 486 Busy Here or 603 Decline
+    """
+    name = "declined"
+
+    def __init__(self, code=603, ring_delay=0, ringing_code=None):
+        """
+        :param code: Int - Final SIP status code (300-699) to reject the call with
+        """
+        if not 300 <= code < 700:
+            raise ValueError("A call can only be declined with a 3xx-6xx status code, not {}".format(code))
+        Disposition.__init__(self, ring_delay, ringing_code)
+        self.code = code
+
+    def __repr__(self):
+        return "<{} code={} ring_delay={}>".format(type(self).__name__, self.code, self.ring_delay)
+
+    def respond(self, sip_phone, phone_call):
+        phone_call.call.answer(self.code)
+        logger.info("[%s] [INCOMING] Call declined with %s", sip_phone.pbx_account_name, self.code)
+
+
+class Busy(Decline):
+    """
+    Reject the call as busy (486 Busy Here)
+    """
+
+    def __init__(self, ring_delay=0, ringing_code=None):
+        Decline.__init__(self, 486, ring_delay, ringing_code)
+
+
+class NoAnswer(Disposition):
+    """
+    Let the call ring until the caller gives up, or until 'time_out' passes and it is rejected with 'code'
+    """
+    name = "timed out"
+
+    def __init__(self, time_out=None, code=480, ringing_code=180):
+        """
+        :param time_out: Number or Tuple - Seconds (or a range) to ring before rejecting the call, None to ring for
+                         as long as the caller (or the PBX) allows
+        :param code: Int - SIP status code the call is rejected with once 'time_out' passes (480 Temporarily
+                     Unavailable)
+        """
+        Disposition.__init__(self, time_out, ringing_code)
+        self.code = code
+
+    def apply(self, sip_phone, phone_call):
+        if self.ring_delay is None:
+            if self.ringing_code:
+                phone_call.call.answer(self.ringing_code)
+            return
+        Disposition.apply(self, sip_phone, phone_call)
+
+    def respond(self, sip_phone, phone_call):
+        phone_call.call.answer(self.code)
+        logger.info("[%s] [INCOMING] Call was not answered, rejected with %s", sip_phone.pbx_account_name, self.code)
+
+
+class WeightedMix(Disposition):
+    """
+    Pick one of several dispositions at random for each call, in proportion to their weights
+    e.g. WeightedMix([(80, Answer(ring_delay=(2, 8))), (15, NoAnswer()), (5, Busy())])
+    """
+
+    def __init__(self, weighted_dispositions):
+        """
+        :param weighted_dispositions: List - (weight, Disposition or action name) tuples
+        """
+        Disposition.__init__(self)
+        self.dispositions = [as_disposition(disposition) for _, disposition in weighted_dispositions]
+        self._cumulative_weights = list(itertools.accumulate(weight for weight, _ in weighted_dispositions))
+        if not self.dispositions or self._cumulative_weights[-1] <= 0:
+            raise ValueError("A WeightedMix needs at least one disposition with a positive weight")
+
+    def __repr__(self):
+        return "<WeightedMix {}>".format(self.dispositions)
+
+    def choose(self):
+        index = bisect.bisect_right(self._cumulative_weights, random.uniform(0, self._cumulative_weights[-1]))
+        return self.dispositions[min(index, len(self.dispositions) - 1)].choose()
+
+    def apply(self, sip_phone, phone_call):
+        self.choose().apply(sip_phone, phone_call)
+
+    def respond(self, sip_phone, phone_call):
+        self.choose().respond(sip_phone, phone_call)
+
+
+ACTIONS = {
+    "ANSWER": Answer,
+    "BUSY": Busy,
+    "DECLINE": Decline,
+    "NO_ANSWER": NoAnswer,
+}
+
+
+def as_disposition(action_on_incoming_call):
+    """
+    :param action_on_incoming_call: String or Disposition - A Disposition, or the name of one ("ANSWER", "BUSY",
+                                    "DECLINE" or "NO_ANSWER") to use with its defaults
+    :return: Disposition - The disposition
+    """
+    if isinstance(action_on_incoming_call, Disposition):
+        return action_on_incoming_call
+    try:
+        return ACTIONS[action_on_incoming_call.upper()]()
+    except (KeyError, AttributeError):
+        raise ValueError("'{}' is not a valid value for 'action_on_incoming_call'".format(action_on_incoming_call))
@@ -0,0 +1,337 @@
+import logging
+import re
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+DTMF_DIGITS = "0123456789*#ABCD"
+
+
+def _check_digits(digits):
+    """
+    :param digits: String - DTMF digits
+    :return: String - The digits, upper case
+    """
+    digits = digits.upper()
+    invalid = set(digits) - set(DTMF_DIGITS)
+    if invalid:
+        raise ValueError("Not DTMF digits: {}".format("".join(sorted(invalid))))
+    return digits
+
+
+def _as_pattern(pattern):
+    """
+    :param pattern: String or compiled regular expression - Digits to wait for, as a regular expression
+    :return: Compiled regular expression
+    """
+    return re.compile(pattern) if isinstance(pattern, str) else pattern
+
+
+class DTMFMatch:
+    """
+    Digits received on a call which matched a wait, with when each of them arrived
+    """
+    __slots__ = ("digits", "timings", "sent_at")
+
+    def __init__(self, digits, timings, sent_at):
+        """
+        :param digits: String - The digits which matched
+        :param timings: Tuple - (digit, time.monotonic() it was received) of each of them
+        :param sent_at: Float - time.monotonic() at which the last digit before them was sent (None if none was)
+        """
+        self.digits = digits
+        self.timings = timings
+        self.sent_at = sent_at
+
+    def __repr__(self):
+        return "<DTMFMatch {!r} latency={}>".format(self.digits, self.latency)
+
+    @property
+    def received_at(self):
+        """ time.monotonic() at which the first of the digits arrived """
+        return self.timings[0][1]
+
+    @property
+    def completed_at(self):
+        """ time.monotonic() at which the last of the digits arrived """
+        return self.timings[-1][1]
+
+    @property
+    def latency(self):
+        """ Seconds from sending the last digit before the match to receiving its first digit, e.g. an IVR's response
+        time (None if no digit had been sent) """
+        return None if self.sent_at is None else self.received_at - self.sent_at
+
+    @property
+    def duration(self):
+        """ Seconds from the first digit of the match to the last """
+        return self.completed_at - self.received_at
+
+
+class DTMFLog:
+    """
+    The DTMF digits sent and received on one call, each with the time.monotonic() at which it was sent or received
+
+    Only the most recent 'max_digits' of each are kept. Received digits are consumed by the waits they match, so
+    each wait only looks at the digits which have arrived since the previous one matched. Guarded by the owning
+    Soft Phone's state lock.
+    """
+    __slots__ = ("sent", "received", "received_total", "consumed")
+
+    def __init__(self, max_digits=256):
+        """
+        :param max_digits: Int - How many sent and how many received digits are kept
+        """
+        self.sent = deque(maxlen=max_digits)  # (digit, sent at)
+        self.received = deque(maxlen=max_digits)  # (digit, received at)
+        self.received_total = 0
+        self.consumed = 0  # number of received digits consumed by waits, counted from the start of the call
+
+    def __repr__(self):
+        return "<DTMFLog sent={!r} received={!r}>".format(self.sent_digits, self.received_digits)
+
+    @property
+    def sent_digits(self):
+        """ The digits sent (that are still kept) """
+        return "".join(digit for digit, _ in self.sent)
+
+    @property
+    def received_digits(self):
+        """ The digits received (that are still kept) """
+        return "".join(digit for digit, _ in self.received)
+
+    def record_sent(self, digits, now=None):
+        """
+        :param digits: String - Digits handed to pjsua together (pjsua paces them, they are all timed as sent now)
+        :param now: Float - time.monotonic() at which they were sent
+        """
+        now = time.monotonic() if now is None else now
+        self.sent.extend((digit, now) for digit in digits)
+
+    def record_received(self, digits, now=None):
+        """
+        :param digits: String - Digits reported by a pjsua on_dtmf_digit callback
+        :param now: Float - time.monotonic() at which they arrived
+        """
+        now = time.monotonic() if now is None else now
+        self.received.extend((digit, now) for digit in digits)
+        self.received_total += len(digits)
+
+    def pending_digits(self):
+        """
+        :return: String - The received digits no wait has consumed yet
+        """
+        first = self.received_total - len(self.received)  # the number of the oldest digit kept
+        return "".join(digit for digit, _ in list(self.received)[max(0, self.consumed - first):])
+
+    def match(self, pattern):
+        """
+        Look for a pattern in the received digits no wait has consumed yet, and consume them up to the end of it
+        :param pattern: Compiled regular expression - The digits wanted
+        :return: DTMFMatch - The digits which matched, None if they haven't arrived (yet)
+        """
+        pending = self.pending_digits()
+        if not pending:
+            return None
+        found = pattern.search(pending)
+        if not found or found.end() == found.start():
+            return None
+        offset = len(self.received) - len(pending)
+        timings = tuple(list(self.received)[offset + found.start():offset + found.end()])
+        self.consumed += found.end()
+        received_at = timings[0][1]
+        sent_at = None
+        for _, at in reversed(self.sent):
+            if at <= received_at:
+                sent_at = at
+                break
+        return DTMFMatch(found.group(), timings, sent_at)
+
+
+class DTMFSequence:
+    """
+    Script of DTMF digits to send on a call: digits with gaps between them, pauses, and waits for digits from the
+    far end (e.g. an IVR acknowledging a menu choice)
+
+        sequence = DTMFSequence(gap=0.2).send("1").wait_for("9", time_out=5).pause(0.5).send("1234#")
+
+    or from a dial string, where each ',' is a pause: DTMFSequence.parse("1,,1234#", gap=0.2, pause=1.0)
+    """
+
+    def __init__(self, gap=0.1):
+        """
+        :param gap: Number - Default seconds between the digits of each 'send'
+        """
+        self.gap = gap
+        self.steps = []  # ("digit", digit), ("pause", seconds) and ("wait", pattern, time_out)
+
+    def __repr__(self):
+        return "<DTMFSequence {} steps>".format(len(self.steps))
+
+    def __len__(self):
+        return len(self.steps)
+
+    @classmethod
+    def parse(cls, dial_string, gap=0.1, pause=1.0):
+        """
+        :param dial_string: String - DTMF digits, with a ',' for each pause
+        :param gap: Number - Seconds between consecutive digits
+        :param pause: Number - Seconds of each ','
+        :return: DTMFSequence - The sequence
+        """
+        sequence = cls(gap)
+        for digits in re.findall(r",|[^,]+", dial_string):
+            if digits == ",":
+                sequence.pause(pause)
+            else:
+                sequence.send(digits)
+        return sequence
+
+    def send(self, digits, gap=None):
+        """
+        Send digits one at a time
+        :param digits: String - The digits
+        :param gap: Number - Seconds between them (defaults to the sequence's gap)
+        :return: DTMFSequence - The sequence, to chain further steps
+        """
+        gap = self.gap if gap is None else gap
+        for index, digit in enumerate(_check_digits(digits)):
+            if index and gap > 0:
+                self.steps.append(("pause", gap))
+            self.steps.append(("digit", digit))
+        return self
+
+    def pause(self, seconds):
+        """
+        :param seconds: Number - Seconds to wait before the next step
+        :return: DTMFSequence - The sequence, to chain further steps
+        """
+        self.steps.append(("pause", seconds))
+        return self
+
+    def wait_for(self, pattern, time_out=10):
+        """
+        Wait for digits from the far end before the next step, the sequence fails if they don't arrive in time
+        :param pattern: String or compiled regular expression - The digits wanted, e.g. "9" or r"\\d{4}#"
+        :param time_out: Number - Seconds to wait for them
+        :return: DTMFSequence - The sequence, to chain further steps
+        """
+        self.steps.append(("wait", _as_pattern(pattern), time_out))
+        return self
+
+
+class DTMFSequenceRun:
+    """
+    A DTMFSequence being played on a call, step by step on the PJSipClient's timer thread
+
+    Pauses are timers and waits are woken by the digits arriving, so no thread sleeps whilst a sequence runs.
+    Every step scheduled carries the number of the step it is for, so a wait woken both by a digit and by its time
+    out only moves on once.
+    """
+
+    def __init__(self, sip_phone, phone_call, sequence):
+        """
+        :param sip_phone: SoftPhone - The phone carrying the call
+        :param phone_call: PhoneCall - The call
+        :param sequence: DTMFSequence - The sequence
+        """
+        self.sip_phone = sip_phone
+        self.phone_call = phone_call
+        self.steps = tuple(sequence.steps)
+        self.step = 0
+        self.state = "running"  # then "completed", "failed" or "cancelled"
+        self.error = None
+        self.matches = []  # DTMFMatch of each wait
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self._waiting = False
+        self._time_out_armed = None  # the wait step whose time out has been scheduled
+
+    def __repr__(self):
+        return "<DTMFSequenceRun {} step {}/{}>".format(self.state, self.step, len(self.steps))
+
+    def finished(self):
+        """ The sequence has completed, failed or been cancelled """
+        return self.state != "running"
+
+    def start(self):
+        """ Run the first step (on the timer thread) """
+        self._schedule(0, self.step)
+
+    def cancel(self):
+        """ Stop the sequence before its next step """
+        self._finish("cancelled")
+
+    def call_ended(self):
+        """ The call has ended (called from the pjsua callback thread), fail the sequence rather than leave a wait
+        running until its time out """
+        self._finish("failed", "the call ended")
+
+    def _schedule(self, delay, step):
+        self.sip_phone.pjsip_client.timers.schedule(delay, self._advance, step)
+
+    def on_digits(self):
+        """ Digits have arrived on the call (called from the pjsua callback thread), wake the wait if there is one """
+        if self._waiting:
+            self._schedule(0, self.step)
+
+    def _finish(self, state, error=None):
+        """
+        Record how the sequence ended, and wake anything waiting for it
+        """
+        with self.sip_phone._state_changed:
+            if self.state != "running":
+                return
+            self.state, self.error, self.finished_at = state, error, time.monotonic()
+            self._waiting = False
+            self.phone_call.dtmf_sequences = tuple(run for run in self.phone_call.dtmf_sequences if run is not self)
+            self.sip_phone._state_changed.notify_all()
+        if error:
+            logger.warning("[%s] DTMF sequence failed at step %s: %s", self.sip_phone.pbx_account_name, self.step,
+                           error)
+        self.sip_phone._notify_state_listeners(self.phone_call)
+
+    def _advance(self, step, timed_out=False):
+        """
+        Run steps from 'step' until one has to wait (runs on the timer thread)
+        :param step: Int - The step this was scheduled for, ignored if the sequence has moved on since
+        :param timed_out: Boolean - Scheduled by the time out of a wait
+        """
+        if step != self.step or self.finished():
+            return
+        sip_phone, phone_call = self.sip_phone, self.phone_call
+        while self.step < len(self.steps):
+            if phone_call.has_ended():
+                self._finish("failed", "the call ended")
+                return
+            kind = self.steps[self.step][0]
+            if kind == "digit":
+                try:
+                    sip_phone.send_dtmf_key_tones(self.steps[self.step][1], call=phone_call)
+                except Exception as e:  # the timer thread would only log it, leaving the sequence running for ever
+                    self._finish("failed", "unable to send DTMF: {}".format(e))
+                    return
+            elif kind == "pause":
+                self.step += 1
+                self._schedule(self.steps[self.step - 1][1], self.step)
+                return
+            else:
+                _, pattern, time_out = self.steps[self.step]
+                with sip_phone._state_changed:
+                    found = phone_call.dtmf.match(pattern)
+                    if found:
+                        sip_phone.metrics.on_dtmf_match(found)
+                    self._waiting = not found
+                if not found:
+                    if timed_out:
+                        self._finish("failed", "no DTMF matching {!r} within {} seconds".format(
+                            pattern.pattern, time_out))
+                    elif self._time_out_armed != self.step:
+                        self._time_out_armed = self.step
+                        sip_phone.pjsip_client.timers.schedule(time_out, self._advance, self.step, True)
+                    return
+                self.matches.append(found)
+                timed_out = False
+            self.step += 1
+        self._finish("completed")
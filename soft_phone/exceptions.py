@@ -3,3 +3,9 @@ class PhoneCallNotInProgress(Exception):
     """
     A SIP phone call has been referenced, but the phone call does not exist or has ended.
     """
+
+
+class FleetWorkerError(Exception):
+    """
+    A command sent to a worker process of a PhoneFleet raised an exception in the worker.
+    """
@@ -0,0 +1,613 @@
+"""
+In-process simulation of the pjsua bindings, selected with soft_phone.backend.use_backend("fake")
+
+It implements the part of the pjsua API soft_phone uses, against a simulated PBX: REGISTERs succeed after
+'registration_delay', calls between accounts registered with the same Lib are delivered to the callee (which
+answers however its AccountCallback decides), and calls to any other number ring after 'ring_delay' and are answered
+'answer_delay' later. Callbacks run on a single event thread holding the library lock, as they do in pjsua.
+No audio flows, players and recorders only take up conference slots.
+"""
+import heapq
+import itertools
+import threading
+import time
+import wave
+import weakref
+
+_lib = None
+
+
+class Settings:
+    """
+    Behaviour of the simulated PBX, change it with 'configure'
+    """
+
+    def __init__(self):
+        self.registration_delay = 0.01
+        self.registration_status = 200  # final status of every REGISTER
+        self.ring_delay = 0.02
+        self.answer_delay = 0.05
+        self.answer_status = 200  # final status of calls to numbers which aren't registered with the Lib
+        self.media_loss_percent = 0.0  # of the packets each call receives, as reported by Call.dump_status
+        self.media_jitter_ms = 2.0
+        self.media_rtt_ms = 40.0
+
+
+settings = Settings()
+
+
+def configure(**kwargs):
+    """
+    Change the behaviour of the simulated PBX
+    :param kwargs: Any attribute of Settings, e.g. ring_delay=0.5
+    """
+    for name, value in kwargs.items():
+        if not hasattr(settings, name):
+            raise AttributeError("The fake pjsua backend has no setting '{}'".format(name))
+        setattr(settings, name, value)
+
+
+class Error(Exception):
+    def __init__(self, op_name, obj, err_code, err_msg=""):
+        Exception.__init__(self, op_name, err_code, err_msg)
+        self.op_name = op_name
+        self.obj = obj
+        self.err_code = err_code
+        self.err_msg = err_msg
+
+
+class TransportType:
+    UNSPECIFIED = 0
+    UDP = 1
+    TCP = 2
+    TLS = 3
+    IPV6 = 128
+    UDP_IPV6 = UDP + IPV6
+    TCP_IPV6 = TCP + IPV6
+
+
+class CallState:
+    NULL = 0
+    CALLING = 1
+    INCOMING = 2
+    EARLY = 3
+    CONNECTING = 4
+    CONFIRMED = 5
+    DISCONNECTED = 6
+
+
+_STATE_TEXT = {0: "NULL", 1: "CALLING", 2: "INCOMING", 3: "EARLY", 4: "CONNECTING", 5: "CONFIRMED",
+               6: "DISCONNCTD"}
+
+
+class MediaState:
+    NULL = 0
+    ACTIVE = 1
+    LOCAL_HOLD = 2
+    REMOTE_HOLD = 3
+    ERROR = 4
+
+
+class LogConfig:
+    def __init__(self, level=5, filename="", callback=None, console_level=5):
+        self.level = level
+        self.filename = filename
+        self.callback = callback
+        self.console_level = console_level
+        self.msg_logging = True
+        self.decor = 0
+
+
+class UAConfig:
+    def __init__(self):
+        self.max_calls = 4
+        self.nameserver = []
+        self.stun_domain = ""
+        self.stun_host = ""
+        self.user_agent = "pjsip python"
+        self.thread_cnt = 1
+        self.main_thread_only = False
+
+
+class MediaConfig:
+    def __init__(self):
+        self.clock_rate = 16000
+        self.snd_clock_rate = 0
+        self.channel_count = 1
+        self.audio_frame_ptime = 20
+        self.max_media_ports = 32
+        self.quality = 6
+        self.ptime = 0
+        self.no_vad = False
+        self.ilbc_mode = 30
+        self.tx_drop_pct = 0
+        self.rx_drop_pct = 0
+        self.ec_options = 0
+        self.ec_tail_len = 256
+        self.jb_min = -1
+        self.jb_max = -1
+        self.enable_ice = False
+        self.enable_turn = False
+
+
+class TransportConfig:
+    def __init__(self, port=0, bound_addr="", public_addr=""):
+        self.port = port
+        self.bound_addr = bound_addr
+        self.public_addr = public_addr
+
+
+class TransportInfo:
+    def __init__(self, type, port, host):
+        self.type = type
+        self.description = "fake"
+        self.is_reliable = type != TransportType.UDP
+        self.is_secure = False
+        self.is_datagram = type == TransportType.UDP
+        self.host = host
+        self.port = port
+        self.ref_cnt = 1
+
+
+class Transport:
+    def __init__(self, lib, transport_id, info):
+        self._lib = weakref.ref(lib)
+        self._id = transport_id
+        self._info = info
+
+    def info(self):
+        return self._info
+
+
+class AccountConfig:
+    def __init__(self, domain="", username="", password="", display="", registrar="", proxy=""):
+        self.id = "sip:{}@{}".format(username, domain)
+        self.reg_uri = "sip:" + domain
+        self.reg_timeout = 300
+        self.transport_id = -1
+        self.username = username
+        self.password = password
+        self.proxy = [proxy] if proxy else []
+
+
+class AccountInfo:
+    def __init__(self, account):
+        self.is_default = False
+        self.uri = account._cfg.id
+        self.reg_active = account._reg_active
+        self.reg_expires = account._reg_expires
+        self.reg_status = account._reg_status
+        self.reg_reason = "OK" if account._reg_status == 200 else ""
+        self.online_status = 0
+        self.online_text = ""
+
+
+class AccountCallback:
+    def __init__(self, account=None):
+        self._set_account(account)
+
+    def _set_account(self, account):
+        self.account = weakref.proxy(account) if account else None
+
+    def on_reg_state(self):
+        pass
+
+    def on_incoming_call(self, call):
+        call.hangup(486)
+
+    def on_pager(self, from_uri, contact, mime_type, body):
+        pass
+
+
+class Account:
+    def __init__(self, lib, acc_id, cfg, cb=None):
+        self._lib = weakref.ref(lib)
+        self._id = acc_id
+        self._cfg = cfg
+        self._reg_status = 0
+        self._reg_expires = -1
+        self._reg_active = False
+        self._deleted = False
+        self.set_callback(cb)
+
+    def set_callback(self, cb):
+        self._cb = cb if cb else AccountCallback(self)
+        self._cb._set_account(self)
+
+    def info(self):
+        return AccountInfo(self)
+
+    def is_valid(self):
+        return not self._deleted
+
+    def set_registration(self, renew):
+        self._lib()._schedule(settings.registration_delay, self._complete_registration, renew)
+
+    def _complete_registration(self, renew):
+        if self._deleted:
+            return
+        if renew:
+            self._reg_status = settings.registration_status
+            self._reg_active = self._reg_status == 200
+            self._reg_expires = self._cfg.reg_timeout if self._reg_active else -1
+        else:
+            self._reg_expires = -1
+            self._reg_active = False
+        self._cb.on_reg_state()
+
+    def delete(self):
+        lib = self._lib()
+        with lib._lock:
+            self._deleted = True
+            lib._accounts.pop(self._id, None)
+
+    def make_call(self, dst_uri, cb=None, hdr_list=None):
+        lib = self._lib()
+        with lib._lock:
+            if len(lib._calls) >= lib._max_calls:
+                raise Error("make_call()", self, 70010, "Too many calls")
+            call = Call(lib, next(lib._call_ids), cb, self, dst_uri, role=0)
+            call._state = CallState.CALLING
+            lib._schedule(0.0, call._fire_state)
+            number = dst_uri.split(":", 1)[1].split("@", 1)[0]
+            callee = lib._account_for(number)
+            if callee:
+                lib._schedule(settings.ring_delay / 2, lib._deliver_incoming, call, callee)
+            else:
+                lib._schedule(settings.ring_delay, call._provisional, 180)
+                if settings.answer_status < 300:
+                    lib._schedule(settings.ring_delay + settings.answer_delay, call._connect)
+                else:
+                    lib._schedule(settings.ring_delay + settings.answer_delay, call._disconnect,
+                                  settings.answer_status)
+            return call
+
+
+class CallInfo:
+    def __init__(self, call):
+        self.role = call._role
+        self.account = call._acc
+        self.uri = call._acc._cfg.id
+        self.contact = self.uri
+        self.remote_uri = call._remote_uri
+        self.remote_contact = call._remote_uri
+        self.sip_call_id = "fake-{}".format(call._id)
+        self.state = call._state
+        self.state_text = _STATE_TEXT[call._state]
+        self.last_code = call._last_code
+        self.last_reason = ""
+        self.media_state = call._media_state
+        self.media_dir = 0
+        self.conf_slot = call._conf_slot
+        now = time.time()
+        self.call_time = int(now - call._connect_time) if call._connect_time else 0
+        self.total_time = int(now - call._start_time)
+
+
+class CallCallback:
+    def __init__(self, call=None):
+        self._set_call(call)
+
+    def _set_call(self, call):
+        self.call = weakref.proxy(call) if call else None
+
+    def on_state(self):
+        pass
+
+    def on_media_state(self):
+        pass
+
+    def on_dtmf_digit(self, digits):
+        pass
+
+
+class Call:
+    def __init__(self, lib, call_id, cb, acc, remote_uri, role):
+        self._lib = weakref.ref(lib)
+        self._id = call_id
+        self._acc = acc
+        self._remote_uri = remote_uri
+        self._role = role
+        self._state = CallState.NULL
+        self._media_state = MediaState.NULL
+        self._last_code = 0
+        self._conf_slot = -1
+        self._start_time = time.time()
+        self._connect_time = None
+        self._peer = None
+        self.set_callback(cb)
+        lib._calls[call_id] = self
+
+    def set_callback(self, cb):
+        self._cb = cb if cb else CallCallback(self)
+        self._cb._set_call(self)
+
+    def info(self):
+        return CallInfo(self)
+
+    def is_valid(self):
+        return 1 if self._state != CallState.DISCONNECTED and self._state != CallState.NULL else 0
+
+    def _fire_state(self):
+        self._cb.on_state()
+
+    def _provisional(self, code):
+        if self._state in (CallState.CALLING, CallState.EARLY):
+            self._state = CallState.EARLY
+            self._last_code = code
+            self._cb.on_state()
+
+    def _connect(self):
+        if self._state in (CallState.DISCONNECTED, CallState.CONFIRMED):
+            return
+        self._state = CallState.CONFIRMED
+        self._last_code = 200
+        self._connect_time = time.time()
+        self._conf_slot = self._lib()._allocate_slot()
+        self._cb.on_state()
+        self._media_state = MediaState.ACTIVE
+        self._cb.on_media_state()
+
+    def _disconnect(self, code):
+        if self._state == CallState.DISCONNECTED:
+            return
+        self._state = CallState.DISCONNECTED
+        self._last_code = code
+        self._media_state = MediaState.NULL
+        lib = self._lib()
+        if self._conf_slot >= 0:
+            lib._release_slot(self._conf_slot)
+            self._conf_slot = -1
+        self._cb.on_state()
+        lib._calls.pop(self._id, None)
+
+    def answer(self, code=200, reason="", hdr_list=None):
+        lib = self._lib()
+        with lib._lock:
+            peer = self._peer
+            if code < 200:
+                self._state = CallState.EARLY
+                self._last_code = code
+                lib._schedule(0.0, self._fire_state)
+                if peer:
+                    lib._schedule(0.0, peer._provisional, code)
+            elif code < 300:
+                lib._schedule(0.0, self._connect)
+                if peer:
+                    lib._schedule(0.0, peer._connect)
+            else:
+                lib._schedule(0.0, self._disconnect, code)
+                if peer:
+                    lib._schedule(0.0, peer._disconnect, code)
+
+    def hangup(self, code=603, reason="", hdr_list=None):
+        lib = self._lib()
+        with lib._lock:
+            lib._schedule(0.0, self._disconnect, code if self._state != CallState.CONFIRMED else 200)
+            if self._peer:
+                lib._schedule(0.0, self._peer._disconnect, 200)
+
+    def dial_dtmf(self, digits):
+        lib = self._lib()
+        if self._peer:
+            for index, digit in enumerate(digits):
+                lib._schedule(0.01 * index, self._peer._cb.on_dtmf_digit, digit)
+
+    def dump_status(self, with_media=True, indent="", max_len=1024):
+        dump = "{}Call time: 00h:00m:{:02d}s".format(indent, int(time.time() - self._start_time))
+        if not with_media or self._media_state != MediaState.ACTIVE:
+            return dump[:max_len]
+        # 50 packets a second each way since the call connected, 'media_loss_percent' of them lost on the way in
+        sent = int(50 * (time.time() - self._connect_time))
+        lost = int(sent * settings.media_loss_percent / 100)
+        jitter, rtt = settings.media_jitter_ms, settings.media_rtt_ms
+        dump += (
+            "\n    #0 audio PCMU @8kHz, sendrecv, peer=127.0.0.1:4000\n"
+            "       RX pt=0, last update:00h:00m:00.020s ago\n"
+            "          total {rx}pkt {rx_kb:.1f}KB ({rx_kb:.1f}KB +IP hdr) @avg=64.0Kbps/80.0Kbps\n"
+            "          pkt loss={lost} ({loss:.1f}%), discrd=0 (0.0%), dup=0 (0.0%), reord=0 (0.0%)\n"
+            "                (msec)    min     avg     max     last    dev\n"
+            "          jitter     : {j_min:7.3f} {j:7.3f} {j_max:7.3f} {j:7.3f}   0.500\n"
+            "       TX pt=0, ptime=20ms, last update:00h:00m:00.020s ago\n"
+            "          total {tx}pkt {tx_kb:.1f}KB ({tx_kb:.1f}KB +IP hdr) @avg=64.0Kbps/80.0Kbps\n"
+            "          pkt loss=0 (0.0%), dup=0 (0.0%), reorder=0 (0.0%)\n"
+            "                (msec)    min     avg     max     last    dev \n"
+            "          jitter     :   0.000   1.000   2.000   1.000   0.500\n"
+            "      RTT msec       : {rtt_min:7.3f} {rtt:7.3f} {rtt_max:7.3f} {rtt:7.3f}   1.000").format(
+            rx=sent - lost, rx_kb=(sent - lost) * 0.16, lost=lost, loss=100.0 * lost / sent if sent else 0.0,
+            j_min=jitter / 2, j=jitter, j_max=jitter * 2, tx=sent, tx_kb=sent * 0.16, rtt_min=rtt / 2, rtt=rtt,
+            rtt_max=rtt * 2)
+        return dump[:max_len]
+
+
+class CodecInfo:
+    def __init__(self, name, priority, clock_rate):
+        self.name = name
+        self.priority = priority
+        self.clock_rate = clock_rate
+        self.channel_count = 1
+        self.avg_bps = 64000
+        self.frm_ptime = 20
+        self.ptime = 20
+        self.pt = 0
+        self.vad_enabled = False
+        self.plc_enabled = True
+
+
+class Lib:
+    def __init__(self):
+        global _lib
+        if _lib:
+            raise Error("__init()__", None, -1, "Library instance already exist")
+        _lib = self
+        self._lock = threading.RLock()
+        self._heap = []
+        self._seq = itertools.count()
+        self._call_ids = itertools.count()
+        self._acc_ids = itertools.count()
+        self._player_ids = itertools.count()
+        self._recorder_ids = itertools.count()
+        self._accounts = {}
+        self._calls = {}
+        self._players = {}
+        self._recorders = {}
+        self._slots = set()
+        self._connections = set()
+        self._max_calls = 4
+        self._max_ports = 32
+        self._transports = []
+        self._wake = threading.Condition(self._lock)
+        self._thread = None
+        self._running = False
+        self._codecs = {"PCMU/8000/1": 128, "PCMA/8000/1": 128, "speex/16000/1": 130, "G722/16000/1": 130}
+        self.log_cfg = None
+
+    @staticmethod
+    def instance():
+        return _lib
+
+    def init(self, ua_cfg=None, log_cfg=None, media_cfg=None):
+        ua_cfg = ua_cfg or UAConfig()
+        media_cfg = media_cfg or MediaConfig()
+        self._max_calls = ua_cfg.max_calls
+        self._max_ports = media_cfg.max_media_ports
+        self._clock_rate = media_cfg.clock_rate
+        self.log_cfg = log_cfg
+        if log_cfg and log_cfg.callback:
+            log_cfg.callback(4, "fake pjsua initialised", 0)
+
+    def create_transport(self, type, cfg=None):
+        cfg = cfg or TransportConfig()
+        port = cfg.port or 5060 + len(self._transports)
+        for transport in self._transports:
+            if transport.info().port == port and transport.info().host == (cfg.bound_addr or "0.0.0.0"):
+                raise Error("create_transport()", self, 120098, "Address already in use")
+        transport = Transport(self, len(self._transports), TransportInfo(type, port, cfg.bound_addr or "0.0.0.0"))
+        self._transports.append(transport)
+        return transport
+
+    def set_null_snd_dev(self):
+        pass
+
+    def start(self, with_thread=True):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="fake-pjsua", daemon=True)
+        self._thread.start()
+
+    def destroy(self):
+        global _lib
+        with self._lock:
+            self._running = False
+            self._wake.notify_all()
+        if self._thread:
+            self._thread.join()
+        _lib = None
+
+    def thread_register(self, name):
+        pass
+
+    def handle_events(self, timeout=50):
+        return 0
+
+    def _schedule(self, delay, fn, *args):
+        with self._lock:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), fn, args))
+            self._wake.notify()
+
+    def _run(self):
+        with self._lock:
+            while self._running:
+                if not self._heap:
+                    self._wake.wait()
+                    continue
+                due = self._heap[0][0] - time.monotonic()
+                if due > 0:
+                    self._wake.wait(due)
+                    continue
+                _, _, fn, args = heapq.heappop(self._heap)
+                fn(*args)
+
+    def _account_for(self, number):
+        for account in self._accounts.values():
+            if account._cfg.username == number and account._reg_active:
+                return account
+        return None
+
+    def _deliver_incoming(self, caller_call, callee_account):
+        if caller_call._state == CallState.DISCONNECTED:
+            return
+        if len(self._calls) >= self._max_calls:
+            caller_call._disconnect(486)
+            return
+        call = Call(self, next(self._call_ids), None, callee_account, caller_call._acc._cfg.id, role=1)
+        call._state = CallState.INCOMING
+        call._peer = caller_call
+        caller_call._peer = call
+        callee_account._cb.on_incoming_call(call)
+
+    def _allocate_slot(self):
+        for slot in range(1, self._max_ports):
+            if slot not in self._slots:
+                self._slots.add(slot)
+                return slot
+        raise Error("conf", self, 70012, "Too many conference ports")
+
+    def _release_slot(self, slot):
+        self._slots.discard(slot)
+        self._connections = set(c for c in self._connections if slot not in c)
+
+    def create_account(self, acc_config, set_default=True, cb=None):
+        with self._lock:
+            account = Account(self, next(self._acc_ids), acc_config, cb)
+            self._accounts[account._id] = account
+            self._schedule(settings.registration_delay, account._complete_registration, True)
+            return account
+
+    def create_player(self, filename, loop=False):
+        with self._lock:
+            player_id = next(self._player_ids)
+            self._players[player_id] = self._allocate_slot()
+            return player_id
+
+    def player_get_slot(self, player_id):
+        return self._players[player_id]
+
+    def player_set_pos(self, player_id, pos):
+        pass
+
+    def player_destroy(self, player_id):
+        with self._lock:
+            self._release_slot(self._players.pop(player_id))
+
+    def create_recorder(self, filename):
+        with self._lock:
+            recorder_id = next(self._recorder_ids)
+            self._recorders[recorder_id] = self._allocate_slot()
+            with wave.open(filename, "wb") as wav_file:  # nothing is simulated on the call, so it stays silent
+                wav_file.setparams((1, 2, self._clock_rate, 0, "NONE", "not compressed"))
+            return recorder_id
+
+    def recorder_get_slot(self, rec_id):
+        return self._recorders[rec_id]
+
+    def recorder_destroy(self, rec_id):
+        with self._lock:
+            self._release_slot(self._recorders.pop(rec_id))
+
+    def conf_connect(self, src_slot, dst_slot):
+        self._connections.add((src_slot, dst_slot))
+
+    def conf_disconnect(self, src_slot, dst_slot):
+        self._connections.discard((src_slot, dst_slot))
+
+    def conf_get_active_ports(self):
+        return len(self._slots) + 1
+
+    def conf_get_max_ports(self):
+        return self._max_ports
+
+    def enum_codecs(self):
+        return [CodecInfo(name, priority, int(name.split("/")[1])) for name, priority in self._codecs.items()]
+
+    def set_codec_priority(self, name, priority):
+        self._codecs[name] = priority
@@ -0,0 +1,437 @@
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from soft_phone import backend
+from soft_phone.config import PJSipConfig
+from soft_phone.exceptions import FleetWorkerError, PhoneCallNotInProgress
+from soft_phone.metrics import MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+
+def _call_summary(phone_call):
+    """
+    :param phone_call: PhoneCall - A call carried by a worker
+    :return: Dict - The published state of the call (plain values, so it can be sent back to the coordinator)
+    """
+    call_state = phone_call.call_state
+    return {"pbx_account_name": phone_call.sip_phone.pbx_account_name, "call_id": phone_call.call_id,
+            "direction": phone_call.direction, "state": call_state.state, "last_code": call_state.last_code,
+            "connected": phone_call.is_connected(), "ended": phone_call.has_ended(),
+            "setup_time": (call_state.connected_at - call_state.started_at
+                           if call_state.connected_at is not None else None),
+            "connected_duration": call_state.connected_duration()}
+
+
+class _Worker:
+    """
+    One worker process of a PhoneFleet: a PJSipClient and a SoftPhonePool of the fleet's accounts
+    Commands from the coordinator are run on a pool of threads (registered with PJSip), so slow ones (e.g. a dial
+    waiting to be answered) don't hold up the rest.
+    """
+    max_remembered_calls = 10000
+
+    def __init__(self, index, connection, config):
+        self.index = index
+        self.connection = connection
+        self.config = config
+        self._send_lock = threading.Lock()
+        self._calls = OrderedDict()  # Call-ID -> PhoneCall, recent calls dialled by the worker (even once ended)
+        self._calls_lock = threading.Lock()  # the commands run on several threads at once
+        self.pjsip_client = None
+        self.pool = None
+
+    def run(self):
+        """ Serve the coordinator's commands until it sends 'stop' """
+        backend.use_backend(self.config["backend"])
+        from soft_phone.manage_pjsip import PJSipClient  # only now the backend has been chosen
+        from soft_phone.pool import SoftPhonePool
+
+        self.pjsip_client = PJSipClient(**self.config["client_kwargs"])
+        self.pjsip_client.start()
+        self.pool = SoftPhonePool(self.pjsip_client, self.config["pbx_ip"], self.config["accounts"],
+                                  self.config["pbx_password"], max_in_flight=self.config["max_in_flight"],
+                                  **self.config["soft_phone_kwargs"])
+        executor = ThreadPoolExecutor(max_workers=self.config["command_threads"])
+        try:
+            while True:
+                try:
+                    request_id, command, args, kwargs = self.connection.recv()
+                except EOFError:  # the coordinator has gone
+                    return
+                if command == "stop":
+                    break
+                executor.submit(self._execute, request_id, command, args, kwargs)
+        finally:
+            executor.shutdown(wait=True)
+            self.pool.unregister_all()
+            self.pjsip_client.stop()
+        self._send(request_id, True, None)
+
+    def _send(self, request_id, succeeded, result):
+        with self._send_lock:
+            self.connection.send((request_id, succeeded, result))
+
+    def _execute(self, request_id, command, args, kwargs):
+        """ Run a command on a pool thread and send its outcome back to the coordinator """
+        self.pjsip_client.register_thread()
+        try:
+            result = getattr(self, "_command_" + command)(*args, **kwargs)
+        except Exception as e:  # the coordinator re-raises it as a FleetWorkerError
+            logger.debug("[worker %s] Command '%s' failed", self.index, command, exc_info=True)
+            self._send(request_id, False, "{}: {}".format(type(e).__name__, e))
+        else:
+            self._send(request_id, True, result)
+
+    def _remember(self, phone_call):
+        with self._calls_lock:
+            self._calls[phone_call.call_id] = phone_call
+            while len(self._calls) > self.max_remembered_calls:
+                self._calls.popitem(last=False)
+
+    def _phone_call(self, pbx_account_name, call_id):
+        """
+        :return: PhoneCall - A call in progress on the phone (or one the worker dialled, even if it has ended)
+        """
+        phone = self.pool[pbx_account_name]
+        phone_call = phone.get_call(call_id) if call_id else phone.current_call
+        if phone_call is None:
+            with self._calls_lock:
+                phone_call = self._calls.get(call_id)
+        if phone_call is None:
+            raise PhoneCallNotInProgress("[{}] The call does not exist".format(pbx_account_name))
+        return phone_call
+
+    def _command_register(self, time_out):
+        return {pbx_account_name: dict(result._asdict())
+                for pbx_account_name, result in self.pool.register_all(time_out).items()}
+
+    def _command_unregister(self, time_out):
+        self.pool.unregister_all(time_out)
+
+    def _command_dial(self, pbx_account_name, number_to_dial, protocol, time_out):
+        phone = self.pool[pbx_account_name]
+        if time_out:
+            phone_call = phone.make_call(number_to_dial, protocol, time_out)
+        else:
+            phone_call = phone._start_call(number_to_dial, protocol)
+        self._remember(phone_call)
+        return _call_summary(phone_call)
+
+    def _command_get_call(self, pbx_account_name, call_id):
+        return _call_summary(self._phone_call(pbx_account_name, call_id))
+
+    def _command_hang_up(self, pbx_account_name, call_id):
+        phone_call = self._phone_call(pbx_account_name, call_id)
+        if not phone_call.has_ended():
+            phone_call.sip_phone.hang_up(phone_call)
+
+    def _command_hang_up_after(self, pbx_account_name, call_length, call_id):
+        phone_call = self._phone_call(pbx_account_name, call_id)
+        phone_call.sip_phone.hang_up_after(call_length, phone_call)
+
+    def _command_wait_for_call_to_end(self, pbx_account_name, call_id, time_out):
+        phone_call = self._phone_call(pbx_account_name, call_id)
+        return phone_call.sip_phone._wait_for_state(phone_call.has_ended, time_out)
+
+    def _command_send_dtmf_key_tones(self, pbx_account_name, digits, call_id):
+        self.pool[pbx_account_name].send_dtmf_key_tones(digits, self._phone_call(pbx_account_name, call_id))
+
+    def _command_run_load(self, numbers_to_dial, calls_per_second, load_kwargs):
+        from soft_phone.load_generator import LoadGenerator
+        return LoadGenerator(self.pool, numbers_to_dial, calls_per_second, **load_kwargs).run()
+
+    def _command_metrics(self):
+        metrics = self.pjsip_client.metrics.aggregate()
+        metrics.pbx_account_name = "worker-{}".format(self.index)
+        return metrics
+
+
+def _run_worker(index, connection, config):
+    """ Entry point of a worker process """
+    logging.basicConfig(level=config["log_level"],
+                        format="%(asctime)s worker-{} %(name)s %(levelname)s %(message)s".format(index))
+    _Worker(index, connection, config).run()
+
+
+class PhoneFleet:
+    """
+    'Soft Phones' sharded over worker processes, each with its own PJSipClient, so one host can use all its cores
+
+    pjsua allows one Lib per process, and one Lib mixes all its media through one conference bridge, so a single
+    process tops out at a few hundred calls. The fleet starts a worker process per core (with the 'spawn' start
+    method, as a forked copy of a running pjsua is unusable), deals the accounts out between them, and routes each
+    command to the worker which owns the account. The coordinator process has no pjsua Lib of its own.
+    """
+
+    def __init__(self, pbx_ip, accounts, pbx_password=None, workers=None, client_kwargs=None, soft_phone_kwargs=None,
+                 max_in_flight=20, command_threads=32, log_level=logging.WARNING, base_port=None,
+                 ports_per_worker=100):
+        """
+        :param pbx_ip: String - Address of the PBX to register with
+        :param accounts: Iterable - Account names sharing 'pbx_password', or (account name, password) tuples
+        :param pbx_password: String - Password for any account not given as an (account name, password) tuple
+        :param workers: Int - Number of worker processes (defaults to the number of cores, at most one per account)
+        :param client_kwargs: Dict - Passed to each worker's PJSipClient, e.g. max_calls
+        :param soft_phone_kwargs: Dict - Passed to each SoftPhone, e.g. answer_audio or action_on_incoming_call
+        :param max_in_flight: Int - The maximum number of REGISTERs each worker has outstanding at once
+        :param command_threads: Int - How many commands each worker runs at once
+        :param log_level: Int - Logging level of the worker processes
+        :param base_port: Int - Give each worker its own block of 'ports_per_worker' local ports from here on, shared
+                          out between the transports of the PJSipConfig in 'client_kwargs' (None for any free port)
+        :param ports_per_worker: Int - Size of each worker's block of ports
+        """
+        accounts = [account if isinstance(account, (tuple, list)) else (str(account), pbx_password)
+                    for account in accounts]
+        workers = min(workers or os.cpu_count() or 1, len(accounts)) or 1
+        self.pbx_ip = pbx_ip
+        self.shards = [accounts[index::workers] for index in range(workers)]
+        self.worker_of_account = {str(pbx_account_name): index
+                                  for index, shard in enumerate(self.shards) for pbx_account_name, _ in shard}
+        self.base_port = base_port
+        self.ports_per_worker = ports_per_worker
+        self._config = {"backend": backend.selected_backend(), "pbx_ip": pbx_ip, "pbx_password": pbx_password,
+                        "client_kwargs": dict(client_kwargs or {}), "soft_phone_kwargs": dict(soft_phone_kwargs or {}),
+                        "max_in_flight": max_in_flight, "command_threads": command_threads, "log_level": log_level}
+        self._processes = []
+        self._connections = []
+        self._receivers = []
+        self._send_locks = []
+        self._pending = {}  # request id -> Future
+        self._pending_lock = threading.Lock()
+        self._request_ids = itertools.count()
+
+    def __len__(self):
+        return len(self.shards)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """ Start the worker processes, each creates its PJSipClient and its share of the phones """
+        context = multiprocessing.get_context("spawn")
+        for index, shard in enumerate(self.shards):
+            connection, worker_connection = context.Pipe()
+            config = dict(self._config, accounts=shard)
+            if self.base_port:
+                config["client_kwargs"] = dict(config["client_kwargs"], config=self._worker_pjsip_config(index))
+            process = context.Process(target=_run_worker, args=(index, worker_connection, config),
+                                      name="soft-phone-worker-{}".format(index), daemon=True)
+            process.start()
+            worker_connection.close()
+            receiver = threading.Thread(target=self._receive, args=(index, connection),
+                                        name="soft-phone-fleet-receiver-{}".format(index), daemon=True)
+            receiver.start()
+            self._processes.append(process)
+            self._connections.append(connection)
+            self._send_locks.append(threading.Lock())
+            self._receivers.append(receiver)
+        logger.info("Started %s worker processes for %s phones", len(self.shards), len(self.worker_of_account))
+
+    def stop(self, time_out=30):
+        """
+        Unregister every phone and stop the worker processes
+        :param time_out: Number - Seconds to wait for each worker to shut down before it is terminated
+        """
+        for index, process in enumerate(self._processes):
+            try:
+                self._submit(index, "stop").result(time_out)
+            except Exception:
+                logger.warning("Worker %s did not stop cleanly, terminating it", index)
+            process.join(time_out)
+            if process.is_alive():
+                process.terminate()
+            self._connections[index].close()
+        self._processes, self._connections, self._send_locks, self._receivers = [], [], [], []
+        logger.info("Every worker process has been stopped")
+
+    def _worker_pjsip_config(self, index):
+        """
+        :param index: Int - The worker
+        :return: PJSipConfig - The fleet's PJSip configuration with the transports moved into the worker's ports
+        """
+        pjsip_config = self._config["client_kwargs"].get("config") or PJSipConfig()
+        ports_per_transport = self.ports_per_worker // len(pjsip_config.transports)
+        if ports_per_transport < 1:
+            raise ValueError("'ports_per_worker' must allow at least one port for each transport")
+        return pjsip_config.with_port_ranges(self.base_port + index * self.ports_per_worker, ports_per_transport)
+
+    def _receive(self, index, connection):
+        """ Resolve the futures of a worker's replies (runs on a receiver thread per worker) """
+        while True:
+            try:
+                request_id, succeeded, result = connection.recv()
+            except (EOFError, OSError):
+                break
+            with self._pending_lock:
+                future = self._pending.pop(request_id, None)
+            if future is None:
+                continue
+            if succeeded:
+                future.set_result(result)
+            else:
+                future.set_exception(FleetWorkerError("[worker {}] {}".format(index, result)))
+        with self._pending_lock:  # the worker has gone, anything it still owed will never arrive
+            orphaned = [future for future in self._pending.values() if future.worker_index == index]
+            for future in orphaned:
+                del self._pending[future.request_id]
+        for future in orphaned:
+            future.set_exception(FleetWorkerError("[worker {}] The worker process has exited".format(index)))
+
+    def _submit(self, index, command, *args, **kwargs):
+        """
+        Send a command to a worker
+        :return: Future - Resolved with the command's result once the worker replies
+        """
+        future = Future()
+        future.worker_index = index
+        future.request_id = next(self._request_ids)
+        with self._pending_lock:
+            self._pending[future.request_id] = future
+        with self._send_locks[index]:
+            self._connections[index].send((future.request_id, command, args, kwargs))
+        return future
+
+    def _worker_for(self, pbx_account_name):
+        try:
+            return self.worker_of_account[str(pbx_account_name)]
+        except KeyError:
+            raise ValueError("'{}' is not one of the fleet's accounts".format(pbx_account_name))
+
+    def submit(self, pbx_account_name, command, *args, **kwargs):
+        """
+        Send a command to the worker owning an account without waiting for it, e.g. to dial from many phones at once
+        :param pbx_account_name: String - The account
+        :param command: String - "dial", "get_call", "hang_up", "wait_for_call_to_end" or "send_dtmf_key_tones"
+        :return: Future - Resolved with the command's result (as returned by the method of the same name)
+        """
+        return self._submit(self._worker_for(pbx_account_name), command, str(pbx_account_name), *args, **kwargs)
+
+    def _gather(self, command, *args, **kwargs):
+        """
+        :return: List - The result of running a command on every worker
+        """
+        futures = [self._submit(index, command, *args, **kwargs) for index in range(len(self._processes))]
+        return [future.result() for future in futures]
+
+    def register_all(self, time_out=30):
+        """
+        Register every account in the fleet, each worker registering its own share at once
+        :param time_out: Number - Overall number of seconds allowed for the fleet to register
+        :return: Dict - Registration result (pbx_account_name, reg_status and latency) for each account name
+        """
+        results = {}
+        for worker_results in self._gather("register", time_out):
+            results.update(worker_results)
+        logger.info("Registered %s of %s phones", sum(1 for result in results.values() if result["reg_status"] == 200),
+                    len(results))
+        return results
+
+    def unregister_all(self, time_out=10):
+        """
+        Unregister and delete every account in the fleet
+        :param time_out: Number - Overall number of seconds allowed for each worker's share to be removed
+        """
+        self._gather("unregister", time_out)
+
+    def dial(self, pbx_account_name, number_to_dial, protocol="sip", time_out=12):
+        """
+        Make a call from one of the fleet's phones
+        :param pbx_account_name: String - The account to call from
+        :param number_to_dial: String - The number (SIP user) to dial
+        :param protocol: String - URI scheme used to build the destination, e.g. "sip"
+        :param time_out: Int - The maximum number of seconds to wait for the call to be CONFIRMED (0 not to wait)
+        :return: Dict - The call's state, including its 'call_id' for the other commands
+        """
+        return self.submit(pbx_account_name, "dial", number_to_dial, protocol, time_out).result()
+
+    def get_call(self, pbx_account_name, call_id=None):
+        """
+        :param pbx_account_name: String - The account carrying the call
+        :param call_id: String - SIP Call-ID of the call, defaults to the phone's current call
+        :return: Dict - The call's state
+        """
+        return self.submit(pbx_account_name, "get_call", call_id).result()
+
+    def hang_up(self, pbx_account_name, call_id=None):
+        """
+        End a call
+        :param pbx_account_name: String - The account carrying the call
+        :param call_id: String - SIP Call-ID of the call, defaults to the phone's current call
+        """
+        self.submit(pbx_account_name, "hang_up", call_id).result()
+
+    def hang_up_after(self, pbx_account_name, call_length, call_id=None):
+        """
+        Have the worker hang up a call once it has been connected for a specific duration (returns at once)
+        :param pbx_account_name: String - The account carrying the call
+        :param call_length: Number - Seconds of connection time
+        :param call_id: String - SIP Call-ID of the call, defaults to the phone's current call
+        """
+        self.submit(pbx_account_name, "hang_up_after", call_length, call_id).result()
+
+    def wait_for_call_to_end(self, pbx_account_name, call_id=None, time_out=60):
+        """
+        :param pbx_account_name: String - The account carrying the call
+        :param call_id: String - SIP Call-ID of the call, defaults to the phone's current call
+        :param time_out: Number - The maximum number of seconds to wait for the call to end
+        :return: Boolean - True if the call has ended
+        """
+        return self.submit(pbx_account_name, "wait_for_call_to_end", call_id, time_out).result()
+
+    def send_dtmf_key_tones(self, pbx_account_name, digits, call_id=None):
+        """
+        Send DTMF keypad tones to a call
+        :param pbx_account_name: String - The account carrying the call
+        :param digits: String - Digits to send over the call
+        :param call_id: String - SIP Call-ID of the call, defaults to the phone's current call
+        """
+        self.submit(pbx_account_name, "send_dtmf_key_tones", digits, call_id).result()
+
+    def run_load(self, numbers_to_dial, calls_per_second, **load_kwargs):
+        """
+        Run a LoadGenerator in every worker, over its share of the phones, with the rate split between them
+        :param numbers_to_dial: String or List - The number(s) to dial
+        :param calls_per_second: Number - Target rate of call originations across the whole fleet
+        :param load_kwargs: Passed to each LoadGenerator (a 'total_calls' is split between the workers too), the
+                            'report_callback' can't be used as it would run in the worker
+        :return: LoadStatistics - The statistics of every worker combined
+        """
+        from soft_phone.load_generator import LoadStatistics
+
+        workers = len(self._processes)
+        total_calls = load_kwargs.pop("total_calls", None)
+        futures = []
+        for index in range(workers):
+            worker_kwargs = dict(load_kwargs)
+            if total_calls is not None:
+                worker_kwargs["total_calls"] = total_calls // workers + (1 if index < total_calls % workers else 0)
+            futures.append(self._submit(index, "run_load", numbers_to_dial, calls_per_second / float(workers),
+                                        worker_kwargs))
+        combined = LoadStatistics(setup_time_samples=None)
+        for future in futures:
+            statistics = future.result()
+            for name in ("attempts", "answered", "failed", "active"):
+                setattr(combined, name, getattr(combined, name) + getattr(statistics, name))
+            combined.setup_times.extend(statistics.setup_times)
+            # CLOCK_MONOTONIC is system wide, so the workers' timestamps can be compared
+            combined.started_at = min(combined.started_at or statistics.started_at, statistics.started_at)
+            combined.finished_at = max(combined.finished_at or statistics.finished_at, statistics.finished_at)
+        return combined
+
+    def metrics(self):
+        """
+        :return: MetricsRegistry - Each worker's aggregated metrics (as 'worker-<index>'), ready for export
+        """
+        registry = MetricsRegistry()
+        for worker_metrics in self._gather("metrics"):
+            registry.add(worker_metrics)
+        return registry
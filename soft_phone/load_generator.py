@@ -0,0 +1,321 @@
+from soft_phone.backend import get_backend
+import heapq
+import itertools
+import logging
+import math
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+pj = get_backend()
+
+logger = logging.getLogger(__name__)
+
+
+class LoadStatistics:
+    """
+    Running statistics of a load generation run
+    Only the scheduler thread updates them, any thread may read a snapshot.
+    """
+
+    def __init__(self, setup_time_samples=10000):
+        """
+        :param setup_time_samples: Int - How many of the most recent setup times are kept for the percentiles
+        """
+        self.started_at = None
+        self.finished_at = None
+        self.attempts = 0
+        self.answered = 0
+        self.failed = 0
+        self.active = 0
+        self.setup_times = deque(maxlen=setup_time_samples)
+
+    @property
+    def elapsed(self):
+        """ Seconds since the run started (up to when it finished) """
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def achieved_cps(self):
+        """ Call attempts per second actually achieved """
+        elapsed = self.elapsed
+        return self.attempts / elapsed if elapsed else 0.0
+
+    @property
+    def answer_seizure_ratio(self):
+        """ Fraction of completed call attempts (answered or failed) which were answered """
+        completed = self.answered + self.failed
+        return self.answered / completed if completed else 0.0
+
+    def setup_time_percentiles(self, percentiles=(50, 90, 95, 99)):
+        """
+        Percentiles (nearest rank) of the recent call setup times (INVITE to CONFIRMED)
+        :param percentiles: Iterable - The percentiles to calculate
+        :return: Dict - Setup time in seconds for each percentile (None if no call has been answered yet)
+        """
+        samples = sorted(self.setup_times)
+        if not samples:
+            return {percentile: None for percentile in percentiles}
+        return {percentile: samples[max(0, int(math.ceil(percentile / 100.0 * len(samples))) - 1)]
+                for percentile in percentiles}
+
+    def snapshot(self):
+        """
+        :return: Dict - The current statistics
+        """
+        return {"elapsed": self.elapsed, "attempts": self.attempts, "answered": self.answered,
+                "failed": self.failed, "active": self.active, "achieved_cps": self.achieved_cps,
+                "answer_seizure_ratio": self.answer_seizure_ratio,
+                "setup_time_percentiles": self.setup_time_percentiles()}
+
+
+class _GeneratedCall:
+    """
+    Book-keeping for a call originated by the load generator
+    """
+    __slots__ = ("phone", "phone_call", "started_at", "confirmed_at", "hang_up_entry")
+
+    def __init__(self, phone, phone_call, started_at):
+        self.phone = phone
+        self.phone_call = phone_call
+        self.started_at = started_at
+        self.confirmed_at = None
+        self.hang_up_entry = None  # the call's entry in the scheduler's hang up heap, once CONFIRMED
+
+
+class LoadGenerator:
+    """
+    Originate calls from a SoftPhonePool of callers at a target rate (calls per second)
+
+    Each call is held for 'hold_time' once CONFIRMED and then hung up. A single scheduler thread paces the
+    originations, driven by the pjsua callbacks through the phones' state listeners, so no thread blocks per call.
+    """
+
+    def __init__(self, caller_pool, numbers_to_dial, calls_per_second, hold_time=30, max_concurrent_calls=None,
+                 ramp_up=0, total_calls=None, duration=None, setup_time_out=12, report_interval=5,
+                 report_callback=None, protocol="sip", calls_per_phone=1):
+        """
+        :param caller_pool: SoftPhonePool - Registered phones to originate the calls from
+        :param numbers_to_dial: String or List - The number(s) to dial, a list is dialled in rotation
+        :param calls_per_second: Number - Target rate of call originations
+        :param hold_time: Number or Tuple - Seconds to hold each call once connected, or a (minimum, maximum) range to
+                          pick a random hold time from
+        :param max_concurrent_calls: Int - Cap on calls in progress at once (defaults to the pool size, limited by the
+                                     PJSipClient's 'max_calls')
+        :param ramp_up: Number - Seconds over which the rate increases linearly from 0 to 'calls_per_second'
+        :param total_calls: Int - Stop originating after this many call attempts
+        :param duration: Number - Stop originating after this many seconds
+        :param setup_time_out: Number - Seconds a call may take to be CONFIRMED before it is abandoned as failed
+        :param report_interval: Number - Seconds between progress reports
+        :param report_callback: Callable - Called with the statistics snapshot (Dict) at every progress report
+        :param protocol: String - URI scheme used to build the destination, e.g. "sip"
+        :param calls_per_phone: Int - How many generated calls each phone may carry at once
+        """
+        if calls_per_second <= 0:
+            raise ValueError("'calls_per_second' must be greater than 0, not {}".format(calls_per_second))
+        if total_calls is None and duration is None:
+            raise ValueError("Either 'total_calls' or 'duration' is required to end the run")
+        self.caller_pool = caller_pool
+        self.pjsip_client = caller_pool.pjsip_client
+        if isinstance(numbers_to_dial, str):
+            numbers_to_dial = [numbers_to_dial]
+        self._numbers_to_dial = itertools.cycle(numbers_to_dial)
+        self.calls_per_second = calls_per_second
+        self.hold_time = hold_time
+        self.calls_per_phone = calls_per_phone
+        self.max_concurrent_calls = max_concurrent_calls or min(len(caller_pool) * calls_per_phone,
+                                                                self.pjsip_client.max_calls)
+        self.ramp_up = ramp_up
+        self.total_calls = total_calls
+        self.duration = duration
+        self.setup_time_out = setup_time_out
+        self.report_interval = report_interval
+        self.report_callback = report_callback
+        self.protocol = protocol
+        self.statistics = LoadStatistics()
+        self._wake = threading.Condition()
+        self._changed_calls = deque()
+        self._stopping = False
+        self._thread = None
+
+    def _origination_offset(self, call_index):
+        """
+        Seconds after the start of the run at which a call attempt is due, following the linear ramp up
+        :param call_index: Int - Zero based index of the call attempt
+        :return: Float - Offset in seconds
+        """
+        if self.ramp_up and call_index < self.calls_per_second * self.ramp_up / 2.0:
+            return math.sqrt(2.0 * call_index * self.ramp_up / self.calls_per_second)
+        return call_index / float(self.calls_per_second) + self.ramp_up / 2.0
+
+    def _pick_hold_time(self):
+        """ Hold time for the next call, in seconds """
+        if isinstance(self.hold_time, (tuple, list)):
+            return random.uniform(*self.hold_time)
+        return self.hold_time
+
+    def _on_phone_state_changed(self, phone_call):
+        """
+        State listener for each caller (runs on the pjsua callback thread)
+        """
+        if phone_call is not None:
+            with self._wake:
+                self._changed_calls.append(phone_call)
+                self._wake.notify()
+
+    def _originate(self, phone, now):
+        """
+        Start a call from an idle phone
+        :return: _GeneratedCall - The call's book-keeping, or None if pjsua refused to make the call
+        """
+        self.statistics.attempts += 1
+        try:
+            phone_call = phone._start_call(next(self._numbers_to_dial), self.protocol)
+        except pj.Error as e:
+            logger.warning("[%s] Call attempt failed: %s", phone.pbx_account_name, e)
+            self.statistics.failed += 1
+            return None
+        self.statistics.active += 1
+        return _GeneratedCall(phone, phone_call, now)
+
+    def _report(self):
+        """ Log (and hand to the report callback) the current statistics """
+        snapshot = self.statistics.snapshot()
+        percentiles = snapshot["setup_time_percentiles"]
+        logger.info("Load: {attempts} attempts, {answered} answered, {failed} failed, {active} active, "
+                    "{achieved_cps:.2f} CPS, ASR {answer_seizure_ratio:.1%}".format(**snapshot) +
+                    ", setup time p50/p95/p99 {} seconds".format(
+                        "/".join("-" if percentiles[p] is None else "{:.3f}".format(percentiles[p])
+                                 for p in (50, 95, 99))))
+        if self.report_callback:
+            self.report_callback(snapshot)
+
+    def run(self):
+        """
+        Generate the load, returning once origination has finished and every generated call has ended
+        :return: LoadStatistics - The statistics of the run
+        """
+        self.pjsip_client.register_thread()
+        phones = self.caller_pool.registered_phones
+        if not phones:
+            raise ValueError("None of the phones in the caller pool are registered")
+        for phone in phones:
+            phone.add_state_listener(self._on_phone_state_changed)
+        try:
+            self._run(phones)
+        finally:
+            for phone in phones:
+                phone.remove_state_listener(self._on_phone_state_changed)
+        self.statistics.finished_at = time.monotonic()
+        self._report()
+        return self.statistics
+
+    def _run(self, phones):
+        """
+        The scheduler loop
+        :param phones: List - Registered phones to originate the calls from
+        """
+        statistics = self.statistics
+        statistics.started_at = time.monotonic()
+        idle_phones = deque(phones * self.calls_per_phone)  # one entry for each call a phone may still make
+        active = {}  # PhoneCall -> _GeneratedCall
+        setting_up = OrderedDict()  # PhoneCall -> _GeneratedCall not yet CONFIRMED, oldest (first to time out) first
+        hang_ups = []  # heap of [due, sequence, _GeneratedCall or None once the call has ended]
+        sequence = itertools.count()
+        schedule_shift = 0.0
+        next_report = statistics.started_at + self.report_interval
+        hung_up_on_stop = False
+        logger.info("Generating load of %s CPS (ramp up %s seconds, at most %s concurrent calls) from %s phones",
+                    self.calls_per_second, self.ramp_up, self.max_concurrent_calls, len(phones))
+        while True:
+            now = time.monotonic()
+            while self._changed_calls:
+                phone_call = self._changed_calls.popleft()
+                generated_call = active.get(phone_call)
+                if generated_call is None:
+                    continue
+                if generated_call.confirmed_at is None and phone_call.is_connected():
+                    generated_call.confirmed_at = now
+                    setting_up.pop(phone_call, None)
+                    statistics.answered += 1
+                    statistics.setup_times.append(now - generated_call.started_at)
+                    generated_call.hang_up_entry = [now + self._pick_hold_time(), next(sequence), generated_call]
+                    heapq.heappush(hang_ups, generated_call.hang_up_entry)
+                if phone_call.has_ended():
+                    del active[phone_call]
+                    setting_up.pop(phone_call, None)
+                    if generated_call.hang_up_entry is not None:
+                        generated_call.hang_up_entry[2] = None  # cancelled, don't keep the ended call alive
+                    idle_phones.append(generated_call.phone)
+                    statistics.active -= 1
+                    if generated_call.confirmed_at is None:
+                        statistics.failed += 1
+            while hang_ups and (hang_ups[0][0] <= now or hang_ups[0][2] is None):
+                generated_call = heapq.heappop(hang_ups)[2]
+                if generated_call is not None:
+                    generated_call.hang_up_entry = None
+                    generated_call.phone.hang_up(generated_call.phone_call)
+            while setting_up:
+                generated_call = next(iter(setting_up.values()))
+                if generated_call.started_at + self.setup_time_out > now:
+                    break
+                del setting_up[generated_call.phone_call]  # abandoned, it is counted as failed once it has ended
+                generated_call.phone.hang_up(generated_call.phone_call)
+
+            stop_originating = (self._stopping or
+                                (self.total_calls is not None and statistics.attempts >= self.total_calls) or
+                                (self.duration is not None and now - statistics.started_at >= self.duration))
+            next_origination = None
+            if not stop_originating:
+                due = statistics.started_at + schedule_shift + self._origination_offset(statistics.attempts)
+                if due <= now and idle_phones and len(active) < self.max_concurrent_calls:
+                    if now - due > 1.0 / self.calls_per_second:
+                        schedule_shift += now - due  # held back by the cap, so don't burst to catch up
+                    phone = idle_phones.popleft()
+                    generated_call = self._originate(phone, now)
+                    if generated_call:
+                        active[generated_call.phone_call] = generated_call
+                        setting_up[generated_call.phone_call] = generated_call
+                    else:
+                        idle_phones.append(phone)
+                    continue
+                if due > now:
+                    next_origination = due
+            elif not active:
+                return
+            elif self._stopping and not hung_up_on_stop:
+                hung_up_on_stop = True
+                for generated_call in list(active.values()):
+                    generated_call.phone.hang_up(generated_call.phone_call)
+            if now >= next_report:
+                self._report()
+                next_report = now + self.report_interval
+            next_hang_up = hang_ups[0][0] if hang_ups else None
+            next_setup_time_out = (next(iter(setting_up.values())).started_at + self.setup_time_out
+                                   if setting_up else None)
+            wake_at = min(t for t in (next_origination, next_hang_up, next_setup_time_out, next_report)
+                          if t is not None)
+            with self._wake:
+                if not self._changed_calls:
+                    self._wake.wait(max(0.0, wake_at - time.monotonic()))
+
+    def start(self):
+        """
+        Run the load generator in a background thread
+        """
+        self._thread = threading.Thread(target=self.run, name="load-generator")
+        self._thread.start()
+
+    def stop(self, wait=True):
+        """
+        Stop originating calls and hang up any which are in progress
+        :param wait: Boolean - Wait for the background thread to finish
+        """
+        with self._wake:
+            self._stopping = True
+            self._wake.notify()
+        if wait and self._thread:
+            self._thread.join()
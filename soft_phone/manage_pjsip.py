@@ -1,30 +1,298 @@
-import pjsua as pj
+from soft_phone.backend import get_backend
 import logging
-from .callbacks import log_cb
+import threading
+from .account_cache import AccountCache
+from .audio_players import AudioPlayerCache
+from .callbacks import log_cb, pjsip_console_level, LogRingBuffer
+from .config import MEDIA_PROFILES, MediaProfile, PJSipConfig
+from .media_stats import MediaStatsCollector
+from .resources import ResourceTracker
+from .metrics import CallbackStats, MetricsRegistry
+from .timers import TimerService
+
+pj = get_backend()
 
 logger = logging.getLogger(__name__)
 
+TRANSPORT_TYPES = {"udp": pj.TransportType.UDP, "tcp": pj.TransportType.TCP}
+
+
+def check_receive_buffer_size(receive_buffer_size):
+    """
+    Warn if the operating system gives new sockets a smaller receive buffer than wanted
+    pjsua has no per socket setting (PJSIP only sets SO_RCVBUF when built with PJSIP_UDP_SO_RCVBUF_SIZE), so its
+    sockets get the system default, net.core.rmem_default on Linux.
+    :param receive_buffer_size: Int - Bytes of receive buffer wanted
+    :return: Boolean - False if the default is known to be smaller
+    """
+    try:
+        with open("/proc/sys/net/core/rmem_default") as rmem_default:
+            default_size = int(rmem_default.read())
+    except (OSError, ValueError):
+        logger.debug("The default socket receive buffer size can't be read, assuming it is large enough")
+        return True
+    if default_size < receive_buffer_size:
+        logger.warning("Sockets get a %s byte receive buffer, less than the %s wanted, SIP packets may be dropped "
+                       "under load (raise it with: sysctl -w net.core.rmem_max=%s net.core.rmem_default=%s)",
+                       default_size, receive_buffer_size, receive_buffer_size, receive_buffer_size)
+        return False
+    return True
+
 
 class PJSipClient:
     """
     Manage the PJSip instance
+
+    'start' and 'stop' may be called any number of times: stopping destroys the pjsua library and starting again
+    creates it afresh with the same configuration (Soft Phones created before a restart can't be used after it).
+    PJSipClient.instance() gives the process wide client, for test sessions to share.
     """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_calls=None, max_media_ports=None, log_level=6, log_file="/tmp/pjsip.log",
+                 console_log_level=None, log_callback=log_cb, log_ring_buffer_size=None,
+                 log_ring_buffer_file="/tmp/pjsip_failed_calls.log", audio_player_cache_size=8, config=None,
+                 callback_stall_threshold=0.05, cdr_writer=None, account_cache_size=0, account_cache_ttl=300,
+                 media_stats_interval=None, media_profile=None, resource_sample_interval=1000,
+                 tracemalloc_interval=None):
+        """
+        :param max_calls: Int - The maximum number of concurrent calls pjsua will allow (pjsua's default is 4, and it
+                          can never exceed the PJSUA_MAX_CALLS pjsua was compiled with, 32 unless it was rebuilt)
+        :param max_media_ports: Int - Size of the conference bridge, every connected call and audio player needs a port
+        :param log_level: Int - PJSIP log verbosity (0-6) for 'log_file' and the ring buffer
+        :param log_file: String - File PJSIP writes its log to (None for no log file)
+        :param console_log_level: Int - Most verbose PJSIP level handed to 'log_callback' (defaults to only what
+                                  'log_cb' would actually log given the current logging configuration)
+        :param log_callback: Callable - Receives PJSIP log lines, None to let PJSIP write to the console itself
+        :param log_ring_buffer_size: Int - Keep this many of the most recent 'log_level' lines in memory and only write
+                                     them to 'log_ring_buffer_file' when a call fails (None to disable)
+        :param log_ring_buffer_file: String - File the ring buffer is flushed to
+        :param audio_player_cache_size: Int - How many audio players no call is using are kept ready for reuse
+        :param config: PJSipConfig - Transports and threading (defaults to one UDP transport on any free port)
+        :param callback_stall_threshold: Float - Seconds a pjsua callback may take before it is logged as a stall
+        :param cdr_writer: CDRWriter - Writes a call detail record for every call which ends, closed by 'stop'
+        :param account_cache_size: Int - How many registered accounts to keep for reuse once their phones are
+                                   unregistered, so the next phone with the same account needn't REGISTER (0 for none)
+        :param account_cache_ttl: Number - Seconds a cached account may wait unused before it is unregistered
+        :param media_stats_interval: Number - Sample the jitter, packet loss, round trip time and bitrate of every
+                                     call with active media this often (in seconds), and estimate its MOS (None to
+                                     collect no media statistics)
+        :param media_profile: MediaProfile or String - Codecs, ptime, VAD, echo cancellation and conference bridge
+                              settings, or the name of one of MEDIA_PROFILES ("default", "low_cpu" or
+                              "signalling_only"), 'max_media_ports' and the config's 'clock_rate' take precedence
+        :param resource_sample_interval: Int - Sample the live accounts, calls, players, recorders and conference
+                                         ports every this many call cycles, to find leaks (None for never)
+        :param tracemalloc_interval: Int - Also snapshot the Python memory with tracemalloc every this many call
+                                     cycles (None to not trace it, tracing slows every allocation down)
+        """
+        self.config = config or PJSipConfig()
+        if isinstance(media_profile, str):
+            if media_profile not in MEDIA_PROFILES:
+                raise ValueError("Unknown media profile '{}', choose from {}".format(media_profile,
+                                                                                   sorted(MEDIA_PROFILES)))
+            media_profile = MEDIA_PROFILES[media_profile]
+        self.media_profile = media_profile or MediaProfile()
+        ua_cfg = pj.UAConfig()
+        if max_calls:
+            ua_cfg.max_calls = max_calls
+        ua_cfg.thread_cnt = self.config.sip_threads
+        media_cfg = pj.MediaConfig()
+        self.media_profile.apply_media_config(media_cfg)
+        if max_media_ports:
+            media_cfg.max_media_ports = max_media_ports
+        if self.config.clock_rate:
+            media_cfg.clock_rate = self.config.clock_rate
+        if self.config.media_threads:
+            if hasattr(media_cfg, "thread_cnt"):
+                media_cfg.thread_cnt = self.config.media_threads
+            else:
+                logger.warning("This pjsua build has no media thread count setting, ignoring media_threads=%s",
+                               self.config.media_threads)
+        if self.config.receive_buffer_size:
+            check_receive_buffer_size(self.config.receive_buffer_size)
+        self.max_calls = ua_cfg.max_calls
+        self.max_media_ports = media_cfg.max_media_ports
+        if console_log_level is None:
+            console_log_level = pjsip_console_level() if log_callback is log_cb else log_level
+        self.log_ring_buffer = None
+        if log_ring_buffer_size:
+            self.log_ring_buffer = LogRingBuffer(log_ring_buffer_file, log_ring_buffer_size, callback=log_callback,
+                                                 callback_level=console_log_level)
+            log_callback, console_log_level = self.log_ring_buffer, log_level
+        if not log_file and not self.log_ring_buffer:
+            log_level = console_log_level  # nothing wants the more verbose lines, so PJSIP need not format them
+        log_cfg = pj.LogConfig(level=log_level, filename=log_file or "", callback=log_callback,
+                               console_level=console_log_level)
+        self._lib_configs = ua_cfg, log_cfg, media_cfg
+        self._audio_player_cache_size = audio_player_cache_size
+        self._lifecycle_lock = threading.RLock()
+        self._started = False
+        self.metrics = MetricsRegistry()  # timing metrics of every Soft Phone using this instance
+        self.callback_stats = CallbackStats(callback_stall_threshold)
+        self.cdr_writer = cdr_writer
+        self.account_cache = AccountCache(self, account_cache_size, account_cache_ttl) if account_cache_size else None
+        if media_stats_interval and self.signalling_only:
+            logger.warning("The media profile is signalling only, so no media statistics will be collected")
+            media_stats_interval = None
+        self.media_stats = MediaStatsCollector(self, media_stats_interval) if media_stats_interval else None
+        self.resources = ResourceTracker(self, resource_sample_interval, tracemalloc_interval=tracemalloc_interval)
+        self.lib = None
+        self._initialise()
 
-    def __init__(self):
+    @classmethod
+    def instance(cls, **kwargs):
+        """
+        The process wide client, created (with 'kwargs') and started on first use, and started again if it has been
+        stopped since
+        :param kwargs: The PJSipClient arguments, only used when the client is created
+        :return: PJSipClient - The started client
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(**kwargs)
+            elif kwargs:
+                logger.debug("The shared PJSipClient already exists, ignoring %s", sorted(kwargs))
+            client = cls._instance
+        client.start()
+        return client
+
+    def _initialise(self):
+        """
+        Create and initialise the pjsua library, its transports and the services built on it
+        """
+        ua_cfg, log_cfg, media_cfg = self._lib_configs
         self.lib = pj.Lib()  # Create library instance
-        self.lib.init(log_cfg=pj.LogConfig(level=6, callback=log_cb,
-                                           filename="/tmp/pjsip.log"))  # Init library with default config
-        self.lib.create_transport(pj.TransportType.UDP)  # Create UDP transport which listens to any available port
+        self.lib.init(ua_cfg=ua_cfg, log_cfg=log_cfg, media_cfg=media_cfg)  # Init library with the configured options
+        self.codecs = self.media_profile.apply_codec_priorities(self.lib)
+        if self.codecs:
+            logger.info("Offering the codecs %s", ", ".join(self.codecs))
+        self.transports = [self._create_transport(settings) for settings in self.config.transports]
+        self._next_transport = 0
         self.lib.set_null_snd_dev()  # disable the sound card
+        self.audio_players = AudioPlayerCache(self.lib, self._audio_player_cache_size)
+        self.timers = TimerService(on_thread_start=self.register_thread)  # delayed actions, e.g. answering calls
+        self._registered_threads = threading.local()
+        self._registered_threads.registered = True  # the thread which initialised the library is already known
 
-    def start(self):
-        """ Startup the PJSIP instance ready for use """
-        logger.debug("Starting the PJSIP instance")
+    def _create_transport(self, settings):
+        """
+        Create a SIP transport, on the first free port of its range
+        :param settings: TransportSettings - The transport to create
+        :return: pjsua Transport - The transport
+        """
+        error = None
+        for port in settings.ports():
+            try:
+                transport = self.lib.create_transport(
+                    TRANSPORT_TYPES[settings.type],
+                    pj.TransportConfig(port=port, bound_addr=settings.bound_address,
+                                       public_addr=settings.public_address))
+            except pj.Error as e:
+                error = e
+                logger.debug("Can't create the %s transport on port %s: %s", settings.type, port, e)
+                continue
+            logger.info("Created %s transport on %s:%s", settings.type, transport.info().host, transport.info().port)
+            return transport
+        raise error
 
-        self.lib.start()  # Start the library
+    def get_transport(self, transport=None):
+        """
+        Resolve which transport an account is bound to
+        :param transport: Int, String or pjsua Transport - Index into 'transports', the transport itself, or
+                          "round_robin" for the next transport in turn (None to let pjsua choose)
+        :return: pjsua Transport - The transport, or None to let pjsua choose
+        """
+        if transport is None or isinstance(transport, pj.Transport):
+            return transport
+        if transport == "round_robin":
+            transport, self._next_transport = self._next_transport, (self._next_transport + 1) % len(self.transports)
+        elif isinstance(transport, bool) or not isinstance(transport, int):
+            raise ValueError("'transport' must be an index into the transports, a pjsua Transport, \"round_robin\" or "
+                             "None, not {!r}".format(transport))
+        if not -len(self.transports) <= transport < len(self.transports):
+            raise ValueError("There is no transport {} (the PJSipClient has {})".format(
+                transport, len(self.transports)))
+        return self.transports[transport]
+
+    @property
+    def signalling_only(self):
+        """ The media profile leaves the media of every call alone (no playback, recording or media statistics) """
+        return self.media_profile.signalling_only
+
+    @property
+    def started(self):
+        """ The PJSIP instance has been started (and not stopped since) """
+        return self._started
+
+    def start(self):
+        """ Startup the PJSIP instance ready for use (nothing is done if it already is) """
+        with self._lifecycle_lock:
+            if self._started:
+                return
+            if self.lib is None:  # stopped before, so start afresh
+                self._initialise()
+            logger.debug("Starting the PJSIP instance")
+            self.lib.start()  # Start the library
+            self.resources.start()
+            self._started = True
         logger.debug("PJSIP instance successfully started")
 
     def stop(self):
-        logger.debug("Preparing to destroy PJSip")
-        self.lib.destroy()
+        """ Destroy the PJSIP instance (nothing is done if it already has been), 'start' creates it again """
+        with self._lifecycle_lock:
+            if self.lib is None:
+                return
+            logger.debug("Preparing to destroy PJSip")
+            if self.account_cache:
+                self.account_cache.clear()
+            if self.media_stats is not None:
+                self.media_stats.clear()
+            self.timers.stop()
+            self.audio_players.clear()
+            self.lib.destroy()
+            self.lib = None
+            self.resources.stop()  # pjsua has destroyed whatever was left
+            self._started = False
+            if self.cdr_writer:  # after pjsua, so the calls it disconnected have their records written too
+                self.cdr_writer.close()
+                self.cdr_writer = None  # it can't be reopened, a restarted client needs a new one
         logger.info("PJSip instance has been destroyed")
+
+    def _on_call_failed(self, phone_call):
+        """
+        A call failed to connect (called from the pjsua callback thread), write out the buffered PJSIP log if any
+        :param phone_call: PhoneCall - The call which failed
+        """
+        if self.log_ring_buffer:
+            self.log_ring_buffer.flush("[{}] Call {} failed with SIP status {}".format(
+                phone_call.sip_phone.pbx_account_name, phone_call.call_id, phone_call.last_code))
+
+    def register_thread(self, name=None):
+        """
+        Register the calling thread with PJSip, so that it may call into pjsua (only done once per thread)
+        :param name: String - Name to register the thread under, defaults to the Python thread name
+        """
+        if not getattr(self._registered_threads, "registered", False):
+            self.lib.thread_register(name or threading.current_thread().name)
+            self._registered_threads.registered = True
+
+    def __enter__(self):
+        """ Start the PJSIP instance and register the calling thread with it """
+        self.start()
+        self.register_thread()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """ Destroy the PJSIP instance when leaving the 'with' block """
+        self.stop()
+
+    async def __aenter__(self):
+        """ Start the PJSIP instance and register the event loop's thread with it """
+        self.start()
+        self.register_thread()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        """ Destroy the PJSIP instance when leaving the 'async with' block """
+        self.stop()
@@ -0,0 +1,313 @@
+from soft_phone.backend import get_backend
+import logging
+import math
+import re
+import threading
+import time
+from collections import deque
+
+pj = get_backend()
+
+logger = logging.getLogger(__name__)
+
+MEDIA_STATS_FIELDS = ("mos", "mos_min", "rx_packets", "rx_loss_percent", "rx_jitter_ms", "rx_jitter_max_ms",
+                      "rtt_ms", "rtt_max_ms", "rx_kbps", "tx_kbps")
+
+# E-model equipment impairment (Ie) and packet loss robustness (Bpl) of each codec, from ITU-T G.113 Appendix I,
+# codecs which aren't listed are scored as G.711
+CODEC_IMPAIRMENTS = {"PCMU": (0.0, 25.1), "PCMA": (0.0, 25.1), "G729": (11.0, 19.0)}
+
+_CODEC = re.compile(r"#\d+ audio (\S+)")
+_TOTAL = re.compile(r"total (\d+)pkt .*?@avg=([\d.]+)([KM]?)bps")
+_LOSS = re.compile(r"pkt loss=(\d+) \(([\d.]+)%\)(?:, discrd=(\d+))?")
+_SUMMARY = r"{}\s*:\s*([\d.]+)\s+([\d.]+)\s+([\d.]+)\s+([\d.]+)"  # min avg max last (msec)
+_JITTER = re.compile(_SUMMARY.format("jitter"))
+_RTT = re.compile(_SUMMARY.format("RTT msec"))
+_BITRATE_UNITS = {"": 0.001, "K": 1.0, "M": 1000.0}
+MIN_SCORED_PACKETS = 50  # a MOS is only estimated over at least this many packets (a second of 20ms frames)
+
+
+def _direction(section):
+    """
+    :param section: String - The RX or TX part of a stream's statistics
+    :return: Dict - Its packet count, bitrate, losses and jitter (only those found)
+    """
+    stats = {}
+    match = _TOTAL.search(section)
+    if match:
+        stats["packets"] = int(match.group(1))
+        stats["kbps"] = float(match.group(2)) * _BITRATE_UNITS[match.group(3)]
+    match = _LOSS.search(section)
+    if match:
+        stats["lost"] = int(match.group(1))
+        stats["discarded"] = int(match.group(3) or 0)
+    match = _JITTER.search(section)
+    if match:
+        stats["jitter_avg_ms"], stats["jitter_max_ms"], stats["jitter_last_ms"] = (
+            float(match.group(2)), float(match.group(3)), float(match.group(4)))
+    return stats
+
+
+def parse_dump_status(dump):
+    """
+    Pick the statistics of a call's first audio stream out of pjsua's call dump (Call.dump_status)
+    :param dump: String - The dump, with media
+    :return: Dict - "codec", "rx" and "tx" (dicts of "packets", "kbps", "lost", "discarded", "jitter_avg_ms",
+             "jitter_max_ms" and "jitter_last_ms", as far as they were found) and "rtt_ms" (avg, max, last) if the
+             peer has sent RTCP, None if the call has no audio stream
+    """
+    match = _CODEC.search(dump)
+    if not match:
+        return None
+    stream = dump[match.end():]
+    next_stream = stream.find("\n    #")
+    if next_stream >= 0:
+        stream = stream[:next_stream]
+    rx_start, tx_start = stream.find("RX "), stream.find("TX ")
+    if rx_start < 0 or tx_start < rx_start:
+        return None
+    stats = {"codec": match.group(1), "rx": _direction(stream[rx_start:tx_start]),
+             "tx": _direction(stream[tx_start:])}
+    match = _RTT.search(stream, tx_start)
+    if match:
+        stats["rtt_ms"] = float(match.group(2)), float(match.group(3)), float(match.group(4))
+    return stats
+
+
+def estimate_mos(rtt_ms, jitter_ms, loss_percent, codec=None):
+    """
+    Estimate the listening quality of a call with the ITU-T G.107 E-model, reduced to the delay and packet loss
+    impairments (as in Cole & Rosenbluth, "Voice over IP Performance Monitoring")
+    :param rtt_ms: Float - Round trip time (None if unknown, taken as 0)
+    :param jitter_ms: Float - Mean interarrival jitter, the jitter buffer is assumed to add twice this to the delay
+    :param loss_percent: Float - Packets lost or discarded as too late, as a percentage
+    :param codec: String - Codec name, e.g. "PCMU" (see CODEC_IMPAIRMENTS)
+    :return: Float - Mean Opinion Score, from 1 (bad) to 4.5 (the best narrowband speech can score)
+    """
+    impairment, robustness = CODEC_IMPAIRMENTS.get((codec or "").upper(), CODEC_IMPAIRMENTS["PCMU"])
+    delay = (rtt_ms or 0.0) / 2 + 2 * jitter_ms + 10  # one way: network, jitter buffer and packetisation
+    delay_impairment = 0.024 * delay + (0.11 * (delay - 177.3) if delay > 177.3 else 0.0)
+    loss_impairment = impairment + (95 - impairment) * loss_percent / (loss_percent + robustness)
+    rating = 93.2 - delay_impairment - loss_impairment
+    if rating <= 0:
+        return 1.0
+    if rating >= 100:
+        return 4.5
+    return 1 + 0.035 * rating + 7e-6 * rating * (rating - 60) * (100 - rating)
+
+
+class CallMediaStats:
+    """
+    Running aggregates of the media statistics of one call
+
+    pjsua's counters run from the start of the call, so the loss each MOS is estimated from is the change since
+    the last estimate (once at least MIN_SCORED_PACKETS more have been expected), and only sums and extremes are
+    kept: the record is the same size however long the call lasts.
+    """
+    __slots__ = ("codec", "samples", "sampled_at", "rx_packets", "rx_lost", "scored_packets", "scored_lost",
+                 "tx_packets", "rx_kbps", "tx_kbps", "jitter_ms", "jitter_max_ms", "rtt_ms", "rtt_max_ms", "scores",
+                 "mos_sum", "mos_min", "mos_last")
+
+    def __init__(self):
+        self.codec = None
+        self.samples = 0
+        self.sampled_at = None
+        self.rx_packets = 0
+        self.rx_lost = 0  # lost and discarded
+        self.scored_packets = 0  # rx_packets and rx_lost as of the last MOS estimate
+        self.scored_lost = 0
+        self.tx_packets = 0
+        self.rx_kbps = None
+        self.tx_kbps = None
+        self.jitter_ms = None  # pjsua's mean over the call
+        self.jitter_max_ms = None
+        self.rtt_ms = None
+        self.rtt_max_ms = None
+        self.scores = 0
+        self.mos_sum = 0.0
+        self.mos_min = None
+        self.mos_last = None
+
+    def __repr__(self):
+        return "<CallMediaStats samples={} mos={} rx_loss_percent={}>".format(self.samples, self.mos,
+                                                                               self.rx_loss_percent)
+
+    def update(self, stats, now=None):
+        """
+        Add a sample
+        :param stats: Dict - Statistics of the call's audio stream, as returned by parse_dump_status
+        :param now: Float - time.monotonic() at which it was taken
+        """
+        rx, tx = stats["rx"], stats["tx"]
+        self.codec = stats["codec"]
+        self.rx_packets = max(rx.get("packets", 0), self.rx_packets)
+        self.rx_lost = max(rx.get("lost", 0) + rx.get("discarded", 0), self.rx_lost)
+        self.tx_packets = tx.get("packets", self.tx_packets)
+        self.rx_kbps, self.tx_kbps = rx.get("kbps", self.rx_kbps), tx.get("kbps", self.tx_kbps)
+        if "jitter_avg_ms" in rx:
+            self.jitter_ms = rx["jitter_avg_ms"]
+            self.jitter_max_ms = max(self.jitter_max_ms or 0.0, rx["jitter_max_ms"])
+        if "rtt_ms" in stats:
+            self.rtt_ms, rtt_max, _ = stats["rtt_ms"]
+            self.rtt_max_ms = max(self.rtt_max_ms or 0.0, rtt_max)
+        self.samples += 1
+        self.sampled_at = now
+        received, lost = self.rx_packets - self.scored_packets, self.rx_lost - self.scored_lost
+        if received + lost < MIN_SCORED_PACKETS:
+            return  # too few packets since the last estimate for its loss rate to mean much
+        self.scored_packets, self.scored_lost = self.rx_packets, self.rx_lost
+        mos = estimate_mos(self.rtt_ms, rx.get("jitter_last_ms", self.jitter_ms or 0.0),
+                           100.0 * lost / (received + lost), self.codec)
+        self.scores += 1
+        self.mos_sum += mos
+        self.mos_min = mos if self.mos_min is None else min(self.mos_min, mos)
+        self.mos_last = mos
+
+    @property
+    def mos(self):
+        """ Mean of the MOS estimates, or one over the whole call if it was too short for any (None if no media) """
+        if self.scores:
+            return self.mos_sum / self.scores
+        if not self.rx_packets:
+            return None
+        return estimate_mos(self.rtt_ms, self.jitter_ms or 0.0, self.rx_loss_percent, self.codec)
+
+    @property
+    def rx_loss_percent(self):
+        """ Percentage of the packets sent to the phone which were lost or discarded, over the whole call """
+        expected = self.rx_packets + self.rx_lost
+        return 100.0 * self.rx_lost / expected if expected else None
+
+    def as_dict(self):
+        """
+        :return: Dict - The aggregates named by MEDIA_STATS_FIELDS, rounded (None where nothing was measured)
+        """
+        mos = self.mos
+        values = (mos, self.mos_min if self.scores else mos, self.rx_packets, self.rx_loss_percent, self.jitter_ms,
+                  self.jitter_max_ms, self.rtt_ms, self.rtt_max_ms, self.rx_kbps, self.tx_kbps)
+        return {name: round(value, 3) if isinstance(value, float) else value
+                for name, value in zip(MEDIA_STATS_FIELDS, values)}
+
+
+class MediaStatsCollector:
+    """
+    Samples the media statistics of every call with ACTIVE media, on the PJSipClient's timer thread
+
+    Rather than each call having a polling thread, one periodic timer walks the active calls round robin, sampling
+    just enough of them on each tick for every call to be sampled once per 'interval': the pjsua lock is only ever
+    held for one call's dump at a time, and the cost is spread evenly whatever the number of calls. Each sample is
+    added to the call's CallMediaStats ('PhoneCall.media_stats').
+    """
+
+    def __init__(self, pjsip_client, interval=5.0, tick=0.1):
+        """
+        :param pjsip_client: PJSipClient - The client whose calls are sampled
+        :param interval: Number - Seconds between samples of the same call
+        :param tick: Number - Seconds between the collector's timer runs, over which each interval is spread
+        """
+        self.pjsip_client = pjsip_client
+        self.interval = interval
+        self.tick = min(tick, interval)
+        self.samples = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._calls = deque()  # the calls still to sample in this round
+        self._active = set()
+        self._round_started = None  # time.monotonic() at which the current round began
+        self._timer = None
+
+    def __len__(self):
+        return len(self._active)
+
+    def attach(self, phone_call):
+        """
+        Start sampling a call (its media has just become ACTIVE)
+        :param phone_call: PhoneCall - The call
+        """
+        with self._lock:
+            if phone_call.media_stats is None:
+                phone_call.media_stats = CallMediaStats()
+            if phone_call in self._active:
+                return  # e.g. its media has been re-negotiated
+            self._active.add(phone_call)
+            self._calls.append(phone_call)
+            if self._timer is None:  # the first call of a round
+                self._timer = self.pjsip_client.timers.schedule(self.tick, self._run)
+                self._round_started = time.monotonic()
+
+    def detach(self, phone_call):
+        """
+        Stop sampling a call (it has ended), it is dropped from the round when next reached
+        :param phone_call: PhoneCall - The call
+        """
+        with self._lock:
+            self._active.discard(phone_call)
+
+    def sample(self, phone_call):
+        """
+        Take a sample of a call's media statistics now, e.g. just before hanging it up
+        :param phone_call: PhoneCall - The call (ignored unless its media is being sampled)
+        :return: Boolean - A sample was taken
+        """
+        if phone_call.media_stats is None or phone_call.has_ended():
+            return False
+        try:
+            stats = parse_dump_status(phone_call.call.dump_status(True, "", 4096))
+        except pj.Error as e:
+            self.errors += 1
+            logger.debug("[%s] Unable to read the media statistics of call %s: %s",
+                         phone_call.sip_phone.pbx_account_name, phone_call.call_id, e)
+            return False
+        if stats is None:
+            return False
+        with self._lock:
+            phone_call.media_stats.update(stats, time.monotonic())
+            self.samples += 1
+        return True
+
+    def _run(self):
+        """
+        Sample this tick's share of the calls, then schedule the next tick (runs on the timer thread)
+        """
+        now = time.monotonic()
+        with self._lock:
+            if not self._calls and now - self._round_started >= self.interval:
+                self._calls.extend(self._active)  # start the next round, once an interval after the last
+                self._round_started = now
+            due = []
+            for _ in range(math.ceil(len(self._active) * self.tick / self.interval)):
+                if not self._calls:
+                    break
+                phone_call = self._calls.popleft()
+                if phone_call in self._active:
+                    due.append(phone_call)
+            if not self._active and not self._calls:
+                self._timer = None  # idle until a call is attached
+                return
+        for phone_call in due:
+            self.sample(phone_call)
+        with self._lock:
+            if self._timer is None:
+                return  # cleared whilst sampling
+            try:
+                self._timer = self.pjsip_client.timers.schedule(self.tick, self._run)
+            except RuntimeError:
+                self._timer = None  # the client is being stopped
+
+    def clear(self):
+        """
+        Stop sampling every call, e.g. as the client is stopped
+        """
+        with self._lock:
+            self._active.clear()
+            self._calls.clear()
+            timer, self._timer = self._timer, None
+            self._round_started = None
+        if timer is not None:
+            timer.cancel()
+
+    def stats(self):
+        """
+        :return: Dict - The number of calls being sampled, and the samples taken and failed so far
+        """
+        return {"calls": len(self._active), "samples": self.samples, "errors": self.errors}
@@ -0,0 +1,338 @@
+import bisect
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the histogram buckets, spanning a LAN PBX answering in milliseconds to a slow trunk
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Upper bounds (seconds) for the time taken by callbacks and event handlers, which should be well under a millisecond
+CALLBACK_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+HISTOGRAM_DESCRIPTIONS = {
+    "registration_latency": "Seconds from sending the REGISTER to receiving its 200",
+    "post_dial_delay": "Seconds from sending the INVITE to the first 180/183",
+    "setup_time": "Seconds from sending the INVITE to the call being CONFIRMED",
+    "answer_latency": "Seconds from the first 180/183 to the call being CONFIRMED",
+    "media_latency": "Seconds from the call being CONFIRMED to its media being ACTIVE",
+    "teardown_time": "Seconds from sending the BYE to the call being DISCONNECTED",
+    "dtmf_response_latency": "Seconds from sending a DTMF digit to receiving the first digit of the reply waited for",
+}
+
+COUNTER_DESCRIPTIONS = {
+    "registrations_succeeded": "REGISTERs answered with a 200",
+    "registrations_failed": "REGISTERs answered with a final failure",
+    "registrations_reused": "Registered accounts taken from the account cache instead of REGISTERing",
+    "calls_attempted": "Outgoing calls made",
+    "calls_answered": "Outgoing calls which were CONFIRMED",
+    "calls_failed": "Outgoing calls which were DISCONNECTED without being CONFIRMED",
+    "calls_received": "Incoming calls received",
+    "dtmf_digits_received": "DTMF digits received",
+}
+
+
+class Histogram:
+    """
+    Fixed bucket histogram of durations (seconds)
+
+    It has no lock of its own, each one is only written by its owner whilst holding the owner's state lock.
+    Readers merge or snapshot it without a lock, at worst seeing an observation which is only part recorded.
+    """
+    __slots__ = ("buckets", "counts", "count", "sum", "min", "max")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: Tuple - Ascending upper bounds of the buckets, an overflow bucket is added above the last
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        """
+        Record a duration
+        :param value: Float - Seconds
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Add the observations of another histogram (with the same buckets) to this one
+        :param other: Histogram - The histogram to add
+        """
+        if other.buckets != self.buckets:
+            raise ValueError("Histograms with different buckets can't be merged")
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def quantile(self, q):
+        """
+        Estimate a quantile by interpolating within its bucket
+        :param q: Float - The quantile (0-1)
+        :return: Float - Seconds, None if nothing has been observed
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                lower, upper = max(lower, self.min), min(upper, self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def snapshot(self):
+        """
+        :return: Dict - Count, sum, mean, min, max, estimated p50/p90/p99 and the (non-cumulative) bucket counts
+        """
+        return {"count": self.count, "sum": self.sum, "mean": self.sum / self.count if self.count else None,
+                "min": self.min, "max": self.max, "p50": self.quantile(0.5), "p90": self.quantile(0.9),
+                "p99": self.quantile(0.99),
+                "buckets": dict(zip([str(bound) for bound in self.buckets] + ["+Inf"], self.counts))}
+
+
+class PhoneMetrics:
+    """
+    Timing histograms and counters of one 'Soft Phone', fed from the lifecycle edges its CallStates record
+    Only written by the pjsua callback thread whilst the phone's state lock is held.
+    """
+
+    def __init__(self, pbx_account_name=None, buckets=DEFAULT_BUCKETS):
+        """
+        :param pbx_account_name: String - The phone's account
+        :param buckets: Tuple - Upper bounds of the histogram buckets
+        """
+        self.pbx_account_name = pbx_account_name
+        self.histograms = {name: Histogram(buckets) for name in HISTOGRAM_DESCRIPTIONS}
+        self.counters = dict.fromkeys(COUNTER_DESCRIPTIONS, 0)
+
+    def on_registration(self, reg_status, latency):
+        """
+        The PBX has given a final response to a REGISTER
+        :param reg_status: Int - The SIP status of the response
+        :param latency: Float - Seconds since the REGISTER was sent (None if unknown)
+        """
+        if reg_status == 200:
+            self.counters["registrations_succeeded"] += 1
+            if latency is not None:
+                self.histograms["registration_latency"].observe(latency)
+        else:
+            self.counters["registrations_failed"] += 1
+
+    def on_call_edges(self, phone_call, edges):
+        """
+        Record the durations which end at the lifecycle edges a call has just reached
+        :param phone_call: PhoneCall - The call
+        :param edges: Tuple - Names of the edges reached (see CallState.update)
+        """
+        call_state = phone_call.call_state
+        outgoing = phone_call.direction == "outgoing"
+        histograms = self.histograms
+        for edge in edges:
+            if edge == "ringing" and outgoing:
+                histograms["post_dial_delay"].observe(call_state.ringing_at - call_state.started_at)
+            elif edge == "connected":
+                if outgoing:
+                    self.counters["calls_answered"] += 1
+                    histograms["setup_time"].observe(call_state.connected_at - call_state.started_at)
+                    if call_state.ringing_at is not None:
+                        histograms["answer_latency"].observe(call_state.connected_at - call_state.ringing_at)
+            elif edge == "media_active" and call_state.connected_at is not None:
+                histograms["media_latency"].observe(call_state.media_active_at - call_state.connected_at)
+            elif edge == "ended":
+                if outgoing and call_state.connected_at is None:
+                    self.counters["calls_failed"] += 1
+                if call_state.hangup_requested_at is not None:
+                    histograms["teardown_time"].observe(call_state.ended_at - call_state.hangup_requested_at)
+
+    def on_dtmf_match(self, dtmf_match):
+        """
+        Digits waited for have arrived
+        :param dtmf_match: DTMFMatch - The digits
+        """
+        if dtmf_match.latency is not None:
+            self.histograms["dtmf_response_latency"].observe(dtmf_match.latency)
+
+    def merge(self, other):
+        """
+        Add the counts and observations of another phone's metrics (with the same buckets) to these
+        :param other: PhoneMetrics - The metrics to add
+        """
+        for name, count in list(other.counters.items()):
+            self.counters[name] += count
+        for name, histogram in other.histograms.items():
+            self.histograms[name].merge(histogram)
+
+    def snapshot(self):
+        """
+        :return: Dict - The counters and a snapshot of each histogram
+        """
+        snapshot = dict(self.counters)
+        snapshot.update((name, histogram.snapshot()) for name, histogram in self.histograms.items())
+        return snapshot
+
+
+class MetricsRegistry:
+    """
+    The PhoneMetrics of every 'Soft Phone' using a PJSipClient, aggregated on demand for export
+
+    The metrics of phones which have been unregistered are removed and folded into 'retired', so the registry
+    doesn't grow with every phone ever created whilst the aggregated totals never go backwards.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: Tuple - Upper bounds of the histogram buckets of every phone
+        """
+        self.buckets = tuple(buckets)
+        self.phone_metrics = []
+        self.retired = PhoneMetrics("retired", self.buckets)  # the sum of the metrics removed
+        self._lock = threading.Lock()  # phones are added and removed from any thread
+
+    def add(self, phone_metrics):
+        """
+        Include a phone's metrics (as it creates its account), or metrics gathered elsewhere (e.g. a PhoneFleet
+        worker's aggregate), in the aggregates
+        :param phone_metrics: PhoneMetrics - Metrics with the same buckets as the registry
+        :return: PhoneMetrics - The metrics added
+        """
+        with self._lock:
+            if not any(added is phone_metrics for added in self.phone_metrics):
+                # copied, so readers can iterate without a lock
+                self.phone_metrics = self.phone_metrics + [phone_metrics]
+        return phone_metrics
+
+    def remove(self, phone_metrics):
+        """
+        Stop reporting a phone's metrics on their own, e.g. as it is unregistered, adding them to 'retired'
+        :param phone_metrics: PhoneMetrics - Metrics added to the registry
+        :return: Boolean - True if they were in the registry
+        """
+        with self._lock:
+            remaining = [added for added in self.phone_metrics if added is not phone_metrics]
+            if len(remaining) == len(self.phone_metrics):
+                return False
+            self.retired.merge(phone_metrics)
+            self.phone_metrics = remaining
+        return True
+
+    def aggregate(self):
+        """
+        :return: PhoneMetrics - The sum of every phone's metrics, including those retired
+        """
+        total = PhoneMetrics(buckets=self.buckets)
+        with self._lock:  # so metrics being retired are counted exactly once
+            total.merge(self.retired)
+            phone_metrics = self.phone_metrics
+        for metrics in phone_metrics:
+            total.merge(metrics)
+        return total
+
+    def snapshot(self, per_phone=False):
+        """
+        :param per_phone: Boolean - Also include each phone's own metrics, by account
+        :return: Dict - The aggregated counters and histogram snapshots
+        """
+        snapshot = self.aggregate().snapshot()
+        if per_phone:
+            snapshot["phones"] = {phone_metrics.pbx_account_name: phone_metrics.snapshot()
+                                  for phone_metrics in self.phone_metrics}
+        return snapshot
+
+    def to_json(self, per_phone=False, **json_kwargs):
+        """
+        :param per_phone: Boolean - Also include each phone's own metrics, by account
+        :param json_kwargs: Passed to json.dumps, e.g. indent
+        :return: String - The snapshot as JSON
+        """
+        return json.dumps(self.snapshot(per_phone), **json_kwargs)
+
+    def to_prometheus(self, prefix="soft_phone"):
+        """
+        Render the aggregated metrics in the Prometheus text exposition format
+        :param prefix: String - Prefix of every metric name
+        :return: String - The exposition text
+        """
+        total = self.aggregate()
+        lines = []
+        for name, description in COUNTER_DESCRIPTIONS.items():
+            metric = "{}_{}_total".format(prefix, name)
+            lines += ["# HELP {} {}".format(metric, description), "# TYPE {} counter".format(metric),
+                      "{} {}".format(metric, total.counters[name])]
+        for name, description in HISTOGRAM_DESCRIPTIONS.items():
+            histogram = total.histograms[name]
+            metric = "{}_{}_seconds".format(prefix, name)
+            lines += ["# HELP {} {}".format(metric, description), "# TYPE {} histogram".format(metric)]
+            cumulative = 0
+            for bound, count in zip([repr(bound) for bound in histogram.buckets] + ["+Inf"], histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{{le="{}"}} {}'.format(metric, bound, cumulative))
+            lines += ["{}_sum {!r}".format(metric, histogram.sum), "{}_count {}".format(metric, histogram.count)]
+        return "\n".join(lines) + "\n"
+
+
+class CallbackStats:
+    """
+    Time spent in each kind of pjsua callback (including the state listeners it runs)
+    Whilst a callback runs every other SIP event of the process waits, so any which take longer than
+    'stall_threshold' are counted and logged as stalls.
+    """
+
+    def __init__(self, stall_threshold=0.05, buckets=CALLBACK_BUCKETS):
+        """
+        :param stall_threshold: Float - Seconds a callback may take before it is reported as stalling the SIP stack
+        :param buckets: Tuple - Upper bounds of the histogram buckets
+        """
+        self.stall_threshold = stall_threshold
+        self.buckets = tuple(buckets)
+        self.histograms = {}  # callback name -> Histogram
+        self.stalls = 0
+        self._lock = threading.Lock()  # pjsua may run callbacks on several worker threads
+
+    def observe(self, callback_name, duration, pbx_account_name=None):
+        """
+        Record how long a callback took
+        :param callback_name: String - e.g. "on_state"
+        :param duration: Float - Seconds
+        :param pbx_account_name: String - The phone the callback was for
+        """
+        with self._lock:
+            histogram = self.histograms.get(callback_name)
+            if histogram is None:
+                histogram = self.histograms[callback_name] = Histogram(self.buckets)
+            histogram.observe(duration)
+            stalled = duration >= self.stall_threshold
+            if stalled:
+                self.stalls += 1
+        if stalled:
+            logger.warning("[%s] pjsua callback '%s' took %.1f ms, holding up every other SIP event",
+                           pbx_account_name, callback_name, duration * 1000)
+
+    def snapshot(self):
+        """
+        :return: Dict - The number of stalls and a snapshot of the durations of each kind of callback
+        """
+        with self._lock:
+            snapshot = {name: histogram.snapshot() for name, histogram in self.histograms.items()}
+            snapshot["stalls"] = self.stalls
+        return snapshot
@@ -0,0 +1,170 @@
+from soft_phone.backend import get_backend
+import time
+from soft_phone.dtmf import DTMFLog
+
+pj = get_backend()
+
+
+class CallState:
+    """
+    Snapshot of a call's state, kept current by the call's pjsua callbacks
+
+    Reading it never calls into pjsua (so never contends for the pjsua lock with the media threads), and the call
+    durations are worked out from monotonic timestamps rather than pjsua's whole second 'call_time'/'total_time'.
+    Each lifecycle edge (INVITE sent, first provisional, 180/183, CONFIRMED, media ACTIVE, BYE sent and
+    DISCONNECTED) is timestamped the first time it is seen.
+    """
+    __slots__ = ("state", "media_state", "conf_slot", "last_code", "started_at", "first_provisional_at",
+                 "ringing_at", "connected_at", "media_active_at", "hangup_requested_at", "ended_at")
+
+    def __init__(self, started_at=None):
+        """
+        :param started_at: Float - time.monotonic() at which the call was made (INVITE sent) or received
+        """
+        self.state = pj.CallState.NULL
+        self.media_state = pj.MediaState.NULL
+        self.conf_slot = -1
+        self.last_code = 0
+        self.started_at = time.monotonic() if started_at is None else started_at
+        self.first_provisional_at = None
+        self.ringing_at = None
+        self.connected_at = None
+        self.media_active_at = None
+        self.hangup_requested_at = None
+        self.ended_at = None
+
+    def __repr__(self):
+        return "<CallState state={} media_state={} conf_slot={} last_code={}>".format(
+            self.state, self.media_state, self.conf_slot, self.last_code)
+
+    def update(self, call_info, now=None):
+        """
+        Record the call information captured by a pjsua callback
+        :param call_info: pjsua CallInfo - Call information captured by the callback
+        :param now: Float - time.monotonic() at which the change was seen
+        :return: Tuple - Names of the lifecycle edges reached for the first time ("provisional", "ringing",
+                 "connected", "media_active", "ended")
+        """
+        now = time.monotonic() if now is None else now
+        edges = ()
+        if 100 <= call_info.last_code < 200:
+            if self.first_provisional_at is None:
+                self.first_provisional_at = now
+                edges += ("provisional",)
+            if call_info.last_code in (180, 183) and self.ringing_at is None:
+                self.ringing_at = now
+                edges += ("ringing",)
+        if call_info.state == pj.CallState.CONFIRMED and self.connected_at is None:
+            self.connected_at = now
+            edges += ("connected",)
+        elif call_info.state == pj.CallState.DISCONNECTED and self.ended_at is None:
+            self.ended_at = now
+            edges += ("ended",)
+        self.state = call_info.state
+        self.last_code = call_info.last_code
+        return edges + self.update_media(call_info, now)
+
+    def update_media(self, call_info, now=None):
+        """
+        Record the media information captured by a pjsua media state callback
+        :param call_info: pjsua CallInfo - Call information captured by the callback
+        :param now: Float - time.monotonic() at which the change was seen
+        :return: Tuple - ("media_active",) if the media has just become ACTIVE for the first time, else empty
+        """
+        self.media_state = call_info.media_state
+        self.conf_slot = call_info.conf_slot
+        if call_info.media_state == pj.MediaState.ACTIVE and self.media_active_at is None:
+            self.media_active_at = time.monotonic() if now is None else now
+            return ("media_active",)
+        return ()
+
+    def connected_duration(self, now=None):
+        """
+        :param now: Float - time.monotonic() to measure up to, defaults to now (or when the call ended)
+        :return: Float - Seconds the call has been (or was) connected for, 0 if it never connected
+        """
+        if self.connected_at is None:
+            return 0.0
+        return (self.ended_at or (time.monotonic() if now is None else now)) - self.connected_at
+
+    def total_duration(self, now=None):
+        """
+        :param now: Float - time.monotonic() to measure up to, defaults to now (or when the call ended)
+        :return: Float - Seconds since the call was made or received (until it ended)
+        """
+        return (self.ended_at or (time.monotonic() if now is None else now)) - self.started_at
+
+
+class PhoneCall:
+    """
+    Handle for one call carried by a 'Soft Phone'
+
+    The state is published by the call's pjsua callbacks into its CallState (under the owning Soft Phone's state
+    lock), so reading it never calls into pjsua.
+    """
+
+    def __init__(self, sip_phone, direction):
+        """
+        :param sip_phone: SoftPhone - The phone which made or received the call
+        :param direction: String - "outgoing" or "incoming"
+        """
+        self.sip_phone = sip_phone
+        self.direction = direction
+        self.call = None  # pjsua Call
+        self.call_id = None  # SIP Call-ID, the key of the phone's call registry
+        self.call_state = CallState()
+        self.call_slot_number = None
+        self.audio_player_id = None
+        self.audio_player_slot_id = None
+        self.number_dialled = None  # the number (SIP user) an outgoing call was made to
+        self.remote_uri = None  # SIP URI of the other party
+        self.dtmf_sent = ""  # every DTMF digit sent on the call
+        self.dtmf = DTMFLog()  # the DTMF digits sent and received, with their timings
+        self.dtmf_sequences = ()  # DTMFSequenceRuns still playing on the call
+        self.audio_played = []  # path of each audio file played on the call
+        self.recorder_id = None
+        self.recorder_slot_id = None
+        self.recording_path = None  # WAV file the audio received on the call is recorded to
+        self.recording_analysed = False  # handed to a RecordingAnalyser
+        self.media_stats = None  # CallMediaStats, once the PJSipClient's MediaStatsCollector samples the call
+        self.pending_actions = []  # (offset, Timer) of the actions waiting for the call to be CONFIRMED
+
+    def __repr__(self):
+        return "<PhoneCall {} {} {} state={}>".format(self.sip_phone.pbx_account_name, self.direction,
+                                                      self.call_id, self.state)
+
+    @property
+    def state(self):
+        """ pjsua CallState of the call """
+        return self.call_state.state
+
+    @property
+    def media_state(self):
+        """ pjsua MediaState of the call """
+        return self.call_state.media_state
+
+    @property
+    def last_code(self):
+        """ The last SIP status code of the call """
+        return self.call_state.last_code
+
+    @property
+    def connected_at(self):
+        """ time.monotonic() at which the call was CONFIRMED (None if it has not been) """
+        return self.call_state.connected_at
+
+    def setup_finished(self):
+        """ The call has either connected or been rejected/dropped """
+        return self.call_state.state in (pj.CallState.CONFIRMED, pj.CallState.DISCONNECTED)
+
+    def is_connected(self):
+        """ The call has been answered and is in progress """
+        return self.call_state.state == pj.CallState.CONFIRMED
+
+    def media_is_active(self):
+        """ Audio is flowing on the call """
+        return self.call_state.media_state == pj.MediaState.ACTIVE
+
+    def has_ended(self):
+        """ The call has been disconnected """
+        return self.call_state.state == pj.CallState.DISCONNECTED
@@ -0,0 +1,156 @@
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+from soft_phone.soft_phone import SoftPhone
+
+logger = logging.getLogger(__name__)
+
+RegistrationResult = namedtuple("RegistrationResult", ["pbx_account_name", "reg_status", "latency", "error"],
+                                defaults=(None,))
+RegistrationResult.__doc__ = """
+Outcome of registering one account of a pool
+:param pbx_account_name: String - The account which was registered
+:param reg_status: Int - Final SIP status of the REGISTER (0 if there was no answer, None if it was never sent)
+:param latency: Float - Seconds between sending the REGISTER and receiving the 200 (None unless registered)
+:param error: Exception - Raised creating the account, so the REGISTER was never sent (None if it was)
+"""
+
+
+class SoftPhonePool:
+    """
+    A set of 'Soft Phones' which are registered, unregistered and deleted together
+
+    REGISTERs are issued concurrently from the calling thread, with at most 'max_in_flight' outstanding at once so
+    that the PBX is not stampeded. Progress is driven by the pjsua registration callbacks, not by polling.
+    """
+
+    def __init__(self, pjsip_client, pbx_ip, accounts, pbx_password=None, max_in_flight=20, **soft_phone_kwargs):
+        """
+        :param pjsip_client: Established instance of PJSip Lib
+        :param pbx_ip: String - Address of the PBX to register with
+        :param accounts: Iterable - Account names sharing 'pbx_password' (e.g. range(1000, 1500)), or
+                         (account name, password) tuples
+        :param pbx_password: String - Password for any account not given as an (account name, password) tuple
+        :param max_in_flight: Int - The maximum number of REGISTER/unREGISTER transactions outstanding at once
+        :param soft_phone_kwargs: Passed to each SoftPhone, e.g. answer_audio, or transport="round_robin" to spread
+                                  the accounts over the PJSipClient's transports
+        """
+        if max_in_flight < 1:
+            raise ValueError("'max_in_flight' must be at least 1, not {}".format(max_in_flight))
+        self.pjsip_client = pjsip_client
+        self.max_in_flight = max_in_flight
+        self.phones = []
+        for account in accounts:
+            if isinstance(account, (tuple, list)):
+                pbx_account_name, password = account
+            else:
+                pbx_account_name, password = account, pbx_password
+            self.phones.append(SoftPhone(pjsip_client, pbx_ip, str(pbx_account_name), password, **soft_phone_kwargs))
+        self.phones_by_account = {phone.pbx_account_name: phone for phone in self.phones}
+        self.registration_results = {}
+        self._progress = threading.Condition()
+        for phone in self.phones:
+            phone.add_state_listener(self._on_phone_state_changed)
+
+    def __len__(self):
+        return len(self.phones)
+
+    def __iter__(self):
+        return iter(self.phones)
+
+    def __getitem__(self, pbx_account_name):
+        return self.phones_by_account[str(pbx_account_name)]
+
+    @property
+    def registered_phones(self):
+        """
+        :return: List - The phones whose account is currently registered
+        """
+        return [phone for phone in self.phones if phone.reg_status == 200 and phone.reg_expires != -1]
+
+    def _on_phone_state_changed(self, phone_call):
+        """
+        State listener for every phone in the pool (runs on the pjsua callback thread)
+        """
+        with self._progress:
+            self._progress.notify_all()
+
+    def _run_with_window(self, phones, start, finished, time_out):
+        """
+        Start an operation on each phone, keeping at most 'max_in_flight' unfinished at once
+        Nothing here calls into pjsua whilst holding the progress lock, as the callback thread needs it to notify.
+        :param phones: List - The phones to operate on
+        :param start: Callable - Starts the operation for a phone (non-blocking)
+        :param finished: Callable - Predicate on a phone's published state, True once its operation is complete
+        :param time_out: Number - Overall number of seconds allowed for every phone to finish
+        :return: Tuple (List of phones which finished, List of phones which did not finish in time, Dict of the
+                 exception raised starting the operation by phone, these phones are neither finished nor unfinished)
+        """
+        self.pjsip_client.register_thread()
+        deadline = time.monotonic() + time_out
+        pending = deque(phones)
+        in_flight = []
+        done = []
+        errors = {}
+        while True:
+            for phone in [phone for phone in in_flight if finished(phone)]:
+                in_flight.remove(phone)
+                done.append(phone)
+            while pending and len(in_flight) < self.max_in_flight and time.monotonic() < deadline:
+                phone = pending.popleft()
+                try:
+                    start(phone)
+                except Exception as e:  # one bad account mustn't stop the rest of the pool
+                    logger.warning("[%s] Unable to start: %s", phone.pbx_account_name, e)
+                    errors[phone] = e
+                    continue
+                in_flight.append(phone)
+            remaining = deadline - time.monotonic()
+            if not in_flight or remaining <= 0:
+                return done, in_flight + list(pending), errors
+            with self._progress:
+                if not any(finished(phone) for phone in in_flight):
+                    self._progress.wait(remaining)
+
+    def register_all(self, time_out=30):
+        """
+        Register every account in the pool with the PBX, returning once each one has succeeded or failed
+        :param time_out: Number - Overall number of seconds allowed for the whole pool to register
+        :return: Dict - RegistrationResult for each account name
+        """
+        logger.info("Registering %s phones (at most %s at once)", len(self.phones), self.max_in_flight)
+        start_time = time.monotonic()
+        finished, unfinished, errors = self._run_with_window(
+            self.phones, SoftPhone._create_and_register_account_with_pbx, SoftPhone._registration_finished, time_out)
+        for phone in self.phones:
+            self.registration_results[phone.pbx_account_name] = RegistrationResult(
+                phone.pbx_account_name, phone.reg_status if phone.account else None, phone.registration_latency,
+                errors.get(phone))
+        registered = sum(1 for phone in finished if phone.reg_status == 200)
+        logger.info("Registered %s of %s phones in %.3f seconds (%s failed, %s did not finish)", registered,
+                    len(self.phones), time.monotonic() - start_time, len(finished) - registered + len(errors),
+                    len(unfinished))
+        return dict(self.registration_results)
+
+    def unregister_all(self, time_out=10):
+        """
+        Unregister and delete every account in the pool (those the PJSipClient's account cache can take are parked
+        there instead, still registered)
+        :param time_out: Number - Overall number of seconds allowed for the PBX to remove all of the registrations
+        """
+        parked = sum(1 for phone in self.phones if phone._park_account())
+        if parked:
+            logger.info("%s phones have been parked in the account cache", parked)
+        phones_with_accounts = [phone for phone in self.phones if phone.account]
+        registered = [phone for phone in phones_with_accounts if phone.reg_status == 200]
+        logger.info("Unregistering %s phones (at most %s at once)", len(registered), self.max_in_flight)
+        finished, unfinished, _ = self._run_with_window(
+            registered, SoftPhone._start_unregistration, SoftPhone._unregistration_finished, time_out)
+        if unfinished:
+            logger.warning("%s phones were not unregistered within %s seconds, deleting them anyway",
+                           len(unfinished), time_out)
+        for phone in phones_with_accounts:
+            phone._delete_account()
+            phone.account = None
+        logger.info("%s phones have been unregistered and deleted", len(phones_with_accounts))
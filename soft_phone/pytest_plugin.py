@@ -0,0 +1,114 @@
+"""
+pytest plugin providing a PJSipClient and registered Soft Phones shared by the whole test session
+
+Installed as a pytest11 entry point, so it is active wherever soft_phone is installed. Configure it on the command
+line or in the ini file:
+
+    [pytest]
+    soft_phone_pbx_ip = 10.0.0.1
+    soft_phone_password = secret
+    soft_phone_account_cache_size = 32
+
+    def test_call(soft_phones):
+        caller, receiver = soft_phones("100"), soft_phones("200")
+        phone_call = caller.make_call("200")
+        assert phone_call.is_connected()
+
+Nothing is imported from pjsua until a fixture is first used, so test runs which don't use the fixtures don't pay
+for it.
+"""
+import pytest
+from soft_phone import backend
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("soft_phone")
+    group.addoption("--soft-phone-backend", help="pjsua implementation to use, e.g. 'fake' for the simulation")
+    group.addoption("--soft-phone-pbx", help="address of the PBX the phones register with")
+    group.addoption("--soft-phone-password", help="password of the PBX accounts")
+    parser.addini("soft_phone_backend", "pjsua implementation to use, e.g. 'fake' for the simulation")
+    parser.addini("soft_phone_pbx_ip", "address of the PBX the phones register with")
+    parser.addini("soft_phone_password", "password of the PBX accounts")
+    parser.addini("soft_phone_account_cache_size", "registered accounts kept for reuse between phones", default="32")
+    parser.addini("soft_phone_log_file", "file PJSIP writes its log to (empty for none)", default="")
+
+
+def _setting(config, option, ini_name):
+    """
+    :return: String - The command line option, or else the ini setting (None if neither is set)
+    """
+    return config.getoption(option) or config.getini(ini_name) or None
+
+
+def _end_calls(phone, time_out=10):
+    """
+    Hang up the phone's calls and wait for them to end, so the next test starts with none
+    """
+    phone.hang_up_all_calls()
+    phone._wait_for_state(lambda: not phone.calls, time_out)
+
+
+def pytest_configure(config):
+    backend_name = _setting(config, "--soft-phone-backend", "soft_phone_backend")
+    if backend_name:
+        backend.use_backend(backend_name)
+
+
+@pytest.fixture(scope="session")
+def soft_phone_client(pytestconfig):
+    """
+    The process wide PJSipClient, started for the session (with an account cache, so phones stay registered between
+    tests) and stopped at the end of it
+    """
+    from soft_phone.manage_pjsip import PJSipClient
+    client = PJSipClient.instance(account_cache_size=int(pytestconfig.getini("soft_phone_account_cache_size")),
+                                  log_file=pytestconfig.getini("soft_phone_log_file") or None)
+    yield client
+    client.stop()
+
+
+@pytest.fixture(scope="session")
+def soft_phone_factory(soft_phone_client, pytestconfig):
+    """
+    Callable returning a registered SoftPhone for an account, created the first time the account is asked for and
+    shared by the rest of the session: soft_phone_factory(pbx_account_name, pbx_password=None, **soft_phone_kwargs)
+    """
+    from soft_phone.soft_phone import SoftPhone
+    pbx_ip = _setting(pytestconfig, "--soft-phone-pbx", "soft_phone_pbx_ip")
+    default_password = _setting(pytestconfig, "--soft-phone-password", "soft_phone_password")
+    phones = {}
+
+    def factory(pbx_account_name, pbx_password=None, **soft_phone_kwargs):
+        phone = phones.get(pbx_account_name)
+        if phone is None:
+            if not pbx_ip:
+                pytest.fail("No PBX address, set soft_phone_pbx_ip in the ini file or pass --soft-phone-pbx")
+            phone = SoftPhone(soft_phone_client, pbx_ip, pbx_account_name, pbx_password or default_password,
+                              **soft_phone_kwargs)
+            phone.register_soft_phone()
+            if phone.reg_status != 200:
+                pytest.fail("[{}] Registration failed with status {}".format(pbx_account_name, phone.reg_status))
+            phones[pbx_account_name] = phone
+        return phone
+
+    yield factory
+    for phone in phones.values():
+        _end_calls(phone)
+        phone.unregister_soft_phone()
+
+
+@pytest.fixture
+def soft_phones(soft_phone_factory):
+    """
+    soft_phone_factory for a single test: the calls of every phone it hands out are hung up once the test is over
+    """
+    used = []
+
+    def get_phone(pbx_account_name, pbx_password=None, **soft_phone_kwargs):
+        phone = soft_phone_factory(pbx_account_name, pbx_password, **soft_phone_kwargs)
+        used.append(phone)
+        return phone
+
+    yield get_phone
+    for phone in used:
+        _end_calls(phone)
@@ -0,0 +1,241 @@
+from soft_phone.backend import get_backend
+import logging
+import threading
+import time
+import tracemalloc
+import weakref
+from collections import deque
+
+pj = get_backend()
+
+logger = logging.getLogger(__name__)
+
+# What each sample counts, the pjsua objects first
+SAMPLE_FIELDS = ("accounts", "calls", "recorders", "players", "conference_ports", "phone_calls_alive",
+                 "traced_memory")
+
+
+class ResourceSample:
+    """
+    Counts of the live pjsua objects and of Python's memory, taken after a number of call cycles
+    """
+    __slots__ = ("cycle", "taken_at") + SAMPLE_FIELDS
+
+    def __init__(self, cycle, **counts):
+        """
+        :param cycle: Int - Number of calls which had ended when it was taken
+        :param counts: The values of SAMPLE_FIELDS (None where unknown)
+        """
+        self.cycle = cycle
+        self.taken_at = time.monotonic()
+        for name in SAMPLE_FIELDS:
+            setattr(self, name, counts.get(name))
+
+    def __repr__(self):
+        return "<ResourceSample cycle={} {}>".format(self.cycle, " ".join(
+            "{}={}".format(name, getattr(self, name)) for name in SAMPLE_FIELDS))
+
+    def as_dict(self):
+        """
+        :return: Dict - The call cycle and the counts
+        """
+        sample = {"cycle": self.cycle}
+        sample.update((name, getattr(self, name)) for name in SAMPLE_FIELDS)
+        return sample
+
+
+def _growth_per_cycle(samples, name):
+    """
+    Least squares slope of a count against the call cycle it was sampled at
+    :param samples: List - ResourceSamples, oldest first
+    :param name: String - One of SAMPLE_FIELDS
+    :return: Float - Growth per call cycle, None if there are fewer than two samples with the count
+    """
+    points = [(sample.cycle, getattr(sample, name)) for sample in samples if getattr(sample, name) is not None]
+    if len(points) < 2:
+        return None
+    mean_cycle = sum(cycle for cycle, _ in points) / len(points)
+    mean_value = sum(value for _, value in points) / len(points)
+    spread = sum((cycle - mean_cycle) ** 2 for cycle, _ in points)
+    if not spread:
+        return None
+    return sum((cycle - mean_cycle) * (value - mean_value) for cycle, value in points) / spread
+
+
+class ResourceTracker:
+    """
+    Accounting of the pjsua objects a PJSipClient has alive, for soak tests running calls for days
+
+    Accounts, calls and recorders are counted as the Soft Phones create and destroy them, and the audio players and
+    conference ports in use are read from the client. Every 'sample_interval' call cycles (calls which have ended)
+    the counts are sampled on the timer thread, and the growth per thousand cycles of each is worked out over the
+    last 'history' samples: anything which goes on growing is leaking. With 'tracemalloc_interval' the Python memory
+    is traced too, and the source lines whose allocations have grown the most since the first snapshot are kept.
+    Resources found attached to a call which has already ended (e.g. audio started just as the far end hung up)
+    are reclaimed by the Soft Phones and counted in 'reclaimed'.
+    """
+
+    def __init__(self, pjsip_client, sample_interval=1000, history=60, tracemalloc_interval=None,
+                 leak_threshold=1.0):
+        """
+        :param pjsip_client: PJSipClient - The client whose objects are tracked
+        :param sample_interval: Int - Call cycles between samples of the counts (None for none)
+        :param history: Int - Number of samples kept to work out the growth from
+        :param tracemalloc_interval: Int - Call cycles between tracemalloc snapshots (None to not trace memory,
+                                     tracing slows every allocation down)
+        :param leak_threshold: Float - Growth of a pjsua object count per thousand cycles which is logged as a leak
+        """
+        self.pjsip_client = pjsip_client
+        self.sample_interval = sample_interval
+        self.tracemalloc_interval = tracemalloc_interval
+        self.leak_threshold = leak_threshold
+        self.cycles = 0
+        self.counts = dict.fromkeys(("accounts", "calls", "recorders"), 0)
+        self.reclaimed = dict.fromkeys(("players", "recorders"), 0)
+        self.samples = deque(maxlen=history)
+        self.memory_growth = []  # (source line, bytes grown, allocations grown) of the largest growths
+        self._lock = threading.Lock()
+        self._phone_calls = weakref.WeakSet()  # every PhoneCall still referenced from anywhere
+        self._baseline_snapshot = None
+        self._started_tracemalloc = False
+        self._reported_leaks = set()
+
+    def add(self, kind, delta=1):
+        """
+        Count pjsua objects created (or destroyed, with a negative delta)
+        :param kind: String - "accounts", "calls" or "recorders"
+        :param delta: Int - Number created
+        """
+        with self._lock:
+            self.counts[kind] += delta
+
+    def on_call_started(self, phone_call):
+        """
+        :param phone_call: PhoneCall - A call which has just been made or received
+        """
+        with self._lock:
+            self.counts["calls"] += 1
+            self._phone_calls.add(phone_call)
+
+    def on_call_ended(self, phone_call):
+        """
+        A call has ended, completing a call cycle (called from the pjsua callback thread), sample the counts if one
+        is due
+        :param phone_call: PhoneCall - The call
+        """
+        with self._lock:
+            self.counts["calls"] -= 1
+            self.cycles += 1
+            cycle = self.cycles
+        sample_due = self.sample_interval and cycle % self.sample_interval == 0
+        snapshot_due = self.tracemalloc_interval and cycle % self.tracemalloc_interval == 0
+        if sample_due or snapshot_due:
+            try:  # not on the callback thread, snapshots take a while
+                self.pjsip_client.timers.schedule(0, self._sample, cycle, snapshot_due)
+            except RuntimeError:
+                pass  # the client is being stopped
+
+    def on_reclaimed(self, kind):
+        """
+        :param kind: String - "players" or "recorders", released because their call had already ended
+        """
+        with self._lock:
+            self.reclaimed[kind] += 1
+
+    def sample(self, cycle=None):
+        """
+        Count the live objects now
+        :param cycle: Int - The call cycle to record it against (defaults to the number of calls ended so far)
+        :return: ResourceSample - The counts
+        """
+        pjsip_client = self.pjsip_client
+        conference_ports = None
+        if pjsip_client.lib is not None:
+            try:
+                conference_ports = pjsip_client.lib.conf_get_active_ports()
+            except (pj.Error, AttributeError):  # not every pjsua build has it
+                pass
+        with self._lock:
+            counts = dict(self.counts)
+            phone_calls_alive = len(self._phone_calls)
+        return ResourceSample(self.cycles if cycle is None else cycle, phone_calls_alive=phone_calls_alive,
+                              players=len(pjsip_client.audio_players) if pjsip_client.lib is not None else None,
+                              conference_ports=conference_ports,
+                              traced_memory=tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None,
+                              **counts)
+
+    def _sample(self, cycle, snapshot_due=False):
+        """
+        Record a sample and log anything which keeps growing (runs on the timer thread)
+        """
+        sample = self.sample(cycle)
+        self.samples.append(sample)
+        if snapshot_due and tracemalloc.is_tracing():
+            self._snapshot_memory()
+        if len(self.samples) < 6:
+            return
+        samples = list(self.samples)
+        for name, growth in self.growth().items():
+            if name == "traced_memory" or name in self._reported_leaks:
+                continue
+            if growth is None or growth < self.leak_threshold:
+                continue
+            # the calls in progress as a sample is taken come and go, a leak raises the floor for good
+            values = [getattr(sample, name) for sample in samples]
+            if None not in values and min(values[len(values) // 2:]) > max(values[:len(values) // 2]):
+                self._reported_leaks.add(name)
+                logger.warning("Live %s are growing by %.1f per thousand calls (%s after %s calls), they may be "
+                               "leaking", name, growth, values[-1], cycle)
+
+    def _snapshot_memory(self):
+        """
+        Take a tracemalloc snapshot and keep the source lines whose allocations have grown most since the first
+        """
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>")))
+        if self._baseline_snapshot is None:
+            self._baseline_snapshot = snapshot
+            return
+        self.memory_growth = [(str(statistic.traceback), statistic.size_diff, statistic.count_diff)
+                              for statistic in snapshot.compare_to(self._baseline_snapshot, "lineno")[:10]
+                              if statistic.size_diff > 0]
+
+    def growth(self):
+        """
+        :return: Dict - Growth of each count per thousand call cycles over the samples kept (None where unknown)
+        """
+        samples = list(self.samples)
+        growth = {}
+        for name in SAMPLE_FIELDS:
+            per_cycle = _growth_per_cycle(samples, name)
+            growth[name] = None if per_cycle is None else per_cycle * 1000
+        return growth
+
+    def report(self):
+        """
+        :return: Dict - The call cycles so far, the counts now, their growth per thousand cycles, the resources
+                 reclaimed from ended calls and the source lines whose memory has grown the most
+        """
+        return {"cycles": self.cycles, "current": self.sample().as_dict(), "growth_per_1000_cycles": self.growth(),
+                "reclaimed": dict(self.reclaimed), "memory_growth": list(self.memory_growth)}
+
+    def start(self):
+        """
+        Start tracing memory, if it is to be snapshotted and nothing else has started tracing it
+        """
+        if self.tracemalloc_interval and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+    def stop(self):
+        """
+        The library has been destroyed, with every object it had: zero the counts and stop tracing memory (if the
+        tracker started it)
+        """
+        with self._lock:
+            self.counts = dict.fromkeys(self.counts, 0)
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+            self._baseline_snapshot = None
@@ -1,12 +1,20 @@
-import pjsua as pj
+from soft_phone.backend import get_backend
 import logging
+import os
+import re
+import threading
 import time
-from soft_phone.callbacks import IncomingCallCallback, CallCallback
+from soft_phone.callbacks import IncomingCallCallback, CallCallback, TRACE
+from soft_phone.dispositions import as_disposition
+from soft_phone.dtmf import DTMFSequence, DTMFSequenceRun, _as_pattern
 from soft_phone.exceptions import PhoneCallNotInProgress
-from datetime import datetime
+from soft_phone.metrics import PhoneMetrics
+from soft_phone.phone_call import PhoneCall
+from soft_phone.timers import Timer
+
+pj = get_backend()
 
 logger = logging.getLogger(__name__)
-logging.addLevelName(5, "TRACE")
 
 
 class SoftPhone:
@@ -14,19 +22,24 @@ class SoftPhone:
     'Soft Phone' to act as a device for making or receiving phone calls
     """
     account = None
-    call = None
-    call_slot_number = None
-    audio_player_id = None
-    audio_player_slot_id = None
+    progress_log_interval = 5
 
     def __init__(self, pjsip_client, pbx_ip, pbx_account_name, pbx_password, answer_audio=None, loop=True,
-                 action_on_incoming_call="ANSWER"):
+                 action_on_incoming_call="ANSWER", transport=None, recording_directory=None):
         """
         :param pjsip_client: Established instance of PJSip Lib
         :param pbx_account_name: String - the telephone number to register as
         :param answer_audio: String - File path of a WAV file which should be played once an incoming call is answered
         :param loop: Boolean - Indicate if the audio file should be looped (True), or played once (False)
-        """
+        :param action_on_incoming_call: String or Disposition - "ANSWER" (after ringing for a second), "BUSY",
+                                        "DECLINE", "NO_ANSWER", or a Disposition such as Answer(ring_delay=(2, 8)) or
+                                        a WeightedMix of several
+        :param transport: Int or pjsua Transport - Bind the account to one of the PJSipClient's transports (by index),
+                          or "round_robin" to take the next one in turn (None to let pjsua choose)
+        :param recording_directory: String - Record the audio received on every call to a WAV file in this directory
+                                    (named after the account and the SIP Call-ID), from when its media is ACTIVE
+        """
+        self.pjsip_client = pjsip_client
         self.lib = pjsip_client.lib
         self.pbx_ip = pbx_ip
         self.pbx_account_name = pbx_account_name
@@ -34,253 +47,799 @@ class SoftPhone:
         self.answer_audio = answer_audio
         self.loop = loop
         self.action_on_incoming_call = action_on_incoming_call
+        as_disposition(action_on_incoming_call)  # reject an invalid action now, rather than when a call arrives
+        self.transport = pjsip_client.get_transport(transport)
+        self.recording_directory = recording_directory
+        # State published by the pjsua callbacks, guarded by (and announced through) the condition
+        self._state_changed = threading.Condition()
+        self.reg_status = 0
+        self.reg_expires = None
+        self.registration_started_at = None
+        self.registration_latency = None
+        self.calls = {}  # registry of the calls in progress, keyed by SIP Call-ID
+        self.current_call = None  # the most recent call made or received
+        self._state_listeners = ()
+        # added to the PJSipClient's metrics registry once the phone creates its account
+        self.metrics = PhoneMetrics(pbx_account_name, pjsip_client.metrics.buckets)
 
     def _register_thread(self):
         """
         Register the thread with PJSip
         """
-        logger.debug("[{}] Registering thread with PJSip".format(self.pbx_account_name))
-        self.lib.thread_register(self.pbx_account_name)
-        logger.info("[{}] Thread registered with PJSip".format(self.pbx_account_name))
+        logger.debug("[%s] Registering thread with PJSip", self.pbx_account_name)
+        self.pjsip_client.register_thread(self.pbx_account_name)
+        logger.info("[%s] Thread registered with PJSip", self.pbx_account_name)
+
+    @property
+    def call(self):
+        """
+        The pjsua Call of the current (most recent) call
+        """
+        return self.current_call.call if self.current_call else None
+
+    def get_call(self, call_id):
+        """
+        Look up a call in progress
+        :param call_id: String - SIP Call-ID of the call
+        :return: PhoneCall - The call, or None if there is no such call in progress
+        """
+        return self.calls.get(call_id)
+
+    def add_state_listener(self, listener):
+        """
+        Register a callable to be invoked after every published state change, with the PhoneCall concerned (or None
+        for a change of registration status)
+        Listeners run on the pjsua callback thread, so they must return quickly and must not block
+        :param listener: Callable - e.g. a function which hands the notification over to an event loop
+        """
+        self._state_listeners = self._state_listeners + (listener,)
+
+    def remove_state_listener(self, listener):
+        """
+        Stop invoking a callable previously registered with 'add_state_listener'
+        :param listener: Callable - The listener to remove
+        """
+        self._state_listeners = tuple(registered for registered in self._state_listeners
+                                      if registered is not listener)
+
+    def _notify_state_listeners(self, phone_call=None):
+        """
+        Invoke the state listeners (outside of the state lock)
+        :param phone_call: PhoneCall - The call whose state changed
+        """
+        for listener in self._state_listeners:
+            listener(phone_call)
+
+    def _on_registration_state(self, account_info):
+        """
+        Publish a change of registration status (called from the pjsua callback thread)
+        :param account_info: pjsua AccountInfo - Account information captured by the callback
+        """
+        with self._state_changed:
+            if account_info.reg_status >= 200 and self.reg_status < 200:  # final response to the REGISTER
+                latency = time.monotonic() - self.registration_started_at if self.registration_started_at else None
+                if account_info.reg_status == 200 and self.registration_latency is None:
+                    self.registration_latency = latency
+                self.metrics.on_registration(account_info.reg_status, latency)
+            self.reg_status = account_info.reg_status
+            self.reg_expires = account_info.reg_expires
+            self._state_changed.notify_all()
+        self._notify_state_listeners()
+
+    def _add_call(self, phone_call, call):
+        """
+        Attach a pjsua Call to its handle and add it to the call registry
+        :param phone_call: PhoneCall - Handle for the call
+        :param call: pjsua Call - The call
+        """
+        call_info = call.info()
+        with self._state_changed:
+            phone_call.call = call
+            phone_call.call_id = call_info.sip_call_id
+            phone_call.remote_uri = call_info.remote_uri
+            if not phone_call.has_ended():  # it may already have failed whilst being made
+                self.calls[phone_call.call_id] = phone_call
+            self.current_call = phone_call
+            self._state_changed.notify_all()
+        self._notify_state_listeners(phone_call)
+
+    def _on_incoming_call(self, call):
+        """
+        Publish the arrival of an incoming call (called from the pjsua callback thread)
+        :param call: pjsua Call - The incoming call
+        :return: PhoneCall - Handle for the call
+        """
+        phone_call = PhoneCall(self, "incoming")
+        phone_call.call_state.state = pj.CallState.INCOMING
+        self.pjsip_client.resources.on_call_started(phone_call)
+        with self._state_changed:
+            self.metrics.counters["calls_received"] += 1
+        call.set_callback(CallCallback(call, self, phone_call))
+        self._add_call(phone_call, call)
+        return phone_call
+
+    def _on_call_state(self, phone_call, call_info):
+        """
+        Publish a change of call state (called from the pjsua callback thread)
+        Ended calls are removed from the call registry.
+        :param phone_call: PhoneCall - Handle for the call
+        :param call_info: pjsua CallInfo - Call information captured by the callback
+        """
+        with self._state_changed:
+            edges = phone_call.call_state.update(call_info)
+            self.metrics.on_call_edges(phone_call, edges)
+            if phone_call.has_ended():
+                self.calls.pop(phone_call.call_id, None)
+            pending_actions = phone_call.pending_actions if "connected" in edges or "ended" in edges else ()
+            if pending_actions:
+                phone_call.pending_actions = []
+            self._state_changed.notify_all()
+        for offset, timer in pending_actions:
+            if phone_call.has_ended():
+                timer.cancel()
+            else:
+                self.pjsip_client.timers.schedule_timer(timer, phone_call.connected_at + offset)
+        if "media_active" in edges:
+            self._on_media_active(phone_call)
+        if phone_call.has_ended():
+            player_id, _ = self._detach_audio_player(phone_call)
+            if player_id is not None:  # pjsua has already disconnected the player from the call
+                self.pjsip_client.audio_players.release(player_id)
+            if phone_call.media_stats is not None:
+                self.pjsip_client.media_stats.detach(phone_call)
+            recorder_id, _ = self._detach_recorder(phone_call)
+            if recorder_id is not None:
+                self._destroy_recorder(recorder_id)  # completes the WAV file
+            if phone_call.direction == "outgoing" and phone_call.connected_at is None:
+                self.pjsip_client._on_call_failed(phone_call)
+            if "ended" in edges:
+                for run in phone_call.dtmf_sequences:
+                    run.call_ended()
+                if self.pjsip_client.cdr_writer:
+                    self.pjsip_client.cdr_writer.submit(phone_call)
+                self.pjsip_client.resources.on_call_ended(phone_call)
+        self._notify_state_listeners(phone_call)
+
+    def _on_call_media_state(self, phone_call, call_info):
+        """
+        Publish a change of call media state (called from the pjsua callback thread)
+        :param phone_call: PhoneCall - Handle for the call
+        :param call_info: pjsua CallInfo - Call information captured by the callback
+        """
+        with self._state_changed:
+            edges = phone_call.call_state.update_media(call_info)
+            self.metrics.on_call_edges(phone_call, edges)
+            self._state_changed.notify_all()
+        if edges:
+            self._on_media_active(phone_call)
+        self._notify_state_listeners(phone_call)
+
+    def _on_dtmf_digit(self, phone_call, digits):
+        """
+        Publish DTMF digits received on a call (called from the pjsua callback thread)
+        :param phone_call: PhoneCall - Handle for the call
+        :param digits: String - The digits
+        """
+        with self._state_changed:
+            phone_call.dtmf.record_received(digits)
+            self.metrics.counters["dtmf_digits_received"] += len(digits)
+            self._state_changed.notify_all()
+        logger.debug("[%s] Received DTMF '%s'", self.pbx_account_name, digits)
+        for run in phone_call.dtmf_sequences:
+            run.on_digits()
+        self._notify_state_listeners(phone_call)
+
+    def _on_media_active(self, phone_call):
+        """
+        The call's media has just become ACTIVE (called from the pjsua callback thread), start recording it if the
+        phone records every call, and sampling its media statistics if the client collects them
+        :param phone_call: PhoneCall - Handle for the call
+        """
+        if self.pjsip_client.signalling_only:
+            return
+        if self.pjsip_client.media_stats is not None and not phone_call.has_ended():
+            self.pjsip_client.media_stats.attach(phone_call)
+        if self.recording_directory and phone_call.recorder_id is None and not phone_call.has_ended():
+            file_name = "{}-{}.wav".format(self.pbx_account_name, re.sub(r"[^\w.-]", "_", str(phone_call.call_id)))
+            try:
+                self.start_recording(os.path.join(self.recording_directory, file_name), call=phone_call)
+            except PhoneCallNotInProgress:
+                logger.debug("[%s] The call ended before it could be recorded", self.pbx_account_name)
+            except pj.Error as error:
+                logger.error("[%s] Unable to record the call: %s", self.pbx_account_name, error)
+
+    def _registration_finished(self):
+        """ The PBX has given a final response to the REGISTER (success or failure) """
+        return self.reg_status >= 200
+
+    def _unregistration_finished(self):
+        """ The PBX has removed the registration """
+        return self.reg_expires == -1
+
+    def _call_has_occurred(self):
+        """ A call has been made or received """
+        return self.current_call is not None
+
+    def _wait_for_state(self, predicate, time_out, waiting_message=None):
+        """
+        Block until the state published by the pjsua callbacks satisfies a predicate (with a time out)
+        :param predicate: Callable - Evaluated against the published state only, it must not call into pjsua
+        :param time_out: Number - The maximum number of seconds to wait
+        :param waiting_message: String - Logged every 'progress_log_interval' seconds whilst still waiting
+        :return: Boolean - True if the predicate was satisfied before the time out
+        """
+        deadline = time.monotonic() + time_out
+        with self._state_changed:
+            while not predicate():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                if not self._state_changed.wait(min(remaining, self.progress_log_interval)) and waiting_message:
+                    logger.debug("[%s] %s", self.pbx_account_name, waiting_message)
+            return True
 
     def _create_and_register_account_with_pbx(self):
         """
-        Create and register an account for the phone instance with the PBX
+        Create and register an account for the phone instance with the PBX (or take over a registered one from the
+        PJSipClient's account cache)
         """
-        logger.debug("[{}] Creating account with domain = {}, username = {} and password = {}".format(
-            self.pbx_account_name, self.pbx_ip, self.pbx_account_name, self.pbx_password))
+        self.pjsip_client.metrics.add(self.metrics)  # back in the registry if it was unregistered before
+        if self._take_cached_account():
+            return
+        logger.debug("[%s] Creating account with domain = %s, username = %s and password = %s",
+                     self.pbx_account_name, self.pbx_ip, self.pbx_account_name, self.pbx_password)
         account = pj.AccountConfig(self.pbx_ip, self.pbx_account_name, self.pbx_password)
+        if self.transport is not None:
+            account.transport_id = self.transport._id
+        with self._state_changed:
+            self.reg_status = 0
+            self.reg_expires = None
+            self.registration_started_at = time.monotonic()
+            self.registration_latency = None
         self.account = self.lib.create_account(
-            account, cb=IncomingCallCallback(account, self, action_on_incoming_call=self.action_on_incoming_call,
-                                             audio_playback_file=self.answer_audio, loop=self.loop)
+            account, cb=IncomingCallCallback(account, self, action_on_incoming_call=self.action_on_incoming_call)
         )
-        logger.log(5, "[{}] Registration info - {}".format(self.pbx_account_name, vars(self.account.info())))
-        logger.info("[{}] Account created".format(self.pbx_account_name))
+        self.pjsip_client.resources.add("accounts")
+        if logger.isEnabledFor(TRACE):
+            logger.log(TRACE, "[%s] Registration info - %s", self.pbx_account_name, vars(self.account.info()))
+        logger.info("[%s] Account created", self.pbx_account_name)
+
+    def _take_cached_account(self):
+        """
+        Take over a registered account for this phone from the PJSipClient's account cache, if it has one
+        :return: Boolean - True if an account was taken over
+        """
+        account_cache = self.pjsip_client.account_cache
+        if account_cache is None:
+            return False
+        account = account_cache.checkout(self.pbx_ip, self.pbx_account_name, self.pbx_password, self.transport)
+        if account is None:
+            return False
+        account.set_callback(IncomingCallCallback(account, self, action_on_incoming_call=self.action_on_incoming_call))
+        account_info = account.info()  # after setting the callback, so no later change of status can be missed
+        with self._state_changed:
+            self.reg_status = account_info.reg_status
+            self.reg_expires = account_info.reg_expires
+            self.registration_started_at = None
+            self.registration_latency = None
+            self.metrics.counters["registrations_reused"] += 1
+            self._state_changed.notify_all()
+        self.account = account
+        logger.info("[%s] Account taken from the account cache (status %s)", self.pbx_account_name,
+                    account_info.reg_status)
+        return True
+
+    def _park_account(self):
+        """
+        Hand a registered account with no calls in progress back to the PJSipClient's account cache, rather than
+        unregistering it
+        :return: Boolean - True if the account was parked (the phone no longer has an account)
+        """
+        account_cache = self.pjsip_client.account_cache
+        if account_cache is None or self.account is None or self.reg_status != 200 or self.calls:
+            return False
+        account_cache.checkin(self.account, self.pbx_ip, self.pbx_account_name, self.pbx_password,
+                              self.transport)
+        with self._state_changed:
+            self.reg_status = 0
+            self.reg_expires = None
+            self.current_call = None
+        self.account = None
+        self._retire_metrics()
+        logger.info("[%s] Account parked in the account cache, still registered", self.pbx_account_name)
+        return True
 
-    def register_soft_phone(self):
+    def _retire_metrics(self):
+        """
+        Fold the phone's metrics into the registry's retired totals now it has no account, so that phones created
+        and thrown away by the thousand don't grow the registry (they rejoin it if the phone registers again)
+        """
+        registry = self.pjsip_client.metrics
+        with self._state_changed:
+            if registry.remove(self.metrics):
+                self.metrics = PhoneMetrics(self.pbx_account_name, registry.buckets)
+
+    def register_soft_phone(self, time_out=10):
         """
         Start the phone's thread (allowing it to be run in parallel to the main process thread
         then register the account and set the 'receiver callback'
+        :param time_out: Int - The maximum number of seconds to wait for the registration to complete
         """
 
         self._register_thread()
         self._create_and_register_account_with_pbx()
-        start_time = time.time()
-        for i in range(0, 10):
-            if self.account.info().reg_status == 200:
-                logger.debug("[{}] [RUN] Account is now registered".format(self.pbx_account_name))
-                break
-            time.sleep(1.0 - ((time.time() - start_time) % 1.0))
+        if not self._wait_for_state(self._registration_finished, time_out):
+            logger.warning("[%s] [RUN] Account registration did not complete within %s seconds",
+                           self.pbx_account_name, time_out)
+        elif self.reg_status == 200:
+            logger.debug("[%s] [RUN] Account is now registered", self.pbx_account_name)
+        else:
+            logger.warning("[%s] [RUN] Account registration failed with status %s",
+                           self.pbx_account_name, self.reg_status)
 
     def _wait_for_soft_phone_registration_to_end(self, time_out=10):
         """
         Wait for the Soft Phone's registration status to be False
         """
-        logger.debug("[{}] Waiting for registration status to be False".format(self.pbx_account_name))
-        logger.log(5, "[{}] Registration info - {}".format(self.pbx_account_name, vars(self.account.info())))
-        start_time = datetime.now()
-        while (datetime.now() - start_time).seconds <= time_out:
-            if self.account.info().reg_expires == -1:
-                logger.log(5, "[{}] Registration status is now False".format(self.pbx_account_name))
-                break
-            time.sleep(0.5)
-            logger.log(5, "[{}] Registration info - {}".format(
-                self.pbx_account_name, vars(self.account.info())))
+        logger.debug("[%s] Waiting for registration status to be False", self.pbx_account_name)
+        if logger.isEnabledFor(TRACE):
+            logger.log(TRACE, "[%s] Registration info - %s", self.pbx_account_name, vars(self.account.info()))
+        if self._wait_for_state(self._unregistration_finished, time_out):
+            logger.log(TRACE, "[%s] Registration status is now False", self.pbx_account_name)
+
+    def _start_unregistration(self):
+        """
+        Ask the PBX to remove the registration, without waiting for it to complete
+        """
+        logger.info("[%s] Unregistering phone", self.pbx_account_name)
+        if logger.isEnabledFor(TRACE):
+            logger.log(TRACE, "[%s] Registration info - %s", self.pbx_account_name, vars(self.account.info()))
+        with self._state_changed:
+            self.reg_expires = None
+        self.account.set_registration(False)
+
+    def _delete_account(self):
+        """
+        Delete the account (and the references to its calls) once it has been unregistered
+        """
+        self.account.delete()  # delete account
+        self.pjsip_client.resources.add("accounts", -1)
+        if self.current_call:
+            logger.debug("[%s] Attempting to delete the call objects", self.pbx_account_name)
+            with self._state_changed:  # need to delete the call objects after they are finished.
+                self.calls.clear()
+                self.current_call = None
+            logger.debug("[%s] Call objects have been deleted", self.pbx_account_name)
+        self._retire_metrics()
+        logger.info("[%s] Sip Phone has been unregistered", self.pbx_account_name)
 
     def unregister_soft_phone(self):
         """
         Unregister and delete the account when the call has ended
+        If the PJSipClient has an account cache the account is parked there instead, still registered.
         """
-        logger.info("[{}] Unregistering phone".format(self.pbx_account_name))
-        logger.log(5, "[{}] Registration info - {}".format(
-            self.pbx_account_name, vars(self.account.info())))
-        self.account.set_registration(False)
-        logger.debug("[{}] Deleting account".format(self.pbx_account_name))
+        if self._park_account():
+            return
+        self._start_unregistration()
+        logger.debug("[%s] Deleting account", self.pbx_account_name)
         self._wait_for_soft_phone_registration_to_end()
-        self.account.delete()  # delete account
-        if self.call:
-            logger.debug("[{}] Attempting to delete the call object".format(self.pbx_account_name))
-            del self.call  # need to delete the call object after it is finished.
-            logger.debug("[{}] Call object has been deleted".format(self.pbx_account_name))
-        logger.info("[{}] Sip Phone has been unregistered".format(self.pbx_account_name))
+        self._delete_account()
 
-    def _wait_for_active_media_state_on_call(self, time_out=10, required_media_state=1):
+    def _wait_for_active_media_state_on_call(self, time_out=10, required_media_state=1, call=None):
         """
         Wait for the duration of the timeout for a call to become 'valid'
         :param time_out: Int - Number of seconds to wait for the required media state
         :param required_media_state: Int - "1" for connected call, "0" for other media state, e.g. busy
-        """
-        for i in range(time_out):
-            if str(self.call.is_valid()) == "1":
-                if self.call.info().media_state == pj.MediaState.ACTIVE:
-                    logger.info("[{}] MediaState ACTIVE".format(self.pbx_account_name))
-                    logger.log(5, "[{}] Call info - %s".format(self.pbx_account_name, vars(self.call.info())))
-                    break
-                logger.debug("[{}] Waiting for MediaState ACTIVE (ringing)".format(self.pbx_account_name))
-                logger.log(5, "[{}] Call info - %s".format(self.pbx_account_name, vars(self.call.info())))
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        """
+        phone_call = self._validate_phone_call_in_progress(call)
+        self._wait_for_state(lambda: phone_call.media_is_active() or phone_call.has_ended(), time_out,
+                             waiting_message="Waiting for MediaState ACTIVE (ringing)")
+        if not phone_call.has_ended():
+            if phone_call.media_is_active():
+                logger.info("[%s] MediaState ACTIVE", self.pbx_account_name)
+        else:
+            logger.debug("[%s] Call is not valid", self.pbx_account_name)
+            if required_media_state == 0:
+                logger.info("[%s] Required call media state (0) has occurred", self.pbx_account_name)
             else:
-                logger.debug("[{}] Call is not valid".format(self.pbx_account_name))
-                if required_media_state == 0:
-                    logger.info("[{}] Required call media state (0) has occurred".format(self.pbx_account_name))
-                    return
-                else:
-                    logger.error("[{}] Expected call to be answered, but it was dropped".format(self.pbx_account_name))
-                    return
-            time.sleep(0.1)
-        # TODO This needs some better testing and evaluation
-
-    def make_call(self, number_to_dial, protocol="sip"):
-        """
-        Dial a number/start a call
-        """
-        logger.debug("[{}] Making call to {}".format(self.pbx_account_name, number_to_dial))
-        self.call = self.account.make_call("{}:{}@{}".format(protocol, number_to_dial, self.pbx_ip, CallCallback()))
-        logger.log(5, "[{}] Call info: {}".format(self.pbx_account_name, vars(self.call.info())))
-
-        for i in range(1, 120):
-            if self.call.info().state_text == "CONFIRMED":  # dialler and AGI have established a connection
-                logger.log(5, "[{}] Call info - {}".format(self.pbx_account_name, vars(self.call.info())))
-                logger.info("[{}] Number dialled and connected (call in progress)".format(self.pbx_account_name))
-                break
-            logger.debug("[{}] Waiting for call state to be CONFIRMED".format(self.pbx_account_name))
-            logger.log(5, "[{}] Call info - {}".format(self.pbx_account_name, vars(self.call.info())))
-            time.sleep(0.1)
-        if self.call.info().state_text != "CONFIRMED":
-            logger.log(5, "[{}] Call state is '{}'".format(self.pbx_account_name, self.call.info().state_text))
-
-    def _validate_phone_call_in_progress(self):
+                logger.error("[%s] Expected call to be answered, but it was dropped", self.pbx_account_name)
+
+    def _start_call(self, number_to_dial, protocol="sip"):
+        """
+        Send the INVITE for a new call, without waiting for it to be answered
+        :param number_to_dial: String - The number (SIP user) to dial
+        :param protocol: String - URI scheme used to build the destination, e.g. "sip"
+        :return: PhoneCall - Handle for the new call
+        """
+        logger.debug("[%s] Making call to %s", self.pbx_account_name, number_to_dial)
+        phone_call = PhoneCall(self, "outgoing")
+        phone_call.number_dialled = number_to_dial
+        with self._state_changed:
+            self.metrics.counters["calls_attempted"] += 1
+        self.pjsip_client.resources.on_call_started(phone_call)
+        try:
+            call = self.account.make_call("{}:{}@{}".format(protocol, number_to_dial, self.pbx_ip),
+                                          cb=CallCallback(sip_phone=self, phone_call=phone_call))
+        except pj.Error:
+            self.pjsip_client.resources.on_call_ended(phone_call)  # pjsua never created it
+            raise
+        self._add_call(phone_call, call)
+        if logger.isEnabledFor(TRACE):
+            logger.log(TRACE, "[%s] Call info: %s", self.pbx_account_name, vars(call.info()))
+        return phone_call
+
+    def make_call(self, number_to_dial, protocol="sip", time_out=12):
+        """
+        Dial a number/start a call, the phone may have any number of calls in progress at once
+        :param number_to_dial: String - The number (SIP user) to dial
+        :param protocol: String - URI scheme used to build the destination, e.g. "sip"
+        :param time_out: Int - The maximum number of seconds to wait for the call to be CONFIRMED
+        :return: PhoneCall - Handle for the call, to pass to the other call methods
+        """
+        phone_call = self._start_call(number_to_dial, protocol)
+        # dialler and AGI have established a connection, or the call was rejected
+        self._wait_for_state(phone_call.setup_finished, time_out,
+                             waiting_message="Waiting for call state to be CONFIRMED")
+        if phone_call.is_connected():
+            logger.info("[%s] Number dialled and connected (call in progress)", self.pbx_account_name)
+        else:
+            logger.log(TRACE, "[%s] Call state is '%s'", self.pbx_account_name, phone_call.state)
+        return phone_call
+
+    def _validate_phone_call_in_progress(self, call=None):
         """
         Check to see if the Phone Call is in progress and raise an exception if it is not.
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        :return: PhoneCall - The call
         """
-        if not self.call:
+        if call is None:
+            phone_call = self.current_call
+        elif isinstance(call, PhoneCall):
+            phone_call = call
+        else:
+            phone_call = self.calls.get(call)
+        if not phone_call:
             raise PhoneCallNotInProgress("The call does not exist")
+        return phone_call
 
-    def get_call_length(self):
+    def get_call_length(self, call=None):
         """
-        Return the length of the call connection and the total length of the call (in seconds)
+        Return the length of the call connection and the total length of the call (in whole seconds)
+        Worked out from the call's CallState, so it does not call into pjsua.
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
         :return call_length, total_length: Tuple (Call Connection length (seconds), Total Length (seconds))
         """
-        self._validate_phone_call_in_progress()
-        call_length = self.call.info().call_time
-        total_length = self.call.info().total_time
-        # logger.debug("[{}] Call duration information found: connection '{}' second/s, total '{}' "
-        #              "second/s".format(self.pbx_account_name, call_length, total_length))
-        return call_length, total_length
+        phone_call = self._validate_phone_call_in_progress(call)
+        now = time.monotonic()
+        return int(phone_call.call_state.connected_duration(now)), int(phone_call.call_state.total_duration(now))
 
-    def wait_for_specific_call_connection_length(self, desired_call_length):
+    def get_media_stats(self, call=None):
+        """
+        Return the media quality of a call so far, sampled by the PJSipClient's MediaStatsCollector
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        :return: Dict - Estimated MOS, packet loss, jitter, round trip time and bitrates (see MEDIA_STATS_FIELDS), None
+                 if the call's media statistics haven't been collected
+        """
+        phone_call = self._validate_phone_call_in_progress(call)
+        return phone_call.media_stats.as_dict() if phone_call.media_stats else None
+
+    def wait_for_specific_call_connection_length(self, desired_call_length, call=None):
         """
         Wait until a phone call has reached a specific Call Connection duration
-        :param desired_call_length: Int - Seconds
-        """
-        self._validate_phone_call_in_progress()
-        loop_delay = 0.1
-        last_log_time = datetime.now()
-        while True:
-            call_connection_length, call_total_length = self.get_call_length()
-            if call_connection_length >= desired_call_length:
-                logger.debug("[{}] The desired call connection duration ({} seconds) has been "
-                             "reached".format(self.pbx_account_name, desired_call_length))
-                return True
-            time.sleep(loop_delay)
-            if (datetime.now() - last_log_time).total_seconds() >= 5:
-                last_log_time = datetime.now()
-                logger.debug("[{}] Waiting for the call connection time ({} seconds) to reach the desired {} seconds"
-                             "".format(self.pbx_account_name, round(call_connection_length), desired_call_length))
-
-    @staticmethod
-    def _round_up_current_datetime_seconds(round_value=5):
-        """
-        Get the current datetime seconds, rounded up to the nearest 'rounded_value'
-        :param round_value: Int - What to round the result up by
-        :return: Int - Number of seconds in "now" rounded up to the nearest 'rounded_value'
-        """
-        return int(round_value * round(float(int(datetime.now().strftime("%S"))) / round_value))
+        :param desired_call_length: Number - Seconds
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        :return: Boolean - True if the duration was reached, False if the call ended (or never connected) first
+        """
+        phone_call = self._validate_phone_call_in_progress(call)
+        connected_at = phone_call.connected_at
+        if connected_at is None or phone_call.has_ended():
+            return False
+        remaining = connected_at + desired_call_length - time.monotonic()
+        if remaining > 0 and self._wait_for_state(
+                phone_call.has_ended, remaining,
+                "Waiting for the call connection time to reach the desired {} seconds".format(desired_call_length)):
+            return False
+        logger.debug("[%s] The desired call connection duration (%s seconds) has been reached",
+                     self.pbx_account_name, desired_call_length)
+        return True
+
+    def schedule_call_action(self, offset, action, *args, call=None):
+        """
+        Run an action on a call at a precise offset from the moment it was CONFIRMED (once it is, if it hasn't been)
+        The actions of every call run on the PJSipClient's single timer thread, so no thread waits per call. Actions
+        due after the call has ended are skipped.
+        :param offset: Number - Seconds after the call was CONFIRMED
+        :param action: String or Callable - The name of a method of the phone taking the call as 'call' (e.g.
+                       "hang_up", "send_dtmf_key_tones", "start_audio_playback" or "stop_audio_playback"), or a
+                       callable taking the PhoneCall then 'args', which must return quickly
+        :param args: Arguments of the action, e.g. the digits to send
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        :return: Timer - Handle to cancel the action with, its 'lateness' is how far after its target time it ran
+        """
+        phone_call = self._validate_phone_call_in_progress(call)
+        if isinstance(action, str):
+            getattr(self, action)  # reject an unknown action now, rather than when it is due
+        timer = Timer(None, self._run_call_action, ())
+        timer.args = (timer, phone_call, action, args)
+        with self._state_changed:
+            connected_at = phone_call.connected_at
+            if connected_at is None and not phone_call.has_ended():
+                phone_call.pending_actions.append((offset, timer))
+                return timer
+        if connected_at is None:
+            raise PhoneCallNotInProgress("The call ended without being connected")
+        return self.pjsip_client.timers.schedule_timer(timer, connected_at + offset)
+
+    def hang_up_after(self, call_length, call=None):
+        """
+        Hang up a call once it has been connected for a specific duration, without waiting for it
+        :param call_length: Number - Seconds of connection time
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        :return: Timer - Handle to cancel the hang up with
+        """
+        return self.schedule_call_action(call_length, "hang_up", call=call)
+
+    def _run_call_action(self, timer, phone_call, action, args):
+        """
+        Run an action scheduled with 'schedule_call_action' (on the timer thread)
+        """
+        if phone_call.has_ended():
+            logger.debug("[%s] The call ended before its scheduled %s", self.pbx_account_name, action)
+            return
+        logger.debug("[%s] Running scheduled %s on the call, %.1f ms after its target time", self.pbx_account_name,
+                     action, timer.lateness * 1000)
+        if isinstance(action, str):
+            getattr(self, action)(*args, call=phone_call)
+        else:
+            action(phone_call, *args)
 
     def wait_for_a_call_to_occur(self, time_out=60):
         """
         Wait for a call to happen, then continue when it does (with a time out)
         :param time_out: Int - The maximum number of seconds to wait for a call to happen
+        :return: PhoneCall - The current call, or None if no call happened
         """
-        logger.info("[{}] Waiting for a call to happen".format(self.pbx_account_name))
-        start_time = datetime.now()
-        log_seconds = self._round_up_current_datetime_seconds()
-        while (datetime.now() - start_time).seconds <= time_out:
-            if self.call:
-                logger.info("[{}] Call appears to have occurred, moving on".format(self.pbx_account_name))
-                break
-            candidate_log_seconds = self._round_up_current_datetime_seconds()
-            if log_seconds != candidate_log_seconds:
-                log_seconds = candidate_log_seconds
-                logger.debug("[{}] Waiting for an incoming call...".format(self.pbx_account_name))
-            time.sleep(0.1)
-
-    def wait_for_existing_call_to_end(self, time_out=60):
+        logger.info("[%s] Waiting for a call to happen", self.pbx_account_name)
+        if self._wait_for_state(self._call_has_occurred, time_out,
+                                waiting_message="Waiting for an incoming call..."):
+            logger.info("[%s] Call appears to have occurred, moving on", self.pbx_account_name)
+        return self.current_call
+
+    def wait_for_existing_call_to_end(self, time_out=60, call=None):
         """
         Wait for an existing call to end, then continue when it does (with a time out)
         :param time_out: Int - The maximum number of seconds to wait for a call to happen
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
         """
-        if not self.call:
+        try:
+            phone_call = self._validate_phone_call_in_progress(call)
+        except PhoneCallNotInProgress:
             raise PhoneCallNotInProgress("Cannot wait for call to end, as it has not started!")
         logger.info("Waiting for a call to end")
-        start_time = datetime.now()
-        log_seconds = self._round_up_current_datetime_seconds()
-        while (datetime.now() - start_time).seconds <= time_out:
-            if not self.call.is_valid():
-                logger.info("[{}] Call has ended, moving on".format(self.pbx_account_name))
-                break
-            candidate_log_seconds = self._round_up_current_datetime_seconds()
-            if log_seconds != candidate_log_seconds:
-                log_seconds = candidate_log_seconds
-                logger.debug("[{}] Waiting for the call to end...".format(self.pbx_account_name))
-            time.sleep(0.1)
-
-    def hang_up(self):
+        if self._wait_for_state(phone_call.has_ended, time_out,
+                                waiting_message="Waiting for the call to end..."):
+            logger.info("[%s] Call has ended, moving on", self.pbx_account_name)
+
+    def hang_up(self, call=None):
         """
         End an in progress call
-        """
-        logger.debug("[{}] Hang up call requested".format(self.pbx_account_name))
-        if self.call.is_valid() == 1:
-            self.call.hangup()
-            logger.info("[{}] Call has now hung up".format(self.pbx_account_name))
-            if self.audio_player_id:  # if audio playback is on, stop it
-                self.stop_audio_playback()
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        """
+        phone_call = self._validate_phone_call_in_progress(call)
+        logger.debug("[%s] Hang up call requested", self.pbx_account_name)
+        if phone_call.call.is_valid() == 1:
+            with self._state_changed:
+                if phone_call.call_state.hangup_requested_at is None:
+                    phone_call.call_state.hangup_requested_at = time.monotonic()
+            if phone_call.media_stats is not None:  # the last sample, whilst the stream is still there
+                self.pjsip_client.media_stats.sample(phone_call)
+            phone_call.call.hangup()
+            logger.info("[%s] Call has now hung up", self.pbx_account_name)
+            if phone_call.audio_player_id is not None:  # if audio playback is on, stop it
+                self.stop_audio_playback(phone_call)
         else:
-            logger.info("[{}] Call was already disconnected".format(self.pbx_account_name))
+            logger.info("[%s] Call was already disconnected", self.pbx_account_name)
+
+    def hang_up_all_calls(self):
+        """
+        End every call the phone has in progress
+        """
+        for phone_call in list(self.calls.values()):
+            self.hang_up(phone_call)
 
-    def send_dtmf_key_tones(self, digits):
+    def send_dtmf_key_tones(self, digits, call=None):
         """
         Send DTMF keypad tones to the call
         :param digits: String - Digits to send over the call
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        """
+        phone_call = self._validate_phone_call_in_progress(call)
+        logger.debug("[%s] Sending DTMF key tones '%s'", self.pbx_account_name, digits)
+        sent_at = time.monotonic()  # before pjsua has them, so a reply can't be timed as arriving first
+        phone_call.call.dial_dtmf(digits)
+        with self._state_changed:
+            phone_call.dtmf_sent += digits
+            phone_call.dtmf.record_sent(digits, sent_at)
+        logger.debug("[%s] DTMF tones sent", self.pbx_account_name)
+
+    def send_dtmf_sequence(self, sequence, call=None):
+        """
+        Play a scripted DTMF sequence on a call, on the PJSipClient's timer thread, without waiting for it
+        :param sequence: DTMFSequence or String - The sequence, or a dial string of digits with ',' for one second
+                         pauses (see DTMFSequence.parse)
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        :return: DTMFSequenceRun - Handle on the sequence, wait for it with 'wait_for_dtmf_sequence'
+        """
+        phone_call = self._validate_phone_call_in_progress(call)
+        if isinstance(sequence, str):
+            sequence = DTMFSequence.parse(sequence)
+        run = DTMFSequenceRun(self, phone_call, sequence)
+        with self._state_changed:
+            phone_call.dtmf_sequences += (run,)
+        logger.debug("[%s] Starting a DTMF sequence of %s steps", self.pbx_account_name, len(sequence))
+        run.start()
+        return run
+
+    def wait_for_dtmf_sequence(self, run, time_out=60):
+        """
+        Wait for a DTMF sequence to finish (with a time out)
+        :param run: DTMFSequenceRun - The sequence, as returned by 'send_dtmf_sequence'
+        :param time_out: Number - The maximum number of seconds to wait
+        :return: Boolean - True if every step of the sequence completed
         """
-        logger.debug("[{}] Sending DTMF key tones '{}'".format(self.pbx_account_name, digits))
-        self.call.dial_dtmf(digits)
-        logger.debug("[{}] DTMF tones sent".format(self.pbx_account_name))
+        self._wait_for_state(run.finished, time_out, "Waiting for the DTMF sequence to finish")
+        return run.state == "completed"
+
+    def wait_for_dtmf(self, pattern, time_out=10, call=None):
+        """
+        Wait for DTMF digits matching a pattern to be received on a call (with a time out)
+        Only digits received since the previous wait matched are looked at, and those up to the end of the match are
+        consumed. How long after the last digit sent the first digit of the match arrived is recorded in the
+        'dtmf_response_latency' histogram.
+        :param pattern: String or compiled regular expression - The digits wanted, e.g. "1" or r"\\d{4}#"
+        :param time_out: Number - The maximum number of seconds to wait
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        :return: DTMFMatch - The digits with their timings, None if they didn't arrive before the time out or the
+                 end of the call
+        """
+        phone_call = self._validate_phone_call_in_progress(call)
+        pattern = _as_pattern(pattern)
+        found = []
+
+        def matched():
+            if not found:
+                dtmf_match = phone_call.dtmf.match(pattern)
+                if dtmf_match:
+                    self.metrics.on_dtmf_match(dtmf_match)
+                    found.append(dtmf_match)
+            return bool(found) or phone_call.has_ended()
+
+        self._wait_for_state(matched, time_out, "Waiting for DTMF matching {!r}".format(pattern.pattern))
+        return found[0] if found else None
 
-    def start_audio_playback(self, audio_file_path, loop=True):
+    def start_audio_playback(self, audio_file_path, loop=True, call=None):
         """
         Play audio (WAV) on the call
+        The player comes from the PJSipClient's shared cache, so each file is only loaded once. Nothing is played if
+        the PJSipClient's media profile is signalling only.
         :param audio_file_path: String - path to the audio (WAV) file to be  played on the call
         :param loop: Boolean - Should the audio file be played in a loop (True), or just once (False)
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        """
+        phone_call = self._validate_phone_call_in_progress(call)
+        if self.pjsip_client.signalling_only:
+            logger.debug("[%s] Signalling only, not playing %s", self.pbx_account_name, audio_file_path)
+            return
+        logger.debug("[%s] Attempting to play audio from %s", self.pbx_account_name, audio_file_path)
+        if phone_call.audio_player_id is not None:
+            self.stop_audio_playback(phone_call)
+        phone_call.call_slot_number = phone_call.call_state.conf_slot
+        if phone_call.call_slot_number < 0:  # media not yet published by the callbacks (e.g. just answered)
+            phone_call.call_slot_number = phone_call.call.info().conf_slot
+        player_id, player_slot_id = self.pjsip_client.audio_players.acquire(audio_file_path, loop)
+        with self._state_changed:
+            phone_call.audio_player_id, phone_call.audio_player_slot_id = player_id, player_slot_id
+            ended = phone_call.has_ended()
+        if ended:  # the call ended whilst the player was being set up, after it would have been released
+            player_id, _ = self._detach_audio_player(phone_call)
+            if player_id is not None:
+                self.pjsip_client.audio_players.release(player_id)
+                self.pjsip_client.resources.on_reclaimed("players")
+            raise PhoneCallNotInProgress("The call ended before the audio could be played")
+        self.lib.conf_connect(player_slot_id, phone_call.call_slot_number)
+        phone_call.audio_played.append(audio_file_path)
+        logger.debug("[%s] Audio file '%s' is now being played on the call", self.pbx_account_name, audio_file_path)
+
+    def _detach_audio_player(self, phone_call):
+        """
+        Take the call's audio player away from it, so that only one thread hands it back to the cache
+        :param phone_call: PhoneCall - Handle for the call
+        :return: Tuple (Int - player id, Int - conference slot of the player), the player id is None if there wasn't one
         """
-        logger.debug("[{}] Attempting to play audio from {}".format(self.pbx_account_name, audio_file_path))
-        import os
-        if not os.path.exists(audio_file_path):
-            raise FileNotFoundError("[{}] Cannot find your audio file: {}".format(self.pbx_account_name,
-                                                                                  audio_file_path))
-        if not os.path.isfile(audio_file_path):
-            raise FileNotFoundError("[{}] Your audio file is not a file: {}".format(self.pbx_account_name,
-                                                                                    audio_file_path))
-        self.call_slot_number = self.call.info().conf_slot
-        self.audio_player_id = self.lib.create_player(audio_file_path, loop=loop)
-        self.audio_player_slot_id = self.lib.player_get_slot(self.audio_player_id)
-        self.lib.conf_connect(self.audio_player_slot_id, self.call_slot_number)
-        logger.debug("[{}] Audio file '{}' is now being played on the call".format(self.pbx_account_name,
-                                                                                   audio_file_path))
-
-    def stop_audio_playback(self):
+        with self._state_changed:
+            player = phone_call.audio_player_id, phone_call.audio_player_slot_id
+            phone_call.audio_player_id = None
+            phone_call.audio_player_slot_id = None
+        return player
+
+    def stop_audio_playback(self, call=None):
         """
         Stop the audio playback on the call
+        The player is returned to the shared cache, it is only destroyed once no call is using it.
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        """
+        phone_call = self._validate_phone_call_in_progress(call)
+        player_id, player_slot_id = self._detach_audio_player(phone_call)
+        if player_id is None:
+            return
+        self.lib.conf_disconnect(player_slot_id, phone_call.call_slot_number)
+        self.pjsip_client.audio_players.release(player_id)
+        logger.debug("[%s] Audio playback on the call has ben stopped", self.pbx_account_name)
+
+    def start_recording(self, file_path, call=None):
+        """
+        Record the audio received on the call (what the far end sends) to a WAV file
+        The file is complete once the recording is stopped, or the call ends. Nothing is recorded if the
+        PJSipClient's media profile is signalling only.
+        :param file_path: String - Path of the WAV file to write
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        """
+        phone_call = self._validate_phone_call_in_progress(call)
+        if self.pjsip_client.signalling_only:
+            logger.debug("[%s] Signalling only, not recording to %s", self.pbx_account_name, file_path)
+            return
+        if phone_call.recorder_id is not None:
+            self.stop_recording(phone_call)
+        call_slot = phone_call.call_state.conf_slot
+        if call_slot < 0:  # media not yet published by the callbacks
+            call_slot = phone_call.call.info().conf_slot
+        recorder_id = self.lib.create_recorder(file_path)
+        self.pjsip_client.resources.add("recorders")
+        recorder_slot_id = self.lib.recorder_get_slot(recorder_id)
+        with self._state_changed:
+            phone_call.recorder_id, phone_call.recorder_slot_id = recorder_id, recorder_slot_id
+            phone_call.recording_path = file_path
+            ended = phone_call.has_ended()
+        if ended:  # the call ended whilst the recorder was being set up, after it would have been destroyed
+            recorder_id, _ = self._detach_recorder(phone_call)
+            if recorder_id is not None:
+                self._destroy_recorder(recorder_id)
+                self.pjsip_client.resources.on_reclaimed("recorders")
+            raise PhoneCallNotInProgress("The call ended before it could be recorded")
+        self.lib.conf_connect(call_slot, recorder_slot_id)
+        logger.debug("[%s] Recording the call to %s", self.pbx_account_name, file_path)
+
+    def _detach_recorder(self, phone_call):
         """
-        self.lib.conf_disconnect(self.audio_player_slot_id, self.call_slot_number)
-        self.lib.player_destroy(self.audio_player_id)
-        logger.debug("[{}] Audio playback on the call has ben stopped".format(self.pbx_account_name))
+        Take the call's recorder away from it, so that only one thread destroys it
+        :param phone_call: PhoneCall - Handle for the call
+        :return: Tuple (Int - recorder id, Int - conference slot of the recorder), the id is None if there wasn't one
+        """
+        with self._state_changed:
+            recorder = phone_call.recorder_id, phone_call.recorder_slot_id
+            phone_call.recorder_id = None
+            phone_call.recorder_slot_id = None
+        return recorder
+
+    def _destroy_recorder(self, recorder_id):
+        """
+        Destroy a recorder taken away from its call with '_detach_recorder'
+        :param recorder_id: Int - The recorder
+        """
+        self.lib.recorder_destroy(recorder_id)
+        self.pjsip_client.resources.add("recorders", -1)
+
+    def stop_recording(self, call=None):
+        """
+        Stop recording the call and complete the WAV file
+        :param call: PhoneCall or String - The call (or its Call-ID), defaults to the current call
+        :return: String - Path of the recording (None if the call wasn't being recorded)
+        """
+        phone_call = self._validate_phone_call_in_progress(call)
+        recorder_id, _ = self._detach_recorder(phone_call)
+        if recorder_id is None:
+            return None
+        self._destroy_recorder(recorder_id)  # removing its conference port disconnects it from the call
+        logger.debug("[%s] Recording of the call stopped", self.pbx_account_name)
+        return phone_call.recording_path
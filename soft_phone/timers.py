@@ -0,0 +1,140 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from soft_phone.metrics import CALLBACK_BUCKETS, Histogram
+
+logger = logging.getLogger(__name__)
+
+
+class Timer:
+    """
+    A callback scheduled with a TimerService, which can be cancelled until it has run
+    """
+    __slots__ = ("due", "callback", "args", "cancelled", "fired_at")
+
+    def __init__(self, due, callback, args):
+        """
+        :param due: Float - time.monotonic() at which to run the callback (None until it is known)
+        :param callback: Callable - Called with 'args'
+        :param args: Tuple - Arguments of the callback
+        """
+        self.due = due
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.fired_at = None
+
+    def cancel(self):
+        """ Stop the callback from running (no effect once it has run) """
+        self.cancelled = True
+
+    @property
+    def lateness(self):
+        """ Seconds after its due time the callback was run (None until it has run) """
+        return None if self.fired_at is None else self.fired_at - self.due
+
+
+class TimerService:
+    """
+    Runs callbacks after a delay on a single thread, so that nothing has to sleep on a pjsua callback thread
+
+    The timers are kept in a heap and the thread sleeps until the earliest is due, so any number of timers cost
+    nothing whilst they wait. Callbacks run one at a time and must return quickly. How late each one runs is
+    recorded in the 'lateness' histogram.
+    """
+
+    def __init__(self, name="soft-phone-timers", on_thread_start=None):
+        """
+        :param name: String - Name of the timer thread
+        :param on_thread_start: Callable - Run on the timer thread before any callback, e.g. to register it with PJSip
+        """
+        self.name = name
+        self.on_thread_start = on_thread_start
+        self._timers = []  # heap of (due, sequence, Timer)
+        self._sequence = itertools.count()
+        self._wake = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self.lateness = Histogram(CALLBACK_BUCKETS)  # only written by the timer thread
+
+    def __len__(self):
+        return len(self._timers)
+
+    def schedule(self, delay, callback, *args):
+        """
+        Run a callback on the timer thread after a delay (starting the thread if need be)
+        :param delay: Number - Seconds from now
+        :param callback: Callable - Called with 'args'
+        :return: Timer - Handle to cancel the callback with
+        """
+        return self.schedule_at(time.monotonic() + max(0.0, delay), callback, *args)
+
+    def schedule_at(self, due, callback, *args):
+        """
+        Run a callback on the timer thread at a point in time
+        :param due: Float - time.monotonic() at which to run the callback (at once if it has passed)
+        :param callback: Callable - Called with 'args'
+        :return: Timer - Handle to cancel the callback with
+        """
+        return self.schedule_timer(Timer(due, callback, args), due)
+
+    def schedule_timer(self, timer, due):
+        """
+        Schedule a Timer created beforehand, e.g. whilst waiting for the moment it is relative to
+        :param timer: Timer - The timer (if it has been cancelled already it is dropped when due)
+        :param due: Float - time.monotonic() at which to run it
+        :return: Timer - The timer
+        """
+        timer.due = due
+        with self._wake:
+            if self._stopping:
+                raise RuntimeError("The timer service has been stopped")
+            heapq.heappush(self._timers, (timer.due, next(self._sequence), timer))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            elif self._timers[0][2] is timer:  # it is due before whatever the thread is waiting for
+                self._wake.notify()
+        return timer
+
+    def stats(self):
+        """
+        :return: Dict - The number of timers waiting and a snapshot of how late the callbacks have run
+        """
+        return {"pending": len(self._timers), "lateness": self.lateness.snapshot()}
+
+    def stop(self):
+        """ Stop the timer thread, any timers still waiting are dropped """
+        with self._wake:
+            self._stopping = True
+            self._timers = []
+            self._wake.notify()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self):
+        if self.on_thread_start:
+            self.on_thread_start()
+        while True:
+            with self._wake:
+                while not self._stopping:
+                    if self._timers:
+                        remaining = self._timers[0][0] - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._wake.wait(remaining)
+                    else:
+                        self._wake.wait()
+                if self._stopping:
+                    return
+                timer = heapq.heappop(self._timers)[2]
+            if timer.cancelled:
+                continue
+            timer.fired_at = time.monotonic()
+            self.lateness.observe(timer.fired_at - timer.due)
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception("Timer callback %r failed", timer.callback)
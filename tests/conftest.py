@@ -0,0 +1,67 @@
+"""
+Fixtures running the soft_phone control code against the fake pjsua backend, so the suite runs on any machine
+"""
+import pytest
+from soft_phone.backend import use_backend
+
+use_backend("fake")  # before any module using pjsua is imported
+
+from soft_phone import fake_pjsua  # noqa: E402
+from soft_phone.manage_pjsip import PJSipClient  # noqa: E402
+from soft_phone.soft_phone import SoftPhone  # noqa: E402
+
+PBX_IP = "10.0.0.1"
+PASSWORD = "secret"
+
+
+@pytest.fixture(autouse=True)
+def fake_pbx(monkeypatch):
+    """
+    The simulated PBX's settings, reset for every test and with short delays so the tests run quickly
+    """
+    monkeypatch.setattr(fake_pjsua, "settings", fake_pjsua.Settings())
+    fake_pjsua.configure(registration_delay=0.001, ring_delay=0.01, answer_delay=0.01)
+    return fake_pjsua.settings
+
+
+@pytest.fixture
+def client_factory():
+    """
+    Callable returning a started PJSipClient, stopped once the test is over: client_factory(**pjsip_client_kwargs)
+    """
+    clients = []
+
+    def factory(**pjsip_client_kwargs):
+        pjsip_client_kwargs.setdefault("log_file", None)
+        client = PJSipClient(**pjsip_client_kwargs)
+        client.start()
+        clients.append(client)
+        return client
+
+    yield factory
+    for client in clients:
+        client.stop()
+
+
+@pytest.fixture
+def pjsip_client(client_factory):
+    """
+    A started PJSipClient with the default settings
+    """
+    return client_factory()
+
+
+@pytest.fixture
+def phone_factory(pjsip_client):
+    """
+    Callable returning a SoftPhone on 'pjsip_client', registered unless told otherwise:
+    phone_factory(pbx_account_name, register=True, **soft_phone_kwargs)
+    """
+
+    def factory(pbx_account_name, register=True, **soft_phone_kwargs):
+        phone = SoftPhone(pjsip_client, PBX_IP, pbx_account_name, PASSWORD, **soft_phone_kwargs)
+        if register:
+            phone.register_soft_phone(time_out=5)
+        return phone
+
+    return factory
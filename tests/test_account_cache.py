@@ -0,0 +1,86 @@
+import time
+import pytest
+from soft_phone.config import PJSipConfig, TransportSettings
+from soft_phone.soft_phone import SoftPhone
+
+
+@pytest.fixture
+def cached_client(client_factory):
+    return client_factory(account_cache_size=2, account_cache_ttl=60,
+                          config=PJSipConfig([TransportSettings(), TransportSettings()]))
+
+
+def phone(client, pbx_account_name, **soft_phone_kwargs):
+    soft_phone = SoftPhone(client, "10.0.0.1", pbx_account_name, "secret", **soft_phone_kwargs)
+    soft_phone.register_soft_phone(time_out=5)
+    assert soft_phone.reg_status == 200
+    return soft_phone
+
+
+def test_unregistered_account_is_reused(cached_client):
+    first = phone(cached_client, "100")
+    account = first.account
+    first.unregister_soft_phone()
+    assert cached_client.account_cache.stats()["idle"] == 1
+    second = phone(cached_client, "100")
+    assert second.account is account
+    assert second.metrics.counters["registrations_reused"] == 1
+    assert cached_client.account_cache.stats() == {"idle": 0, "hits": 1, "misses": 1, "evictions": 0}
+
+
+def test_reused_account_receives_calls(cached_client):
+    phone(cached_client, "200", action_on_incoming_call="BUSY").unregister_soft_phone()
+    callee = phone(cached_client, "200", action_on_incoming_call="ANSWER")
+    caller = phone(cached_client, "100")
+    phone_call = caller.make_call("200", time_out=5)
+    assert phone_call.is_connected()
+    assert callee.current_call.is_connected()
+
+
+def test_parked_account_turns_calls_away(cached_client):
+    phone(cached_client, "200", action_on_incoming_call="ANSWER").unregister_soft_phone()
+    caller = phone(cached_client, "100")
+    phone_call = caller.make_call("200", time_out=5)
+    assert phone_call.last_code == 480
+
+
+def test_accounts_are_kept_per_transport(cached_client):
+    phone(cached_client, "100", transport=0).unregister_soft_phone()
+    other_transport = phone(cached_client, "100", transport=1)
+    assert other_transport.metrics.counters["registrations_reused"] == 0
+    same_transport = phone(cached_client, "100", transport=0)
+    assert same_transport.metrics.counters["registrations_reused"] == 1
+
+
+def test_least_recently_parked_are_evicted(cached_client):
+    for pbx_account_name in ("100", "101", "102"):
+        phone(cached_client, pbx_account_name).unregister_soft_phone()
+    assert cached_client.account_cache.stats()["idle"] == 2
+    assert cached_client.account_cache.evictions == 1
+    assert phone(cached_client, "100").metrics.counters["registrations_reused"] == 0
+    assert phone(cached_client, "102").metrics.counters["registrations_reused"] == 1
+
+
+def test_idle_accounts_expire(client_factory):
+    client = client_factory(account_cache_size=2, account_cache_ttl=0.05)
+    phone(client, "100").unregister_soft_phone()
+    deadline = time.monotonic() + 5
+    while len(client.account_cache) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(client.account_cache) == 0
+    assert client.resources.counts["accounts"] == 0
+
+
+def test_prewarmed_account(cached_client):
+    cached_client.account_cache.prewarm("10.0.0.1", "100", "secret", cached_client.transports[1])
+    assert phone(cached_client, "100", transport=0).metrics.counters["registrations_reused"] == 0
+    assert phone(cached_client, "100", transport=1).metrics.counters["registrations_reused"] == 1
+
+
+def test_failed_registration_is_not_cached(client_factory, fake_pbx):
+    client = client_factory(account_cache_size=2)
+    fake_pbx.registration_status = 403
+    soft_phone = SoftPhone(client, "10.0.0.1", "100", "secret")
+    soft_phone.register_soft_phone(time_out=5)
+    soft_phone.unregister_soft_phone()
+    assert len(client.account_cache) == 0
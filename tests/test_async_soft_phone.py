@@ -0,0 +1,92 @@
+import asyncio
+import threading
+from soft_phone.async_soft_phone import AsyncSoftPhone
+
+PBX_IP = "10.0.0.1"
+PASSWORD = "secret"
+
+
+def run_on_recording_loop(coroutine_function):
+    """
+    Run a coroutine on a fresh event loop whose 'call_soon_threadsafe' records the threads calling it and the
+    thread the scheduled callbacks run on
+    """
+    handed_over = []
+
+    async def main():
+        event_loop = asyncio.get_running_loop()
+        call_soon_threadsafe = event_loop.call_soon_threadsafe
+
+        def recording_call_soon_threadsafe(callback, *args, **kwargs):
+            caller = threading.get_ident()
+
+            def run_callback(*callback_args):
+                handed_over.append((caller, threading.get_ident()))
+                callback(*callback_args)
+
+            return call_soon_threadsafe(run_callback, *args, **kwargs)
+
+        event_loop.call_soon_threadsafe = recording_call_soon_threadsafe
+        return await coroutine_function(), threading.get_ident()
+
+    result, loop_thread = asyncio.run(main())
+    return result, loop_thread, handed_over
+
+
+def test_register_call_and_unregister(pjsip_client):
+    phone = AsyncSoftPhone(pjsip_client, PBX_IP, "100", PASSWORD)
+
+    async def scenario():
+        assert await phone.register(time_out=5)
+        assert phone._event_loop is asyncio.get_running_loop()
+        phone_call = await phone.make_call("900", time_out=5)
+        assert phone_call.is_connected()
+        assert await phone.wait_for_call_length(0.05, time_out=5, call=phone_call)
+        await phone.hang_up(time_out=5, call=phone_call)
+        assert phone_call.has_ended()
+        await phone.unregister(time_out=5)
+        return phone_call
+
+    phone_call, loop_thread, handed_over = run_on_recording_loop(scenario)
+    assert phone_call.has_ended()
+    assert pjsip_client.resources.counts["accounts"] == 0
+    # every wait was resolved by a callback thread handing the state change over to the loop's own thread
+    assert handed_over
+    assert all(caller != loop_thread and runner == loop_thread for caller, runner in handed_over)
+
+
+def test_failed_registration(pjsip_client, fake_pbx):
+    fake_pbx.registration_status = 403
+    phone = AsyncSoftPhone(pjsip_client, PBX_IP, "100", PASSWORD)
+    registered, _, _ = run_on_recording_loop(lambda: phone.register(time_out=5))
+    assert registered is False
+    assert phone.soft_phone.reg_status == 403
+
+
+def test_wait_for_call_length_when_the_far_end_hangs_up(pjsip_client):
+    caller = AsyncSoftPhone(pjsip_client, PBX_IP, "100", PASSWORD)
+    callee = AsyncSoftPhone(pjsip_client, PBX_IP, "200", PASSWORD)
+
+    async def scenario():
+        await asyncio.gather(caller.register(time_out=5), callee.register(time_out=5))
+        phone_call = await caller.make_call("200", time_out=5)
+        incoming_call = await callee.wait_for_call(time_out=5)
+        callee.hang_up_after(0.05, call=incoming_call)
+        reached = await caller.wait_for_call_length(5, time_out=5, call=phone_call)
+        return reached, phone_call
+
+    (reached, phone_call), _, _ = run_on_recording_loop(scenario)
+    assert reached is False
+    assert phone_call.has_ended()
+
+
+def test_wait_times_out(pjsip_client):
+    phone = AsyncSoftPhone(pjsip_client, PBX_IP, "100", PASSWORD)
+
+    async def scenario():
+        await phone.register(time_out=5)
+        return await phone.wait_for_call(time_out=0.05)
+
+    incoming_call, _, _ = run_on_recording_loop(scenario)
+    assert incoming_call is None
+    assert phone._waiters == []
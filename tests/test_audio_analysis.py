@@ -0,0 +1,105 @@
+import wave
+import pytest
+from soft_phone import audio_analysis
+from soft_phone.audio_analysis import DTMF_HIGH_FREQUENCIES, DTMF_KEYS, DTMF_LOW_FREQUENCIES
+
+np = pytest.importorskip("numpy")
+
+
+def tone(frequencies, duration, sample_rate=8000, level=0.3):
+    """ Sum of sine waves, each at 'level' of full scale """
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    return sum(level * np.sin(2 * np.pi * frequency * t) for frequency in frequencies)
+
+
+def silence(duration, sample_rate=8000):
+    return np.zeros(int(duration * sample_rate))
+
+
+def dtmf(digits, sample_rate=8000, on=0.06, off=0.06):
+    """ The digits as in-band DTMF, each 'on' seconds of tone followed by 'off' seconds of silence """
+    frequencies = {key: (low, high) for low, keys in zip(DTMF_LOW_FREQUENCIES, DTMF_KEYS)
+                   for high, key in zip(DTMF_HIGH_FREQUENCIES, keys)}
+    return np.concatenate([part for digit in digits
+                           for part in (tone(frequencies[digit], on, sample_rate), silence(off, sample_rate))])
+
+
+def write_wav(path, samples, sample_rate):
+    with wave.open(str(path), "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes((np.clip(samples, -1, 1) * 32767).astype("<i2").tobytes())
+    return str(path)
+
+
+@pytest.mark.parametrize("sample_rate", [8000, 16000])
+def test_detect_dtmf(sample_rate):
+    digits = "1234567890*#ABCD"
+    assert audio_analysis.detect_dtmf(dtmf(digits, sample_rate), sample_rate) == digits
+
+
+def test_detect_dtmf_repeated_digits_and_noise():
+    samples = np.concatenate((silence(0.2), dtmf("5500"), silence(0.2)))
+    samples += np.random.default_rng(1).normal(0, 0.01, len(samples))
+    assert audio_analysis.detect_dtmf(samples, 8000) == "5500"
+
+
+def test_detect_dtmf_ignores_what_is_not_a_digit():
+    assert audio_analysis.detect_dtmf(tone((697,), 0.2), 8000) == ""  # only one of the two tones
+    assert audio_analysis.detect_dtmf(tone((697, 1209), 0.2, level=0.001), 8000) == ""  # too quiet
+    assert audio_analysis.detect_dtmf(tone((697, 1209), 0.02), 8000) == ""  # too short
+    assert audio_analysis.detect_dtmf(silence(0.01), 8000) == ""
+
+
+def test_detect_tone():
+    samples = np.concatenate((silence(0.5), tone((1000,), 1.0), silence(0.5), tone((425,), 0.3), silence(0.2)))
+    [(start, end)] = audio_analysis.detect_tone(samples, 8000, 1000)
+    assert start == pytest.approx(0.5, abs=0.02) and end == pytest.approx(1.5, abs=0.02)
+    [(start, end)] = audio_analysis.detect_tone(samples, 8000, 425)
+    assert start == pytest.approx(2.0, abs=0.02) and end == pytest.approx(2.3, abs=0.02)
+    assert audio_analysis.detect_tone(samples, 8000, 2000) == []
+
+
+def test_segment_silence():
+    samples = np.concatenate((tone((440,), 0.5), silence(0.5), tone((440,), 0.1), silence(0.1), tone((440,), 0.3)))
+    segments = audio_analysis.segment_silence(samples, 8000)
+    # the 0.1 second gap is shorter than 'min_silence', so it is part of the sound around it
+    assert [is_silent for _, _, is_silent in segments] == [False, True, False]
+    assert [(start, end) for start, end, _ in segments] == pytest.approx([(0, 0.5), (0.5, 1.0), (1.0, 1.5)])
+    assert audio_analysis.segment_silence(silence(1.0), 8000) == [(0.0, pytest.approx(1.0), True)]
+
+
+def test_playback_latency():
+    reference = np.random.default_rng(2).uniform(-0.5, 0.5, 4000)
+    recording = np.concatenate((silence(0.37), 0.5 * reference, silence(0.3)))
+    latency, correlation = audio_analysis.playback_latency(recording, reference, 8000)
+    assert latency == pytest.approx(0.37, abs=1 / 8000.0)
+    assert correlation == pytest.approx(1.0, abs=0.01)
+    # not searched far enough into the recording to find it
+    latency, correlation = audio_analysis.playback_latency(recording, reference, 8000, max_latency=0.1)
+    assert correlation < 0.2
+    assert audio_analysis.playback_latency(reference[:100], reference, 8000) == (None, 0.0)
+
+
+def test_analyse_recording_finds_a_delayed_reference(tmp_path):
+    reference = np.random.default_rng(3).uniform(-0.5, 0.5, 8000)  # half a second at 16 kHz
+    reference_path = write_wav(tmp_path / "reference.wav", reference, 16000)
+    # the far end played the reference 0.25 seconds into the call, recorded at 8 kHz, then two digits and a tone
+    recording = np.concatenate((silence(0.25), reference[::2], silence(0.3), dtmf("42"), silence(0.3),
+                                tone((1000,), 0.2), silence(0.3)))
+    recording_path = write_wav(tmp_path / "recording.wav", recording, 8000)
+    result = audio_analysis.analyse_recording(recording_path, reference_path=reference_path, tones=(1000,))
+    assert result["latency"] == pytest.approx(0.25, abs=1 / 8000.0)
+    assert result["correlation"] > 0.99
+    assert result["dtmf"] == "42"
+    assert result["duration"] == pytest.approx(len(recording) / 8000.0)
+    assert [is_silent for _, _, is_silent in result["segments"]] == [True, False, True, False, True, False, True]
+    [(start, end)] = result["tones"][1000]
+    assert (start, end) == pytest.approx((len(recording) / 8000.0 - 0.5, len(recording) / 8000.0 - 0.3), abs=0.02)
+
+
+def test_analyse_recording_which_cannot_be_read(tmp_path):
+    path = tmp_path / "broken.wav"
+    path.write_bytes(b"not a wav file")
+    assert "error" in audio_analysis.analyse_recording(str(path))
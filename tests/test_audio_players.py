@@ -0,0 +1,90 @@
+import pytest
+from soft_phone.audio_players import AudioPlayerCache
+
+
+@pytest.fixture
+def audio_files(tmp_path):
+    paths = []
+    for name in ("a", "b", "c", "d"):
+        path = tmp_path / "{}.wav".format(name)
+        path.write_bytes(b"")
+        paths.append(str(path))
+    return paths
+
+
+@pytest.fixture
+def cache(pjsip_client):
+    return AudioPlayerCache(pjsip_client.lib, max_idle_players=2)
+
+
+def test_looped_players_are_shared_and_reference_counted(cache, audio_files, pjsip_client):
+    first = cache.acquire(audio_files[0], loop=True)
+    second = cache.acquire(audio_files[0], loop=True)
+    assert first == second
+    assert len(cache) == 1
+    player_id = first[0]
+    assert cache._players[player_id].users == 2
+    cache.release(player_id)
+    assert cache._players[player_id].users == 1
+    assert player_id not in cache._idle
+    cache.release(player_id)
+    assert list(cache._idle) == [player_id]
+    assert player_id in pjsip_client.lib._players  # idle players are kept for the next call
+    assert cache.acquire(audio_files[0], loop=True) == first
+    assert cache._idle == {}
+
+
+def test_play_once_players_are_only_reused_when_idle_and_rewound(cache, audio_files, pjsip_client, monkeypatch):
+    rewound = []
+    monkeypatch.setattr(pjsip_client.lib, "player_set_pos", lambda player_id, pos: rewound.append((player_id, pos)))
+    first = cache.acquire(audio_files[0], loop=False)
+    second = cache.acquire(audio_files[0], loop=False)
+    assert first != second
+    cache.release(first[0])
+    assert cache.acquire(audio_files[0], loop=False) == first
+    assert rewound == [(first[0], 0)]
+
+
+def test_releasing_a_player_not_in_use(cache, audio_files, caplog):
+    player_id, _ = cache.acquire(audio_files[0])
+    cache.release(player_id)
+    cache.release(player_id)
+    cache.release(12345)
+    assert caplog.text.count("is not in use, it can't be released") == 2
+    assert cache._players[player_id].users == 0
+
+
+def test_least_recently_used_idle_players_are_evicted(cache, audio_files, pjsip_client):
+    player_ids = [cache.acquire(path)[0] for path in audio_files[:3]]
+    for player_id in player_ids:
+        cache.release(player_id)
+    # 'max_idle_players' is 2, so the least recently used ('a') has been destroyed
+    assert list(cache._idle) == player_ids[1:]
+    assert player_ids[0] not in pjsip_client.lib._players
+    assert len(cache) == 2
+    cache.acquire(audio_files[1])  # 'b' is now the most recently used
+    cache.release(player_ids[1])
+    cache.release(cache.acquire(audio_files[3])[0])
+    assert list(cache._idle) == [player_ids[1], cache._shared[(audio_files[3], True)].player_id]
+    assert player_ids[2] not in pjsip_client.lib._players
+
+
+def test_players_in_use_are_never_evicted(cache, audio_files, pjsip_client):
+    in_use, _ = cache.acquire(audio_files[0])
+    for path in audio_files[1:]:
+        cache.release(cache.acquire(path, loop=False)[0])
+    assert in_use in pjsip_client.lib._players
+    assert in_use not in cache._idle
+    assert len(cache._idle) == 2
+    cache.clear()
+    assert list(cache._players) == [in_use]
+    assert cache.acquire(audio_files[0])[0] == in_use
+    assert cache._players[in_use].users == 2
+
+
+def test_missing_audio_file(cache, tmp_path):
+    with pytest.raises(FileNotFoundError):
+        cache.acquire(str(tmp_path / "missing.wav"))
+    with pytest.raises(FileNotFoundError):
+        cache.acquire(str(tmp_path))
+    assert len(cache) == 0
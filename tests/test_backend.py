@@ -0,0 +1,24 @@
+import pytest
+from soft_phone import backend, fake_pjsua
+
+
+def test_fake_backend_is_selected():
+    assert backend.selected_backend() == "soft_phone.fake_pjsua"
+    assert backend.get_backend() is fake_pjsua
+
+
+def test_backend_cannot_change_once_loaded():
+    backend.use_backend("fake")  # choosing the same one again is allowed
+    with pytest.raises(RuntimeError):
+        backend.use_backend("pjsua")
+
+
+def test_fake_pbx_settings_are_reset_for_each_test(fake_pbx):
+    assert fake_pbx is fake_pjsua.settings
+    assert fake_pbx.registration_status == 200
+    fake_pbx.registration_status = 503
+
+
+def test_fake_pbx_rejects_unknown_settings():
+    with pytest.raises(AttributeError):
+        fake_pjsua.configure(no_such_setting=1)
@@ -0,0 +1,143 @@
+import csv
+import json
+import sqlite3
+import threading
+import types
+import pytest
+from soft_phone.cdr import CDR_FIELDS, CDRWriter, RotatingSink, SqliteSink
+from soft_phone.soft_phone import SoftPhone
+
+
+@pytest.fixture
+def make_calls(client_factory, fake_pbx):
+    """
+    Callable making an answered call and a rejected one on a client writing CDRs, then stopping it so every record
+    is written: make_calls(path, format)
+    """
+    fake_pbx.answer_status = 404
+
+    def calls(path, format):
+        client = client_factory(cdr_writer=CDRWriter(str(path), format=format, flush_interval=0.01))
+        caller = SoftPhone(client, "10.0.0.1", "100", "secret")
+        callee = SoftPhone(client, "10.0.0.1", "200", "secret", action_on_incoming_call="ANSWER")
+        caller.register_soft_phone(time_out=5)
+        callee.register_soft_phone(time_out=5)
+        answered = caller.make_call("200", time_out=5)
+        caller.send_dtmf_key_tones("12", call=answered)
+        assert callee.wait_for_dtmf("12", time_out=5, call=callee.current_call)
+        caller.hang_up(call=answered)
+        caller.wait_for_existing_call_to_end(time_out=5, call=answered)
+        rejected = caller.make_call("404", time_out=5)
+        client.stop()
+        return answered, rejected
+
+    return calls
+
+
+def test_jsonl(make_calls, tmp_path):
+    path = tmp_path / "cdr.jsonl"
+    answered, rejected = make_calls(path, "jsonl")
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert all(set(record) == set(CDR_FIELDS) for record in records)
+    by_call = {record["call_id"]: record for record in records}
+    assert len(records) == 3  # both legs of the answered call, and the rejected call
+    outgoing = by_call[answered.call_id]
+    assert (outgoing["direction"], outgoing["caller"], outgoing["callee"]) == ("outgoing", "100", "200")
+    assert outgoing["connected_at"] is not None
+    assert outgoing["dtmf_sent"] == "12"
+    assert by_call[rejected.call_id]["last_code"] == 404
+    assert by_call[rejected.call_id]["connected_at"] is None
+    incoming = [record for record in records if record["direction"] == "incoming"]
+    assert [(record["caller"], record["callee"], record["dtmf_received"]) for record in incoming] == [
+        ("100", "200", "12")]
+
+
+def test_csv(make_calls, tmp_path):
+    path = tmp_path / "cdr.csv"
+    make_calls(path, "csv")
+    with open(str(path), newline="") as csv_file:
+        rows = list(csv.reader(csv_file))
+    assert tuple(rows[0]) == CDR_FIELDS
+    assert len(rows) == 4
+
+
+def test_sqlite(make_calls, tmp_path):
+    path = tmp_path / "cdr.db"
+    answered, _ = make_calls(path, "sqlite")
+    connection = sqlite3.connect(str(path))
+    rows = connection.execute("SELECT call_id, direction, last_code FROM cdr").fetchall()
+    assert len(rows) == 3
+    assert (answered.call_id, "outgoing", 200) in rows
+
+
+def test_sqlite_adds_missing_columns(tmp_path):
+    path = str(tmp_path / "cdr.db")
+    old_fields = CDR_FIELDS[:13]
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE cdr ({})".format(", ".join(old_fields)))
+    connection.execute("INSERT INTO cdr VALUES ({})".format(", ".join("?" * len(old_fields))), old_fields)
+    connection.commit()
+    connection.close()
+    sink = SqliteSink(path)
+    sink.write([types.SimpleNamespace(as_row=lambda: tuple(range(len(CDR_FIELDS))))])
+    sink.close()
+    connection = sqlite3.connect(path)
+    assert [row[1] for row in connection.execute("PRAGMA table_info(cdr)")] == list(CDR_FIELDS)
+    rows = connection.execute("SELECT * FROM cdr ORDER BY rowid").fetchall()
+    assert rows[0][len(old_fields)] is None
+    assert rows[1] == tuple(range(len(CDR_FIELDS)))
+
+
+def test_invalid_format(tmp_path):
+    with pytest.raises(ValueError):
+        CDRWriter(str(tmp_path / "cdr.txt"), format="txt")
+
+
+class BlockedSink(RotatingSink):
+    """
+    Sink whose writes wait until 'release' is set
+    """
+
+    def __init__(self, path):
+        self.release = threading.Event()
+        self.records = []
+        RotatingSink.__init__(self, path)
+
+    def _open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, records):
+        self.release.wait(5)
+        self.records.extend(records)
+
+    def flush(self, fsync=False):
+        pass
+
+
+def test_full_queue_drops_records(tmp_path):
+    sink = BlockedSink(str(tmp_path / "cdr"))
+    writer = CDRWriter(None, sink=sink, max_queue_size=2, flush_interval=0.01)
+    records = [types.SimpleNamespace(account="100") for _ in range(10)]
+    threads = [threading.Thread(target=writer.submit_record, args=(record,)) for record in records]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sink.release.set()
+    writer.close()
+    stats = writer.stats()
+    assert stats["dropped"] + stats["written"] == len(records)
+    assert stats["dropped"] >= len(records) - 4  # only the queue and the batch the writer is blocked on were kept
+    assert len(sink.records) == stats["written"]
+
+
+def test_rotating_sink_hooks_are_abstract(tmp_path):
+    class Incomplete(RotatingSink):
+        def _open(self):
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete(str(tmp_path / "cdr"))
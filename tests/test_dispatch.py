@@ -0,0 +1,112 @@
+import asyncio
+import random
+import threading
+import time
+import pytest
+from collections import defaultdict
+from soft_phone.backend import get_backend
+from soft_phone.dispatch import EventDispatcher, PhoneEvent
+
+pj = get_backend()
+
+
+@pytest.fixture
+def pjsip_client(client_factory):
+    return client_factory(max_calls=32)
+
+
+def test_the_events_of_each_call_are_handled_in_order(phone_factory):
+    caller = phone_factory("100")
+    handled = defaultdict(list)  # Call-ID -> events in the order they were handled
+    worker_threads = set()
+
+    def handler(event):
+        time.sleep(random.uniform(0, 0.002))  # slow enough for the workers to overlap
+        worker_threads.add(threading.current_thread().name)
+        if event.phone_call is not None:
+            handled[event.phone_call.call_id].append(event)
+
+    dispatcher = EventDispatcher(handler, workers=4)
+    dispatcher.attach(caller)
+    phone_calls = [caller.make_call("900", time_out=0) for _ in range(16)]
+    for phone_call in phone_calls:
+        caller.hang_up(call=phone_call)
+    for phone_call in phone_calls:
+        caller.wait_for_existing_call_to_end(time_out=5, call=phone_call)
+    dispatcher.stop()
+    assert len(worker_threads) > 1  # the calls were sharded over several workers
+    for phone_call in phone_calls:
+        events = handled[phone_call.call_id]
+        assert [event.published_at for event in events] == sorted(event.published_at for event in events)
+        assert events[-1].state == pj.CallState.DISCONNECTED
+    assert dispatcher.stats()["dropped"] == 0
+
+
+def test_events_are_dropped_when_a_queue_is_full(phone_factory, caplog):
+    phone = phone_factory("100")
+    handling, release = threading.Event(), threading.Event()
+
+    def handler(event):
+        handling.set()
+        release.wait(5)
+
+    dispatcher = EventDispatcher(handler, workers=1, max_queue_size=2)
+    dispatcher._publish(PhoneEvent(phone, None))
+    assert handling.wait(5)  # the worker is busy with the first event, so the rest wait in its queue
+    for _ in range(9):
+        dispatcher._publish(PhoneEvent(phone, None))
+    stats = dispatcher.stats()
+    assert (stats["dropped"], stats["queue_depth"], stats["max_queue_depth"]) == (7, 2, 2)
+    assert "Event dispatch queue is full, 1 events have been dropped" in caplog.text
+    release.set()
+    dispatcher.stop()
+    assert dispatcher.stats()["dispatched"] == 3
+
+
+def test_publishing_waits_for_room_when_told_to(phone_factory):
+    phone = phone_factory("100")
+    release = threading.Event()
+    dispatcher = EventDispatcher(lambda event: release.wait(5), workers=1, max_queue_size=1, block_when_full=True)
+    publisher = threading.Thread(target=lambda: [dispatcher._publish(PhoneEvent(phone, None)) for _ in range(5)])
+    publisher.start()
+    publisher.join(0.1)
+    assert publisher.is_alive()
+    release.set()
+    publisher.join(5)
+    dispatcher.stop()
+    assert (dispatcher.dispatched, dispatcher.dropped) == (5, 0)
+
+
+def test_dispatch_lag_and_handler_duration(phone_factory):
+    phone = phone_factory("100")
+    dispatcher = EventDispatcher(lambda event: time.sleep(0.02), workers=1)
+    for _ in range(3):
+        dispatcher._publish(PhoneEvent(phone, None))
+    dispatcher.stop()
+    stats = dispatcher.stats()
+    assert stats["dispatched"] == 3
+    assert stats["queue_depth"] == 0
+    duration, lag = stats["handler_duration"], stats["dispatch_lag"]
+    assert duration["count"] == 3 and duration["min"] >= 0.02
+    # each event waited for the ones before it to be handled
+    assert lag["count"] == 3 and lag["max"] >= 0.04
+    assert sum(lag["buckets"].values()) == 3
+
+
+def test_handling_on_an_event_loop(phone_factory):
+    phone = phone_factory("100")
+    handled = []
+
+    async def handler(event):
+        handled.append((event, threading.current_thread()))
+
+    async def main():
+        dispatcher = EventDispatcher(handler, max_queue_size=2, event_loop=asyncio.get_running_loop())
+        for _ in range(3):
+            dispatcher._publish(PhoneEvent(phone, None))
+        await asyncio.sleep(0.05)
+        return dispatcher.stats()
+
+    stats = asyncio.run(main())
+    assert (stats["dispatched"], stats["dropped"], stats["queue_depth"]) == (2, 1, 0)
+    assert [thread for _, thread in handled] == [threading.main_thread()] * 2
@@ -0,0 +1,89 @@
+import random
+import pytest
+from soft_phone.dispositions import Answer, Busy, Decline, Disposition, NoAnswer, WeightedMix, as_disposition
+
+
+def test_answer(phone_factory):
+    caller, callee = phone_factory("100"), phone_factory("200", action_on_incoming_call=Answer(ring_delay=0.05))
+    phone_call = caller.make_call("200", time_out=5)
+    assert phone_call.is_connected()
+    assert phone_call.call_state.ringing_at is not None
+    assert phone_call.connected_at - phone_call.call_state.ringing_at >= 0.04
+    assert callee.current_call.is_connected()
+
+
+@pytest.mark.parametrize("disposition, code", [(Busy(), 486), (Decline(), 603), (Decline(404), 404)])
+def test_decline(phone_factory, disposition, code):
+    caller, callee = phone_factory("100"), phone_factory("200", action_on_incoming_call=disposition)
+    phone_call = caller.make_call("200", time_out=5)
+    assert phone_call.has_ended()
+    assert phone_call.last_code == code
+    assert callee.current_call.has_ended()
+    assert callee.calls == {}
+
+
+def test_no_answer_rejects_once_its_time_out_passes(phone_factory):
+    caller, _ = phone_factory("100"), phone_factory("200", action_on_incoming_call=NoAnswer(time_out=0.05))
+    phone_call = caller.make_call("200", time_out=5)
+    assert phone_call.last_code == 480
+    assert phone_call.call_state.ringing_at is not None
+
+
+def test_no_answer_rings_until_the_caller_gives_up(phone_factory):
+    caller, callee = phone_factory("100"), phone_factory("200", action_on_incoming_call="NO_ANSWER")
+    phone_call = caller.make_call("200", time_out=0.2)
+    assert not phone_call.setup_finished()
+    caller.hang_up(call=phone_call)
+    caller.wait_for_existing_call_to_end(time_out=5, call=phone_call)
+    callee.wait_for_existing_call_to_end(time_out=5, call=callee.current_call)
+    assert callee.current_call.has_ended()
+
+
+def test_caller_giving_up_whilst_ringing(phone_factory):
+    caller, callee = phone_factory("100"), phone_factory("200", action_on_incoming_call=Answer(ring_delay=0.2))
+    phone_call = caller.make_call("200", time_out=0.05)
+    caller.hang_up(call=phone_call)
+    caller.wait_for_existing_call_to_end(time_out=5, call=phone_call)
+    incoming_call = callee.current_call
+    callee.wait_for_existing_call_to_end(time_out=5, call=incoming_call)
+    assert not incoming_call.is_connected()
+
+
+def test_weighted_mix_only_picks_dispositions_with_weight():
+    busy, answer = Busy(), Answer()
+    mix = WeightedMix([(0, busy), (1, answer)])
+    assert all(mix.choose() is answer for _ in range(100))
+
+
+def test_weighted_mix_in_proportion():
+    random.seed(1)
+    busy, answer = Busy(), Answer()
+    mix = WeightedMix([(1, busy), (3, answer)])
+    answered = sum(1 for _ in range(4000) if mix.choose() is answer)
+    assert 2800 < answered < 3200
+
+
+def test_weighted_mix_needs_a_positive_weight():
+    with pytest.raises(ValueError):
+        WeightedMix([(0, Busy())])
+
+
+@pytest.mark.parametrize("action, disposition_type", [("ANSWER", Answer), ("busy", Busy), ("DECLINE", Decline),
+                                                      ("NO_ANSWER", NoAnswer)])
+def test_as_disposition(action, disposition_type):
+    assert type(as_disposition(action)) is disposition_type
+
+
+def test_as_disposition_rejects_unknown_actions():
+    with pytest.raises(ValueError):
+        as_disposition("HOLD")
+    with pytest.raises(ValueError):
+        as_disposition(None)
+
+
+def test_disposition_must_respond():
+    class Incomplete(Disposition):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
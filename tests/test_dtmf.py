@@ -0,0 +1,101 @@
+import time
+import pytest
+from soft_phone.dtmf import DTMFLog, DTMFSequence, _as_pattern
+
+
+@pytest.fixture
+def call_pair(phone_factory):
+    """
+    (caller, callee, outgoing call, incoming call) of an answered call
+    """
+    caller, callee = phone_factory("100"), phone_factory("200", action_on_incoming_call="ANSWER")
+    phone_call = caller.make_call("200", time_out=5)
+    incoming_call = callee.wait_for_a_call_to_occur(time_out=5)
+    assert phone_call.is_connected() and incoming_call.is_connected()
+    return caller, callee, phone_call, incoming_call
+
+
+def test_log_matches_consume_the_digits():
+    dtmf = DTMFLog()
+    dtmf.record_sent("1", now=1.0)
+    dtmf.record_received("9", now=1.5)
+    dtmf.record_received("1234#", now=2.0)
+    first = dtmf.match(_as_pattern("9"))
+    assert (first.digits, first.latency) == ("9", 0.5)
+    assert dtmf.pending_digits() == "1234#"
+    assert dtmf.match(_as_pattern("9")) is None
+    second = dtmf.match(_as_pattern(r"\d{4}#"))
+    assert second.digits == "1234#"
+    assert dtmf.pending_digits() == ""
+
+
+def test_log_keeps_the_most_recent_digits():
+    dtmf = DTMFLog(max_digits=4)
+    dtmf.record_received("123456")
+    assert dtmf.received_digits == "3456"
+    assert dtmf.match(_as_pattern("56")).digits == "56"
+
+
+def test_sequence_parse():
+    sequence = DTMFSequence.parse("1,,23", gap=0.2, pause=1.0)
+    assert sequence.steps == [("digit", "1"), ("pause", 1.0), ("pause", 1.0), ("digit", "2"), ("pause", 0.2),
+                              ("digit", "3")]
+
+
+def test_sequence_rejects_invalid_digits():
+    with pytest.raises(ValueError):
+        DTMFSequence().send("12x")
+
+
+def test_send_and_wait_for_dtmf(call_pair):
+    caller, callee, phone_call, incoming_call = call_pair
+    caller.send_dtmf_key_tones("42", call=phone_call)
+    dtmf_match = callee.wait_for_dtmf("4.", time_out=5, call=incoming_call)
+    assert dtmf_match.digits == "42"
+    assert phone_call.dtmf_sent == "42"
+    assert callee.metrics.counters["dtmf_digits_received"] == 2
+
+
+def test_wait_for_dtmf_times_out(call_pair):
+    _, callee, _, incoming_call = call_pair
+    assert callee.wait_for_dtmf("1", time_out=0.05, call=incoming_call) is None
+
+
+def test_sequence_with_a_wait(call_pair):
+    caller, callee, phone_call, incoming_call = call_pair
+    run = caller.send_dtmf_sequence(DTMFSequence(gap=0.01).send("1").wait_for("9", 5).send("23#"), call=phone_call)
+    assert callee.wait_for_dtmf("1", time_out=5, call=incoming_call)
+    callee.send_dtmf_key_tones("9", call=incoming_call)
+    assert callee.wait_for_dtmf("23#", time_out=5, call=incoming_call)
+    assert caller.wait_for_dtmf_sequence(run, time_out=5)
+    assert run.state == "completed"
+    assert [dtmf_match.digits for dtmf_match in run.matches] == ["9"]
+    assert run.matches[0].latency is not None
+    assert phone_call.dtmf_sequences == ()
+
+
+def test_sequence_wait_times_out(call_pair):
+    caller, _, phone_call, _ = call_pair
+    run = caller.send_dtmf_sequence(DTMFSequence().wait_for("9", 0.05), call=phone_call)
+    assert not caller.wait_for_dtmf_sequence(run, time_out=5)
+    assert run.state == "failed"
+    assert "no DTMF matching" in run.error
+
+
+def test_sequence_fails_as_soon_as_the_call_ends(call_pair):
+    caller, callee, phone_call, incoming_call = call_pair
+    run = caller.send_dtmf_sequence(DTMFSequence().wait_for("9", 30), call=phone_call)
+    callee.hang_up(call=incoming_call)
+    started = time.monotonic()
+    assert not caller.wait_for_dtmf_sequence(run, time_out=10)
+    assert time.monotonic() - started < 1
+    assert (run.state, run.error) == ("failed", "the call ended")
+
+
+def test_sequence_cancelled(call_pair):
+    caller, _, phone_call, _ = call_pair
+    run = caller.send_dtmf_sequence(DTMFSequence().pause(5).send("1"), call=phone_call)
+    run.cancel()
+    assert not caller.wait_for_dtmf_sequence(run, time_out=1)
+    assert run.state == "cancelled"
+    assert phone_call.dtmf_sent == ""
@@ -0,0 +1,66 @@
+import os
+import socket
+import pytest
+from soft_phone.exceptions import FleetWorkerError
+from soft_phone.fleet import PhoneFleet
+
+
+@pytest.fixture(scope="module")
+def fleet():
+    # worker processes run the fake backend with its default delays, the fake_pbx fixture only reaches this process
+    fleet = PhoneFleet("10.0.0.1", range(1000, 1004), "secret", workers=2)
+    fleet.start()
+    yield fleet
+    fleet.stop(time_out=10)
+
+
+def test_accounts_are_dealt_out_between_the_workers(fleet):
+    assert len(fleet) == 2
+    assert fleet.worker_of_account == {"1000": 0, "1001": 1, "1002": 0, "1003": 1}
+
+
+def test_register_dial_and_hang_up(fleet):
+    results = fleet.register_all(time_out=10)
+    assert sorted(results) == ["1000", "1001", "1002", "1003"]
+    assert all(result["reg_status"] == 200 for result in results.values())
+    calls = [fleet.dial(pbx_account_name, "900", time_out=5) for pbx_account_name in ("1000", "1001")]
+    assert all(call["connected"] and not call["ended"] for call in calls)
+    for call in calls:
+        fleet.hang_up(call["pbx_account_name"], call["call_id"])
+        assert fleet.wait_for_call_to_end(call["pbx_account_name"], call["call_id"], time_out=5)
+        # the worker still knows the call once it has ended
+        assert fleet.get_call(call["pbx_account_name"], call["call_id"])["ended"]
+    with pytest.raises(FleetWorkerError, match="PhoneCallNotInProgress"):
+        fleet.hang_up("1002", "no-such-call")
+    with pytest.raises(ValueError):
+        fleet.dial("9999", "900")
+    fleet.unregister_all(time_out=10)
+
+
+def test_a_worker_exits_when_the_coordinator_has_gone():
+    fleet = PhoneFleet("10.0.0.1", range(1000, 1004), "secret", workers=2)
+    fleet.start()
+    try:
+        # as if the coordinator process had died, the worker reads EOF from its end of the pipe
+        socket.socket(fileno=os.dup(fleet._connections[0].fileno())).shutdown(socket.SHUT_RDWR)
+        fleet._processes[0].join(10)
+        assert fleet._processes[0].exitcode == 0
+        assert sorted(fleet._submit(1, "register", 5).result(10)) == ["1001", "1003"]  # the other worker carries on
+    finally:
+        fleet.stop(time_out=2)
+
+
+def test_commands_owed_by_a_worker_which_has_exited_fail():
+    fleet = PhoneFleet("10.0.0.1", range(1000, 1004), "secret", workers=2)
+    fleet.start()
+    try:
+        fleet.register_all(time_out=10)
+        fleet.dial("1000", "900", time_out=5)
+        waiting = fleet.submit("1000", "wait_for_call_to_end", None, 30)
+        fleet._processes[0].terminate()
+        with pytest.raises(FleetWorkerError, match="has exited"):
+            waiting.result(10)
+        call = fleet.dial("1001", "900", time_out=5)  # the other worker carries on
+        assert call["connected"]
+    finally:
+        fleet.stop(time_out=2)
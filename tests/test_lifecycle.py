@@ -0,0 +1,61 @@
+import subprocess
+import sys
+import pytest
+from soft_phone.manage_pjsip import PJSipClient
+from soft_phone.soft_phone import SoftPhone
+
+
+def test_importing_the_package_does_not_load_pjsua():
+    script = ("import sys, soft_phone; "
+              "print(sorted(name for name in ('pjsua', 'soft_phone.fake_pjsua', 'soft_phone.manage_pjsip', "
+              "'soft_phone.soft_phone') if name in sys.modules)); "
+              "print(soft_phone.PJSipConfig.__module__); "
+              "print('soft_phone.manage_pjsip' in sys.modules)")
+    output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+    assert output.split("\n")[:3] == ["[]", "soft_phone.config", "False"]
+
+
+def test_lazy_attributes():
+    import soft_phone
+    assert soft_phone.PJSipClient is PJSipClient
+    assert "SoftPhone" in dir(soft_phone)
+    with pytest.raises(AttributeError):
+        soft_phone.NoSuchClass
+
+
+def test_start_and_stop_are_idempotent(client_factory):
+    client = client_factory()
+    lib = client.lib
+    client.start()
+    assert client.started and client.lib is lib
+    client.stop()
+    client.stop()
+    assert not client.started and client.lib is None
+
+
+def test_restart(client_factory):
+    client = client_factory()
+    client.stop()
+    client.start()
+    assert client.started and client.lib is not None
+    phone = SoftPhone(client, "10.0.0.1", "100", "secret")
+    phone.register_soft_phone(time_out=5)
+    phone_call = phone.make_call("900")
+    assert phone_call.is_connected()
+    phone.hang_up(call=phone_call)
+    phone.wait_for_existing_call_to_end(time_out=5, call=phone_call)
+    phone.unregister_soft_phone()
+    assert client.resources.counts["accounts"] == 0
+
+
+def test_instance(monkeypatch):
+    monkeypatch.setattr(PJSipClient, "_instance", None)
+    client = PJSipClient.instance(log_file=None, account_cache_size=4)
+    try:
+        assert client.started
+        assert PJSipClient.instance(account_cache_size=8) is client  # later arguments are ignored
+        assert client.account_cache.max_idle_accounts == 4
+        client.stop()
+        assert PJSipClient.instance() is client and client.started  # started again
+    finally:
+        client.stop()
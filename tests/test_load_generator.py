@@ -0,0 +1,67 @@
+import pytest
+from soft_phone.load_generator import LoadGenerator
+from soft_phone.pool import SoftPhonePool
+
+
+@pytest.fixture
+def caller_pool(pjsip_client):
+    pool = SoftPhonePool(pjsip_client, "10.0.0.1", range(1000, 1005), "secret")
+    pool.register_all(time_out=5)
+    yield pool
+    pool.unregister_all(time_out=5)
+
+
+def test_origination_offsets_follow_the_target_rate():
+    generator = LoadGenerator.__new__(LoadGenerator)
+    generator.calls_per_second, generator.ramp_up = 10, 0
+    assert [generator._origination_offset(index) for index in range(4)] == pytest.approx([0.0, 0.1, 0.2, 0.3])
+
+
+def test_origination_offsets_ramp_up_linearly():
+    generator = LoadGenerator.__new__(LoadGenerator)
+    generator.calls_per_second, generator.ramp_up = 10, 4
+    offsets = [generator._origination_offset(index) for index in range(60)]
+    assert offsets == sorted(offsets)
+    # the rate grows from 0 to 10 CPS over the 4 second ramp up: 20 attempts, then 10 a second
+    assert sum(1 for offset in offsets if offset < 4) == 20
+    assert offsets[20] == pytest.approx(4.0)
+    assert offsets[30] - offsets[20] == pytest.approx(1.0)
+    assert offsets[1] - offsets[0] > offsets[19] - offsets[18] > 0.1
+
+
+def test_calls_are_paced_at_the_target_rate(caller_pool):
+    generator = LoadGenerator(caller_pool, "900", calls_per_second=50, hold_time=0.02, total_calls=10)
+    statistics = generator.run()
+    assert (statistics.attempts, statistics.answered, statistics.failed, statistics.active) == (10, 10, 0, 0)
+    assert statistics.elapsed >= 9 / 50.0
+    assert statistics.achieved_cps <= 50
+    assert len(statistics.setup_times) == 10
+
+
+def test_concurrency_cap(caller_pool):
+    generator = LoadGenerator(caller_pool, "900", calls_per_second=200, hold_time=0.1, max_concurrent_calls=2,
+                              total_calls=6)
+    active_at_origination = []
+    originate = generator._originate
+
+    def recording_originate(phone, now):
+        generated_call = originate(phone, now)
+        active_at_origination.append(generator.statistics.active)
+        return generated_call
+
+    generator._originate = recording_originate
+    statistics = generator.run()
+    assert statistics.answered == 6
+    assert max(active_at_origination) == 2
+    # held back by the cap rather than bursting to catch up with the 200 CPS schedule
+    assert statistics.elapsed >= 0.3
+
+
+def test_calls_not_confirmed_in_time_are_abandoned(caller_pool, fake_pbx):
+    fake_pbx.answer_delay = 5
+    generator = LoadGenerator(caller_pool, "900", calls_per_second=100, hold_time=1, total_calls=3,
+                              setup_time_out=0.1)
+    statistics = generator.run()
+    assert (statistics.attempts, statistics.answered, statistics.failed, statistics.active) == (3, 0, 3, 0)
+    assert statistics.elapsed < 1
+
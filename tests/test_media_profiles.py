@@ -0,0 +1,70 @@
+import os
+import pytest
+from soft_phone.backend import get_backend
+from soft_phone.config import MEDIA_PROFILES, MediaProfile
+from soft_phone.soft_phone import SoftPhone
+
+pj = get_backend()
+
+
+def test_apply_media_config():
+    media_cfg = pj.MediaConfig()
+    MEDIA_PROFILES["low_cpu"].apply_media_config(media_cfg)
+    assert (media_cfg.ptime, media_cfg.no_vad, media_cfg.ec_tail_len, media_cfg.clock_rate, media_cfg.quality) == (
+        20, True, 0, 8000, 1)
+    MediaProfile(conference_ports=500, audio_frame_ptime=10, vad=True).apply_media_config(media_cfg)
+    assert (media_cfg.max_media_ports, media_cfg.audio_frame_ptime, media_cfg.no_vad) == (500, 10, False)
+
+
+def test_the_default_profile_keeps_pjsua_defaults():
+    defaults, media_cfg = vars(pj.MediaConfig()), pj.MediaConfig()
+    MediaProfile().apply_media_config(media_cfg)
+    assert vars(media_cfg) == defaults
+
+
+def test_apply_codec_priorities(pjsip_client):
+    lib = pjsip_client.lib
+    assert MediaProfile(codecs=("g722", "PCMU")).apply_codec_priorities(lib) == ["G722/16000/1", "PCMU/8000/1"]
+    priorities = {codec.name: codec.priority for codec in lib.enum_codecs()}
+    assert priorities == {"G722/16000/1": 255, "PCMU/8000/1": 254, "PCMA/8000/1": 0, "speex/16000/1": 0}
+
+
+def test_no_codecs_keeps_the_priorities(pjsip_client):
+    lib = pjsip_client.lib
+    before = {codec.name: codec.priority for codec in lib.enum_codecs()}
+    assert MediaProfile().apply_codec_priorities(lib) == []
+    assert {codec.name: codec.priority for codec in lib.enum_codecs()} == before
+
+
+def test_profiles_by_name(client_factory):
+    client = client_factory(media_profile="low_cpu")
+    assert client.media_profile is MEDIA_PROFILES["low_cpu"]
+    assert client.codecs == ["PCMU/8000/1", "PCMA/8000/1"]
+    with pytest.raises(ValueError):
+        client_factory(media_profile="no_such_profile")
+
+
+def test_signalling_only_leaves_the_media_alone(client_factory, tmp_path, caplog):
+    audio_file = tmp_path / "audio.wav"
+    audio_file.write_bytes(b"")
+    recordings = tmp_path / "recordings"
+    recordings.mkdir()
+    client = client_factory(media_profile="signalling_only", media_stats_interval=1.0)
+    assert client.signalling_only
+    assert client.media_stats is None
+    assert "no media statistics will be collected" in caplog.text
+    caller = SoftPhone(client, "10.0.0.1", "100", "secret", recording_directory=str(recordings))
+    callee = SoftPhone(client, "10.0.0.1", "200", "secret", answer_audio=str(audio_file),
+                       action_on_incoming_call="ANSWER")
+    caller.register_soft_phone(time_out=5)
+    callee.register_soft_phone(time_out=5)
+    phone_call = caller.make_call("200")
+    assert phone_call.is_connected()
+    caller.start_audio_playback(str(audio_file), call=phone_call)
+    caller.start_recording(str(tmp_path / "recording.wav"), call=phone_call)
+    assert (phone_call.audio_player_id, phone_call.recorder_id, phone_call.media_stats) == (None, None, None)
+    assert len(client.audio_players) == 0
+    assert client.lib._players == {} and client.lib._recorders == {}
+    assert os.listdir(str(recordings)) == []
+    caller.hang_up(call=phone_call)
+    caller.wait_for_existing_call_to_end(time_out=5, call=phone_call)
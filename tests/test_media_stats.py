@@ -0,0 +1,19 @@
+import time
+from soft_phone.soft_phone import SoftPhone
+
+
+def test_each_call_is_sampled_once_per_interval(client_factory):
+    client = client_factory(media_stats_interval=1.0)
+    caller = SoftPhone(client, "10.0.0.1", "100", "secret")
+    caller.register_soft_phone(time_out=5)
+    phone_calls = [caller.make_call(str(900 + index), time_out=5) for index in range(3)]
+    time.sleep(0.8)
+    assert [phone_call.media_stats.samples for phone_call in phone_calls] == [1, 1, 1]
+    time.sleep(0.8)
+    assert [phone_call.media_stats.samples for phone_call in phone_calls] == [2, 2, 2]
+    stats = caller.get_media_stats(call=phone_calls[0])
+    assert stats["rx_packets"] > 0
+    caller.hang_up_all_calls()
+    for phone_call in phone_calls:
+        caller.wait_for_existing_call_to_end(time_out=5, call=phone_call)
+    assert client.media_stats.stats()["calls"] == 0
@@ -0,0 +1,33 @@
+from soft_phone.backend import get_backend
+from soft_phone.pool import SoftPhonePool
+
+pj = get_backend()
+
+
+def test_register_and_unregister_all(pjsip_client):
+    pool = SoftPhonePool(pjsip_client, "10.0.0.1", range(1000, 1010), "secret", max_in_flight=3)
+    results = pool.register_all(time_out=5)
+    assert sorted(results) == [str(account) for account in range(1000, 1010)]
+    assert all(result.reg_status == 200 and result.error is None for result in results.values())
+    assert len(pool.registered_phones) == 10
+    pool.unregister_all(time_out=5)
+    assert pool.registered_phones == []
+    assert pjsip_client.resources.counts["accounts"] == 0
+
+
+def test_one_bad_account_does_not_stop_the_pool(pjsip_client, monkeypatch):
+    create_account = pjsip_client.lib.create_account
+
+    def failing_create_account(account_config, *args, **kwargs):
+        if account_config.username == "1002":
+            raise pj.Error("create_account()", None, 70001, "Invalid account")
+        return create_account(account_config, *args, **kwargs)
+
+    monkeypatch.setattr(pjsip_client.lib, "create_account", failing_create_account)
+    pool = SoftPhonePool(pjsip_client, "10.0.0.1", range(1000, 1005), "secret", max_in_flight=2)
+    results = pool.register_all(time_out=5)
+    assert results["1002"].reg_status is None
+    assert isinstance(results["1002"].error, pj.Error)
+    assert [account for account, result in results.items() if result.reg_status == 200] == [
+        "1000", "1001", "1003", "1004"]
+    pool.unregister_all(time_out=5)
@@ -0,0 +1,57 @@
+import os
+import pytest
+
+pytest_plugins = "pytester"
+
+PACKAGE_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SESSION_TESTS = """
+def test_call(soft_phones):
+    caller, receiver = soft_phones("100"), soft_phones("200", action_on_incoming_call="ANSWER")
+    phone_call = caller.make_call("200")
+    assert phone_call.is_connected()
+
+
+def test_phones_are_shared_by_the_session(soft_phones, soft_phone_client, soft_phone_factory):
+    caller = soft_phones("100")
+    assert caller is soft_phone_factory("100")
+    assert caller.calls == {}  # the calls of the previous test have been hung up
+    assert caller.reg_status == 200
+    assert soft_phone_client.account_cache.max_idle_accounts == 8
+"""
+
+
+@pytest.fixture
+def plugin_pytester(pytester, monkeypatch):
+    monkeypatch.setenv("PYTHONPATH", PACKAGE_DIRECTORY)
+    return pytester
+
+
+def test_fixtures_configured_on_the_command_line(plugin_pytester):
+    plugin_pytester.makeini("[pytest]\nsoft_phone_account_cache_size = 8\n")
+    plugin_pytester.makepyfile(SESSION_TESTS)
+    result = plugin_pytester.runpytest_subprocess("-p", "soft_phone.pytest_plugin", "--soft-phone-backend", "fake",
+                                                  "--soft-phone-pbx", "10.0.0.1", "--soft-phone-password", "secret")
+    result.assert_outcomes(passed=2)
+
+
+def test_fixtures_configured_in_the_ini_file(plugin_pytester):
+    plugin_pytester.makeini("[pytest]\nsoft_phone_backend = fake\nsoft_phone_pbx_ip = 10.0.0.1\n"
+                            "soft_phone_password = secret\nsoft_phone_account_cache_size = 8\n")
+    plugin_pytester.makepyfile(SESSION_TESTS)
+    result = plugin_pytester.runpytest_subprocess("-p", "soft_phone.pytest_plugin")
+    result.assert_outcomes(passed=2)
+
+
+def test_no_pbx_address(plugin_pytester):
+    plugin_pytester.makepyfile("def test_call(soft_phones):\n    soft_phones('100')\n")
+    result = plugin_pytester.runpytest_subprocess("-p", "soft_phone.pytest_plugin", "--soft-phone-backend", "fake")
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines(["*No PBX address*"])
+
+
+def test_the_plugin_does_not_load_pjsua_unless_its_fixtures_are_used(plugin_pytester):
+    plugin_pytester.makepyfile("import sys\n\n\ndef test_nothing_loaded():\n"
+                               "    assert 'soft_phone.manage_pjsip' not in sys.modules\n")
+    result = plugin_pytester.runpytest_subprocess("-p", "soft_phone.pytest_plugin")
+    result.assert_outcomes(passed=1)
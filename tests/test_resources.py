@@ -0,0 +1,103 @@
+import logging
+import pytest
+from soft_phone.exceptions import PhoneCallNotInProgress
+from soft_phone.resources import ResourceTracker
+
+
+@pytest.fixture
+def tracker(pjsip_client):
+    return ResourceTracker(pjsip_client, sample_interval=1000)
+
+
+def record_history(tracker, accounts, calls):
+    """ Sample the tracker once per thousand call cycles with the given counts """
+    for index, (account_count, call_count) in enumerate(zip(accounts, calls)):
+        tracker.counts["accounts"], tracker.counts["calls"] = account_count, call_count
+        tracker._sample((index + 1) * 1000)
+
+
+def test_flat_history_is_not_a_leak(tracker, caplog):
+    caplog.set_level(logging.WARNING)
+    # the calls in progress at each sample come and go, the accounts stay the same
+    record_history(tracker, [10] * 10, [0, 3, 1, 4, 0, 2, 5, 1, 3, 2])
+    growth = tracker.growth()
+    assert growth["accounts"] == 0
+    assert abs(growth["calls"]) < 1
+    assert "leaking" not in caplog.text
+
+
+def test_growing_history_is_reported_once(tracker, caplog):
+    caplog.set_level(logging.WARNING)
+    record_history(tracker, range(10, 50, 4), [2] * 10)
+    assert tracker.growth()["accounts"] == pytest.approx(4.0)
+    # as soon as there are enough samples to tell
+    assert "Live accounts are growing by 4.0 per thousand calls (30 after 6000 calls)" in caplog.text
+    record_history(tracker, range(50, 90, 4), [2] * 10)
+    assert caplog.text.count("leaking") == 1
+
+
+def test_a_spike_is_not_a_leak(tracker, caplog):
+    caplog.set_level(logging.WARNING)
+    # the slope is well over the threshold, but the floor hasn't risen
+    record_history(tracker, [10] * 10, [0, 0, 0, 1, 0, 0, 0, 0, 0, 40])
+    assert tracker.growth()["calls"] > tracker.leak_threshold
+    assert "leaking" not in caplog.text
+
+
+def test_too_few_samples(tracker, caplog):
+    caplog.set_level(logging.WARNING)
+    assert tracker.growth()["accounts"] is None
+    record_history(tracker, [1, 50, 100, 150, 200], [0] * 5)
+    assert tracker.growth()["accounts"] == pytest.approx(49.8)
+    assert "leaking" not in caplog.text  # fewer than 6 samples
+
+
+def test_samples_are_taken_every_interval(client_factory, monkeypatch):
+    client = client_factory(resource_sample_interval=2)
+    samples = []
+    monkeypatch.setattr(client.timers, "schedule", lambda delay, callback, *args: samples.append(args))
+    for _ in range(5):
+        client.resources.on_call_started(object)
+        client.resources.on_call_ended(object)
+    assert [cycle for cycle, snapshot_due in samples] == [2, 4]
+    assert client.resources.counts["calls"] == 0
+
+
+def test_playback_reclaimed_from_a_call_which_ended(pjsip_client, phone_factory, tmp_path, monkeypatch):
+    audio_file = tmp_path / "audio.wav"
+    audio_file.write_bytes(b"")
+    caller = phone_factory("100")
+    phone_call = caller.make_call("900")
+    acquire = pjsip_client.audio_players.acquire
+
+    def acquire_as_the_call_ends(*args):
+        player = acquire(*args)
+        caller.hang_up(call=phone_call)
+        caller.wait_for_existing_call_to_end(time_out=5, call=phone_call)
+        return player
+
+    monkeypatch.setattr(pjsip_client.audio_players, "acquire", acquire_as_the_call_ends)
+    with pytest.raises(PhoneCallNotInProgress):
+        caller.start_audio_playback(str(audio_file), call=phone_call)
+    assert pjsip_client.resources.reclaimed == {"players": 1, "recorders": 0}
+    assert [player.users for player in pjsip_client.audio_players._players.values()] == [0]
+    assert pjsip_client.resources.report()["reclaimed"] == {"players": 1, "recorders": 0}
+
+
+def test_recording_reclaimed_from_a_call_which_ended(pjsip_client, phone_factory, tmp_path, monkeypatch):
+    caller = phone_factory("100")
+    phone_call = caller.make_call("900")
+    create_recorder = pjsip_client.lib.create_recorder
+
+    def create_recorder_as_the_call_ends(file_path):
+        recorder_id = create_recorder(file_path)
+        caller.hang_up(call=phone_call)
+        caller.wait_for_existing_call_to_end(time_out=5, call=phone_call)
+        return recorder_id
+
+    monkeypatch.setattr(pjsip_client.lib, "create_recorder", create_recorder_as_the_call_ends)
+    with pytest.raises(PhoneCallNotInProgress):
+        caller.start_recording(str(tmp_path / "recording.wav"), call=phone_call)
+    assert pjsip_client.resources.reclaimed == {"players": 0, "recorders": 1}
+    assert pjsip_client.resources.counts["recorders"] == 0
+    assert pjsip_client.lib._recorders == {}
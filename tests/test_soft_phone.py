@@ -0,0 +1,140 @@
+import time
+import pytest
+from soft_phone.exceptions import PhoneCallNotInProgress
+
+
+def test_register_and_unregister(pjsip_client, phone_factory):
+    phone = phone_factory("100")
+    assert phone.reg_status == 200
+    assert phone.registration_latency is not None
+    phone.unregister_soft_phone()
+    assert pjsip_client.resources.counts["accounts"] == 0
+
+
+def test_failed_registration(phone_factory, fake_pbx):
+    fake_pbx.registration_status = 403
+    phone = phone_factory("100")
+    assert phone.reg_status == 403
+
+
+def test_call_to_a_number_which_answers(phone_factory):
+    caller = phone_factory("100")
+    phone_call = caller.make_call("900")
+    assert phone_call.is_connected()
+    assert caller.current_call is phone_call
+    caller.hang_up(call=phone_call)
+    caller.wait_for_existing_call_to_end(time_out=5, call=phone_call)
+    assert phone_call.has_ended()
+
+
+def test_call_to_a_number_which_rejects(phone_factory, fake_pbx):
+    fake_pbx.answer_status = 486
+    caller = phone_factory("100")
+    phone_call = caller.make_call("900")
+    assert phone_call.has_ended()
+    assert not phone_call.is_connected()
+    assert phone_call.last_code == 486
+
+
+def test_wait_for_a_call_to_occur(phone_factory):
+    caller, callee = phone_factory("100"), phone_factory("200", action_on_incoming_call="ANSWER")
+    assert callee.wait_for_a_call_to_occur(time_out=0.05) is None
+    phone_call = caller.make_call("200")
+    incoming_call = callee.wait_for_a_call_to_occur(time_out=5)
+    assert incoming_call is not None
+    assert incoming_call.direction == "incoming"
+    assert phone_call.is_connected() and incoming_call.is_connected()
+
+
+def test_wait_for_existing_call_to_end_when_the_far_end_hangs_up(phone_factory):
+    caller, callee = phone_factory("100"), phone_factory("200", action_on_incoming_call="ANSWER")
+    phone_call = caller.make_call("200")
+    incoming_call = callee.wait_for_a_call_to_occur(time_out=5)
+    callee.hang_up(call=incoming_call)
+    started = time.monotonic()
+    caller.wait_for_existing_call_to_end(time_out=5, call=phone_call)
+    assert phone_call.has_ended()
+    assert time.monotonic() - started < 1
+
+
+def test_wait_for_existing_call_to_end_without_a_call(phone_factory):
+    phone = phone_factory("100")
+    with pytest.raises(PhoneCallNotInProgress):
+        phone.wait_for_existing_call_to_end(time_out=0.1)
+
+
+def test_state_listeners(phone_factory):
+    caller = phone_factory("100")
+    notified = []
+    listener = notified.append
+    caller.add_state_listener(listener)
+    phone_call = caller.make_call("900")
+    caller.hang_up(call=phone_call)
+    caller.wait_for_existing_call_to_end(time_out=5, call=phone_call)
+    assert phone_call in notified
+    caller.remove_state_listener(listener)
+    del notified[:]
+    caller.make_call("900")
+    assert notified == []
+
+
+def test_call_registry_tracks_concurrent_calls(phone_factory):
+    caller = phone_factory("100")
+    first, second = caller.make_call("900"), caller.make_call("901")
+    assert first.call_id != second.call_id
+    assert caller.calls == {first.call_id: first, second.call_id: second}
+    assert caller.get_call(first.call_id) is first
+    assert caller.current_call is second
+    caller.hang_up(call=first.call_id)  # by Call-ID
+    caller.wait_for_existing_call_to_end(time_out=5, call=first)
+    assert caller.get_call(first.call_id) is None
+    assert list(caller.calls) == [second.call_id]
+    caller.hang_up_all_calls()
+    caller.wait_for_existing_call_to_end(time_out=5, call=second)
+    assert caller.calls == {}
+
+
+def test_unknown_call_id(phone_factory):
+    phone = phone_factory("100")
+    with pytest.raises(PhoneCallNotInProgress):
+        phone.hang_up(call="no-such-call")
+
+
+def test_phones_join_the_metrics_registry_when_they_register(pjsip_client, phone_factory):
+    phone = phone_factory("100", register=False)
+    assert pjsip_client.metrics.phone_metrics == []
+    phone.register_soft_phone(time_out=5)
+    assert pjsip_client.metrics.phone_metrics == [phone.metrics]
+
+
+def test_metrics_of_unregistered_phones_are_retired(pjsip_client, phone_factory):
+    for _ in range(3):
+        phone = phone_factory("100")
+        phone_call = phone.make_call("900")
+        phone.hang_up(call=phone_call)
+        phone.wait_for_existing_call_to_end(time_out=5, call=phone_call)
+        phone.unregister_soft_phone()
+    assert pjsip_client.metrics.phone_metrics == []
+    snapshot = pjsip_client.metrics.snapshot()
+    assert snapshot["calls_attempted"] == 3
+    assert snapshot["registrations_succeeded"] == 3
+
+
+def test_wait_for_specific_call_connection_length(phone_factory):
+    caller = phone_factory("100")
+    phone_call = caller.make_call("900")
+    assert caller.wait_for_specific_call_connection_length(0.1, call=phone_call)
+    assert phone_call.call_state.connected_duration() >= 0.1
+    caller.hang_up(call=phone_call)
+    caller.wait_for_existing_call_to_end(time_out=5, call=phone_call)
+    assert not caller.wait_for_specific_call_connection_length(10, call=phone_call)
+
+
+def test_hang_up_after(phone_factory):
+    caller = phone_factory("100")
+    phone_call = caller.make_call("900")
+    timer = caller.hang_up_after(0.05, call=phone_call)
+    caller.wait_for_existing_call_to_end(time_out=5, call=phone_call)
+    assert phone_call.has_ended()
+    assert timer.due == pytest.approx(phone_call.call_state.connected_at + 0.05)
+    assert timer.fired_at >= timer.due
@@ -0,0 +1,51 @@
+import pytest
+from soft_phone.config import PJSipConfig, TransportSettings
+from soft_phone.soft_phone import SoftPhone
+
+
+@pytest.fixture
+def three_transport_client(client_factory):
+    return client_factory(config=PJSipConfig([TransportSettings(), TransportSettings(), TransportSettings("tcp")]))
+
+
+def test_transports_are_created_from_the_config(three_transport_client):
+    assert [transport.info().port for transport in three_transport_client.transports] == [5060, 5061, 5062]
+
+
+def test_get_transport(three_transport_client):
+    transports = three_transport_client.transports
+    assert three_transport_client.get_transport() is None
+    assert three_transport_client.get_transport(1) is transports[1]
+    assert three_transport_client.get_transport(transports[2]) is transports[2]
+
+
+def test_round_robin_selection(three_transport_client):
+    transports = three_transport_client.transports
+    assert [three_transport_client.get_transport("round_robin") for _ in range(4)] == transports + transports[:1]
+    phones = [SoftPhone(three_transport_client, "10.0.0.1", str(account), "secret", transport="round_robin")
+              for account in range(100, 103)]
+    assert [phone.transport for phone in phones] == transports[1:] + transports[:1]
+
+
+@pytest.mark.parametrize("transport", ["foo", 3, -4, 1.0, True])
+def test_unknown_transports_are_rejected(three_transport_client, transport):
+    with pytest.raises(ValueError):
+        three_transport_client.get_transport(transport)
+
+
+def test_port_ranges():
+    settings = TransportSettings("tcp", port_range=(5070, 5072), bound_address="10.0.0.2")
+    assert settings.ports() == [5070, 5071, 5072]
+    assert TransportSettings(port=5080).ports() == [5080]
+    moved = settings.with_port_range(6000, 6001)
+    assert (moved.type, moved.ports(), moved.bound_address) == ("tcp", [6000, 6001], "10.0.0.2")
+    pjsip_config = PJSipConfig([TransportSettings(), TransportSettings("tcp")], sip_threads=2)
+    moved = pjsip_config.with_port_ranges(7000, 10)
+    assert [settings.port_range for settings in moved.transports] == [(7000, 7009), (7010, 7019)]
+    assert moved.sip_threads == 2
+
+
+def test_the_first_free_port_of_a_range_is_used(client_factory):
+    client = client_factory(config=PJSipConfig([TransportSettings(port=5090),
+                                                TransportSettings(port_range=(5090, 5092))]))
+    assert [transport.info().port for transport in client.transports] == [5090, 5091]